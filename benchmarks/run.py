@@ -0,0 +1,532 @@
+#!/usr/bin/env python
+"""Time PenPen's stages on synthetic feeds and audio.
+
+Run from the repository root:
+
+    python -m benchmarks.run [--save-baseline]
+
+Every stage runs once per feed size (feed stages) or audio length (audio
+stages) in a fresh interpreter, so its peak memory isn't inflated by the
+stages before it. The synthetic files are generated beforehand in another
+interpreter, and the peak is reset before each run, so it is the one of the
+stage alone. A stand-in for LAME (benchmarks/bin/lame) is put first on the
+PATH.
+
+Results are written as JSON. If a baseline exists, the run fails when a
+stage got slower or bigger than the baseline by more than the thresholds.
+Machines differ, so the baseline's times are first scaled by how long a
+fixed calibration workload took on each machine.
+"""
+
+import argparse
+import datetime
+import fnmatch
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+FEED_SIZES = (10, 1000, 10000, 50000)
+
+# Seconds of audio
+AUDIO_LENGTHS = (10, 60, 300)
+
+# Differences below this many seconds are noise, whatever the ratio
+MIN_TIME_DELTA = 0.01
+
+# Name of the workload timed to compare the speed of machines
+CALIBRATION = 'calibrate'
+
+
+def stageCalibrate(config, workDir, size):
+    """Serialize XML, hash and write small files, without PenPen.
+
+    The work is the same whatever PenPen's code, so how long it takes
+    only depends on the machine.
+    """
+    import hashlib
+    import xml.etree.ElementTree as ET
+
+    calibrationDir = os.path.join(workDir, 'calibrate')
+    data = bytes(range(256)) * 4096
+
+    def run():
+        root = ET.Element('channel')
+
+        for i in range(50000):
+            ET.SubElement(root, 'item').text = "Item %d" % i
+
+        ET.tostring(root)
+
+        for _ in range(64):
+            hashlib.sha256(data).hexdigest()
+
+        shutil.rmtree(calibrationDir, True)
+        os.makedirs(calibrationDir)
+
+        for i in range(500):
+            with open(os.path.join(calibrationDir, "%d" % i), 'wb') as f:
+                f.write(data[:4096])
+
+    return run
+
+
+def stageFeedAppend(config, workDir, size):
+    """Add one episode to the feed (incremental splice)."""
+    from penpen import episodeIndex, rss
+    from . import synthetic
+
+    synthetic.installFeed(config, workDir, size)
+    index = episodeIndex.openIndex(config)
+    episode = newEpisode(workDir)
+
+    return lambda: rss.addEpisodes(config, [episode], index)
+
+
+def stageFeedRebuild(config, workDir, size):
+    """Rewrite the whole feed with one new episode.
+
+    The feed is rewritten once first, as PenPen would have, so that the old
+    items are copied as is (see `rss.feedFragments`).
+    """
+    from penpen import episodeIndex, rss
+    from . import synthetic
+
+    synthetic.installFeed(config, workDir, size)
+    index = episodeIndex.openIndex(config)
+    rss.generateXml(config, [], index)
+    runs = itertools.count()
+
+    def run():
+        # A new guid every run, as the feed never holds an episode twice
+        item = rss.createItem(config, *newEpisode(workDir))
+        item.find('guid').text += "?run=%d" % next(runs)
+        rss.generateXml(config, [item], index)
+
+    return run
+
+
+def stageFeedIndex(config, workDir, size):
+    """Rebuild the episode index from the feed."""
+    from penpen import episodeIndex
+    from . import synthetic
+
+    synthetic.installFeed(config, workDir, size)
+
+    return lambda: episodeIndex.openIndex(config).close()
+
+
+def stageFeedRead(config, workDir, size):
+    """Parse every item of the feed."""
+    from penpen import rss
+    from . import synthetic
+
+    synthetic.installFeed(config, workDir, size)
+
+    def run():
+        for _ in rss.readEpisodes(config['xmlFilepath']):
+            pass
+
+    return run
+
+
+def stageFeedBackup(config, workDir, size):
+    """Snapshot the feed into an empty backup store."""
+    from penpen import rss
+    from . import synthetic
+
+    synthetic.installFeed(config, workDir, size)
+
+    return lambda: rss.createBackup(config)
+
+
+def stageAudioProbe(config, workDir, seconds):
+    """Read the duration of a WAV and an untagged CBR MP3."""
+    from penpen import probe
+    from . import synthetic
+
+    wavFile, mp3File = synthetic.episodeFiles(workDir, seconds)
+
+    return lambda: (probe.probeFile(wavFile), probe.probeFile(mp3File))
+
+
+def stageAudioTag(config, workDir, seconds):
+    """Tag an untagged MP3."""
+    from penpen import audio
+    from . import synthetic
+
+    _, mp3File = synthetic.episodeFiles(workDir, seconds)
+
+    return lambda: audio.tagAudio(mp3File, config, "Episode")
+
+
+def stageAudioCoverArt(config, workDir, seconds):
+    """Tag an untagged MP3, downscaling a 3000x3000 PNG cover first."""
+    from penpen import audio
+    from penpen import coverArt
+    from . import synthetic
+
+    _, mp3File = synthetic.episodeFiles(workDir, seconds)
+    coverFile = os.path.join(workDir, 'cover-3000.png')
+
+    if not os.path.isfile(coverFile):
+        synthetic.makeCover(coverFile, 3000)
+
+    config = dict(config, episodeImageFilepath=coverFile,
+                  coverArtSize="600")
+
+    def run():
+        # Nothing cached, in memory or on disk
+        coverArt._images.clear()
+        coverArt.removeStale(coverFile, "")
+        audio.tagAudio(mp3File, config, "Episode")
+
+    return run
+
+
+def stageAudioTranscode(config, workDir, seconds):
+    """Transcode a WAV to disk, then tag the MP3."""
+    return processWav(config, workDir, seconds, "no")
+
+
+def stageAudioStream(config, workDir, seconds):
+    """Transcode a WAV through LAME's pipes, tagging on the way."""
+    return processWav(config, workDir, seconds, "yes")
+
+
+def stageAudioRenditions(config, workDir, seconds):
+    """Transcode a WAV into two renditions from a single read, then tag."""
+    return processWav(config, workDir, seconds, "no", renditions="mono",
+                      rendition_mono_lameArgs="-b 64 -m m --quiet")
+
+
+def stageAudioLoudness(config, workDir, seconds):
+    """Measure the loudness and true peak of a WAV."""
+    from penpen import loudness
+    from . import synthetic
+
+    wavFile, _ = synthetic.episodeFiles(workDir, seconds)
+
+    return lambda: loudness.measure(wavFile)
+
+
+def stageAudioNormalize(config, workDir, seconds):
+    """Measure a WAV, then transcode it with the gain applied."""
+    return processWav(config, workDir, seconds, "no", loudnessTarget="-16")
+
+
+def processWav(config, workDir, seconds, streaming, **settings):
+    """Return a run of `audio.process` on a fresh WAV."""
+    from penpen import audio
+    from . import synthetic
+
+    wavFile, _ = synthetic.episodeFiles(workDir, seconds)
+    config = dict(config, buildCache="no", streamingTranscode=streaming,
+                  **settings)
+
+    return lambda: audio.process(wavFile, config, "Episode", "Episode")
+
+
+def newEpisode(workDir):
+    """Return the (title, desc, mp3File, duration) of a new episode."""
+    from . import synthetic
+
+    mp3File = os.path.join(workDir, 'new-episode.mp3')
+
+    if not os.path.isfile(mp3File):
+        synthetic.makeMp3(mp3File, 1)
+
+    return ("New episode", "The newest episode.", mp3File, (0, 42, 17))
+
+
+# Stage name => (function, sizes or lengths it runs with)
+STAGES = {CALIBRATION: (stageCalibrate, (1,)),
+          'feed.append': (stageFeedAppend, FEED_SIZES),
+          'feed.rebuild': (stageFeedRebuild, FEED_SIZES),
+          'feed.index': (stageFeedIndex, FEED_SIZES),
+          'feed.read': (stageFeedRead, FEED_SIZES),
+          'feed.backup': (stageFeedBackup, FEED_SIZES),
+          'audio.probe': (stageAudioProbe, AUDIO_LENGTHS),
+          'audio.tag': (stageAudioTag, AUDIO_LENGTHS),
+          'audio.coverArt': (stageAudioCoverArt, AUDIO_LENGTHS),
+          'audio.transcode': (stageAudioTranscode, AUDIO_LENGTHS),
+          'audio.stream': (stageAudioStream, AUDIO_LENGTHS),
+          'audio.renditions': (stageAudioRenditions, AUDIO_LENGTHS),
+          'audio.loudness': (stageAudioLoudness, AUDIO_LENGTHS),
+          'audio.normalize': (stageAudioNormalize, AUDIO_LENGTHS)}
+
+# Optional modules some stages need. They're skipped without them.
+STAGE_REQUIREMENTS = {'audio.coverArt': 'PIL',
+                      'audio.loudness': 'numpy',
+                      'audio.normalize': 'numpy'}
+
+
+def runStage(name, param, workDir, repeat):
+    """Run one stage `repeat` times in this process and return its timings.
+
+    The fastest run is reported. Setup isn't timed, and the peak memory is
+    the highest one of the runs themselves.
+    """
+    from penpen import metrics
+    from . import synthetic
+
+    logging.disable(logging.CRITICAL)
+    stage = STAGES[name][0]
+    config = synthetic.makeConfig(workDir)
+    wall = cpu = None
+    peak = 0
+
+    for _ in range(repeat):
+        run = stage(config, workDir, param)
+        metrics.resetPeakRss()
+
+        startWall = time.perf_counter()
+        startCpu = time.process_time()
+        run()
+        runWall = time.perf_counter() - startWall
+        runCpu = time.process_time() - startCpu
+
+        peak = max(peak, metrics.peakRssKb())
+
+        if wall is None or runWall < wall:
+            wall, cpu = runWall, runCpu
+
+    # Children (e.g. the encoder) are counted too. The setup runs none.
+    peak = max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    return {'wall': wall, 'cpu': cpu, 'peakRssMb': peak / 1024.0}
+
+
+def prepareStage(name, param, workDir):
+    """Generate the synthetic files a stage uses, without timing it."""
+    from . import synthetic
+
+    logging.disable(logging.CRITICAL)
+    STAGES[name][0](synthetic.makeConfig(workDir), workDir, param)
+
+
+def runInChild(name, param, workDir, repeat):
+    """Run one stage in a fresh interpreter and return its timings.
+
+    The synthetic files are generated in another interpreter first, so that
+    building them doesn't count towards the peak memory where it can't be
+    reset (see `metrics.resetPeakRss`).
+    """
+    env = dict(os.environ)
+    env['PATH'] = os.path.join(BENCH_DIR, 'bin') + os.pathsep + \
+        env.get('PATH', '')
+    command = [sys.executable, '-m', 'benchmarks.run', '--child', name,
+               str(param), '--work', workDir, '--repeat', str(repeat)]
+
+    subprocess.check_call(command + ['--prepare'], cwd=REPO_DIR, env=env)
+    output = subprocess.check_output(command, cwd=REPO_DIR, env=env)
+
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def compare(results, baseline, threshold, memoryThreshold, scale=1.0):
+    """Return descriptions of the stages that regressed against `baseline`.
+
+    The baseline's times are multiplied by `scale` (see `machineScale`).
+    """
+    regressions = []
+
+    for key, result in sorted(results.items()):
+        base = baseline.get(key)
+
+        if base is None or key == calibrationKey():
+            continue
+
+        baseWall = base['wall'] * scale
+
+        if result['wall'] > baseWall * (1 + threshold) + MIN_TIME_DELTA:
+            regressions.append("%s: %.3fs (baseline %.3fs scaled to %.3fs)"
+                               % (key, result['wall'], base['wall'],
+                                  baseWall))
+
+        if result['peakRssMb'] > base['peakRssMb'] * (1 + memoryThreshold):
+            regressions.append("%s: %.1f MB peak (baseline %.1f MB)" %
+                               (key, result['peakRssMb'], base['peakRssMb']))
+
+    return regressions
+
+
+def calibrationKey():
+    """Return the results key of the calibration workload."""
+    return "%s[%d]" % (CALIBRATION, STAGES[CALIBRATION][1][0])
+
+
+def machineScale(results, baseline):
+    """Return how much slower this machine is than the baseline's.
+
+    It is the ratio of the times of the calibration workload, or 1 if
+    either is missing.
+    """
+    key = calibrationKey()
+
+    if key not in results or key not in baseline:
+        return 1.0
+
+    return results[key]['wall'] / max(baseline[key]['wall'], 1e-9)
+
+
+def formatRow(key, result, base, scale=1.0):
+    """Format a line of the results table."""
+    row = "%-26s %9.4f %9.4f %9.1f" % (key, result['wall'], result['cpu'],
+                                       result['peakRssMb'])
+
+    if base and key != calibrationKey():
+        baseWall = base['wall'] * scale
+        row += " %+8.1f%%" % (100.0 * (result['wall'] - baseWall) /
+                              max(baseWall, 1e-9))
+
+    return row
+
+
+def parseArgs(argv):
+    """Parse the command line."""
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run',
+                                     description='Benchmark PenPen on \
+                                     synthetic feeds and audio.')
+    parser.add_argument('--stages', default='*',
+                        help='Comma separated stage names or patterns to \
+                        run (default: all). Stages: ' +
+                        ', '.join(sorted(STAGES)))
+    parser.add_argument('--sizes', type=lambda s: [int(v) for v in
+                                                   s.split(',')],
+                        default=FEED_SIZES,
+                        help='Feed sizes in items (default: %s).' %
+                        ','.join(map(str, FEED_SIZES)))
+    parser.add_argument('--lengths', type=lambda s: [int(v) for v in
+                                                     s.split(',')],
+                        default=AUDIO_LENGTHS,
+                        help='Audio lengths in seconds (default: %s).' %
+                        ','.join(map(str, AUDIO_LENGTHS)))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per stage. The fastest counts \
+                        (default: 3).')
+    parser.add_argument('--work',
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'penpen-bench'),
+                        help='Directory for the synthetic files. Feeds are \
+                        kept there between runs.')
+    parser.add_argument('--output',
+                        default=os.path.join(RESULTS_DIR, 'latest.json'),
+                        help='Where to write the results.')
+    parser.add_argument('--baseline',
+                        default=os.path.join(RESULTS_DIR, 'baseline.json'),
+                        help='Results to compare against.')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store the results as the new baseline.')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Allowed slowdown against the baseline \
+                        (default: 0.25 for 25%%).')
+    parser.add_argument('--memory-threshold', type=float, default=0.25,
+                        help='Allowed peak memory growth against the \
+                        baseline (default: 0.25 for 25%%).')
+    parser.add_argument('--child', nargs=2, metavar=('STAGE', 'PARAM'),
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--prepare', action='store_true',
+                        help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Run the benchmarks and check them against the baseline."""
+    args = parseArgs(sys.argv[1:] if argv is None else argv)
+
+    if not os.path.isdir(args.work):
+        os.makedirs(args.work)
+
+    if args.child:
+        name, param = args.child
+
+        if args.prepare:
+            prepareStage(name, int(param), args.work)
+        else:
+            print(json.dumps(runStage(name, int(param), args.work,
+                                      args.repeat)))
+        return 0
+
+    # The calibration always runs first, to scale the baseline
+    patterns = args.stages.split(',')
+    names = [CALIBRATION] + [name for name in sorted(STAGES)
+                             if name != CALIBRATION and
+                             any(fnmatch.fnmatch(name, p) for p in patterns)]
+
+    baseline = {}
+    if os.path.isfile(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    print("%-26s %9s %9s %9s" % ("stage", "wall (s)", "cpu (s)", "peak MB"))
+    results = {}
+    scale = 1.0
+
+    for name in names:
+        requirement = STAGE_REQUIREMENTS.get(name)
+
+        if requirement and importlib.util.find_spec(requirement) is None:
+            print("%-26s skipped (needs %s)" % (name, requirement))
+            continue
+
+        if name == CALIBRATION:
+            params = STAGES[name][1]
+        elif name.startswith('audio.'):
+            params = args.lengths
+        else:
+            params = args.sizes
+
+        for param in params:
+            key = "%s[%d]" % (name, param)
+            results[key] = runInChild(name, param, args.work, args.repeat)
+            print(formatRow(key, results[key], baseline.get(key), scale))
+            sys.stdout.flush()
+
+            if name == CALIBRATION:
+                scale = machineScale(results, baseline)
+
+                if baseline:
+                    print("Baseline times scaled by %.2f for this machine"
+                          % scale)
+
+    report = {'created': datetime.datetime.utcnow().isoformat(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'repeat': args.repeat,
+              'results': results}
+
+    outputs = [args.output] + ([args.baseline] if args.save_baseline else [])
+
+    for output in outputs:
+        if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+            os.makedirs(os.path.dirname(os.path.abspath(output)))
+
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+        print("Saved results => " + output)
+
+    regressions = compare(results, baseline, args.threshold,
+                          args.memory_threshold, scale)
+
+    for regression in regressions:
+        print("REGRESSION " + regression)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
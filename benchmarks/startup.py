@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""Check that the feed-only commands start quickly.
+
+Run from the repository root:
+
+    python -m benchmarks.startup [--budget-ms 50]
+
+`penpen list`, `penpen validate` and `penpen rebuild` are run on a synthetic
+feed with `python -X importtime`. The time spent importing modules that a
+bare interpreter doesn't import is added up (the fastest of a few runs), and
+the check fails if it is over the budget or if any of the modules only
+needed to publish or serve (mutagen, asyncio, multiprocessing, ...) were
+loaded.
+"""
+
+import argparse
+import compileall
+import os
+import subprocess
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+COMMANDS = ('list', 'validate', 'rebuild')
+
+# Modules the feed-only commands must not load
+HEAVY_MODULES = ('mutagen', 'asyncio', 'ctypes', 'concurrent.futures',
+                 'multiprocessing', 'subprocess', 'xml.dom', 'urllib.request',
+                 'brotli', 'cProfile')
+
+# Runs the commands the way the `penpen` script does
+LAUNCHER = "import sys; sys.argv = ['penpen'] + sys.argv[1:]; " \
+    "import penpen; penpen.main()"
+
+
+def importTimes(args, cwd):
+    """Run Python with `-X importtime` and return {module: self time (us)}."""
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                            cwd=cwd, env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+
+    if result.returncode != 0:
+        raise RuntimeError("\'" + " ".join(args) + "\' failed:\n" +
+                           result.stderr)
+
+    times = {}
+
+    # "import time: self [us] | cumulative | imported package"
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        selfTime, _, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(selfTime)
+
+    return times
+
+
+def isHeavy(module):
+    """Check whether `module` is (in) one of `HEAVY_MODULES`."""
+    return any(module == heavy or module.startswith(heavy + '.')
+               for heavy in HEAVY_MODULES)
+
+
+def measure(command, configFile, workDir, bare, repeat):
+    """Return (ms spent importing beyond `bare`, heavy modules loaded)."""
+    best = None
+    heavy = set()
+
+    for _ in range(repeat):
+        times = importTimes(['-c', LAUNCHER, command, '-c', configFile],
+                            workDir)
+        extra = dict((m, t) for m, t in times.items() if m not in bare)
+        total = sum(extra.values()) / 1000.0
+        heavy.update(m for m in extra if isHeavy(m))
+
+        if best is None or total < best:
+            best = total
+
+    return best, sorted(heavy)
+
+
+def parseArgs(argv):
+    """Parse the command line."""
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.startup',
+                                     description='Check the import time of \
+                                     the feed-only commands.')
+    parser.add_argument('--budget-ms', type=float, default=50.0,
+                        help='Allowed import time per command in \
+                        milliseconds (default: 50).')
+    parser.add_argument('--size', type=int, default=1000,
+                        help='Items in the synthetic feed (default: 1000).')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs per command. The fastest counts \
+                        (default: 5).')
+    parser.add_argument('--work',
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'penpen-bench'),
+                        help='Directory for the synthetic files.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Time the startup of each command and check it against the budget."""
+    from . import synthetic
+
+    args = parseArgs(sys.argv[1:] if argv is None else argv)
+
+    if not os.path.isdir(args.work):
+        os.makedirs(args.work)
+
+    config = synthetic.makeConfig(args.work)
+    synthetic.installFeed(config, args.work, args.size)
+
+    configFile = os.path.join(args.work, 'startup.conf')
+    with open(configFile, 'w') as f:
+        for key, value in sorted(config.items()):
+            f.write('%s="%s"\n' % (key, value))
+
+    # Compile the package as an install would, so no run pays for it (e.g.
+    # under PYTHONDONTWRITEBYTECODE)
+    compileall.compile_dir(os.path.join(REPO_DIR, 'penpen'), quiet=1)
+
+    # Build the index and sidecar so `list` and `validate` don't rebuild them
+    importTimes(['-c', LAUNCHER, 'rebuild', '-c', configFile], args.work)
+
+    bare = importTimes(['-c', 'pass'], args.work)
+    failures = []
+
+    print("%-10s %10s  %s" % ("command", "import ms", "heavy modules"))
+
+    for command in COMMANDS:
+        total, heavy = measure(command, configFile, args.work, bare,
+                               args.repeat)
+        print("%-10s %10.1f  %s" % (command, total, ", ".join(heavy) or "-"))
+
+        if total > args.budget_ms:
+            failures.append("%s: %.1f ms of imports (budget %.1f ms)" %
+                            (command, total, args.budget_ms))
+
+        if heavy:
+            failures.append("%s: loaded %s" % (command, ", ".join(heavy)))
+
+    for failure in failures:
+        print("FAILED " + failure)
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""Generate the config, feeds and audio files used by the benchmarks.
+
+Everything is generated offline. Feeds are built with PenPen itself and
+kept in the work directory, so the large ones are only built once.
+"""
+
+import datetime
+import os
+import shutil
+import struct
+
+from penpen import audio
+from penpen import core
+from penpen import episodeIndex
+from penpen import fileUtils
+from penpen import rss
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Silent MPEG 1 Layer III frame: 128 kbps, 44.1 kHz, stereo
+MP3_FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+MP3_FRAME_SAMPLES = 1152
+
+# CD quality WAVs
+WAV_RATE = 44100
+WAV_CHANNELS = 2
+WAV_SAMPLE_BYTES = 2
+
+# Size of the writes used when generating audio
+WRITE_CHUNK_SIZE = 1048576
+
+
+def makeConfig(workDir):
+    """Return the example config with its files moved into `workDir`."""
+    config = core.parseConfigFile(os.path.join(REPO_DIR,
+                                               'configurationExample.conf'))
+    config['xmlFilepath'] = os.path.join(workDir, 'feed.xml')
+    config['rssBackupDir'] = os.path.join(workDir, 'backups')
+    config['episodeImageFilepath'] = os.path.join(workDir, 'cover.jpg')
+
+    # A cover of a typical size. Only its extension is checked.
+    if not os.path.isfile(config['episodeImageFilepath']):
+        with open(config['episodeImageFilepath'], 'wb') as f:
+            f.write(os.urandom(200 * 1024))
+
+    return config
+
+
+def feedFilepath(workDir, count):
+    """Return the location of the cached feed with `count` items."""
+    return os.path.join(workDir, 'feeds', 'feed-%d.xml' % count)
+
+
+def makeFeed(config, workDir, count):
+    """Build (once) a feed with `count` items and return its location."""
+    filepath = feedFilepath(workDir, count)
+
+    if os.path.isfile(filepath):
+        return filepath
+
+    feedDir = os.path.dirname(filepath)
+    buildDir = os.path.join(feedDir, 'build')
+    shutil.rmtree(buildDir, True)
+    os.makedirs(buildDir)
+
+    buildConfig = dict(config)
+    buildConfig['xmlFilepath'] = os.path.join(buildDir, 'feed.xml')
+    buildConfig['rssBackupDir'] = os.path.join(buildDir, 'backups')
+    mp3File = makeMp3(os.path.join(buildDir, 'episode.mp3'), 1)
+
+    # Newest first, one episode a week
+    start = datetime.datetime(2000, 1, 1)
+    items = []
+
+    for i in reversed(range(count)):
+        item = rss.createItem(buildConfig, "Episode %d" % i,
+                              "Description of episode %d. " % i * 8, mp3File,
+                              (0, 42, 17),
+                              start + datetime.timedelta(weeks=i))
+        item.find('guid').text = rss.episodeGuid(buildConfig,
+                                                 "episode-%d.mp3" % i)
+        item.find('enclosure').set('url', item.findtext('guid'))
+        item.find('enclosure').set('length', str(40000000 + i))
+        items.append(item)
+
+    rss.generateXml(buildConfig, items,
+                    episodeIndex.openIndex(buildConfig))
+
+    os.rename(buildConfig['xmlFilepath'], filepath)
+    shutil.rmtree(buildDir)
+
+    return filepath
+
+
+def installFeed(config, workDir, count):
+    """Put a fresh copy of the feed with `count` items in place.
+
+    The files derived from the live feed (index, variants, backups) are
+    removed so every run starts from the same state.
+    """
+    source = makeFeed(config, workDir, count)
+    xmlFilepath = config['xmlFilepath']
+
+    for suffix in (episodeIndex.INDEX_SUFFIX, rss.GZIP_SUFFIX,
+                   rss.BROTLI_SUFFIX, fileUtils.META_SUFFIX):
+        if os.path.exists(xmlFilepath + suffix):
+            os.remove(xmlFilepath + suffix)
+
+    shutil.rmtree(config['rssBackupDir'], True)
+    shutil.copyfile(source, xmlFilepath)
+
+
+def makeWav(filepath, seconds):
+    """Write a 16 bit stereo WAV of `seconds` and return its location."""
+    dataSize = int(seconds * WAV_RATE) * WAV_CHANNELS * WAV_SAMPLE_BYTES
+    byteRate = WAV_RATE * WAV_CHANNELS * WAV_SAMPLE_BYTES
+
+    with open(filepath, 'wb') as f:
+        f.write(b'RIFF' + struct.pack('<I', 36 + dataSize) + b'WAVE')
+        f.write(b'fmt ' + struct.pack('<IHHIIHH', 16, 1, WAV_CHANNELS,
+                                      WAV_RATE, byteRate,
+                                      WAV_CHANNELS * WAV_SAMPLE_BYTES,
+                                      WAV_SAMPLE_BYTES * 8))
+        f.write(b'data' + struct.pack('<I', dataSize))
+
+        # A ramp rather than silence, so nothing can shortcut zeros
+        chunk = bytes(bytearray(i & 0xff for i in range(WRITE_CHUNK_SIZE)))
+
+        for pos in range(0, dataSize, WRITE_CHUNK_SIZE):
+            f.write(chunk[:dataSize - pos])
+
+    return filepath
+
+
+def makeCover(filepath, size):
+    """Write a `size` pixels square PNG of noise and return its location.
+
+    Needs Pillow.
+    """
+    from PIL import Image
+
+    Image.frombytes('RGB', (size, size),
+                    os.urandom(size * size * 3)).save(filepath)
+
+    return filepath
+
+
+def makeMp3(filepath, seconds):
+    """Write a CBR MP3 of `seconds` (no tag) and return its location."""
+    frames = max(1, int(seconds * WAV_RATE / MP3_FRAME_SAMPLES))
+    perChunk = WRITE_CHUNK_SIZE // len(MP3_FRAME)
+
+    with open(filepath, 'wb') as f:
+        for pos in range(0, frames, perChunk):
+            f.write(MP3_FRAME * min(perChunk, frames - pos))
+
+    return filepath
+
+
+def makeAudio(workDir, seconds):
+    """Build (once) a WAV and an MP3 of `seconds`. Return their locations."""
+    audioDir = os.path.join(workDir, 'audio')
+
+    if not os.path.isdir(audioDir):
+        os.makedirs(audioDir)
+
+    wavFile = os.path.join(audioDir, 'source-%d.wav' % seconds)
+    mp3File = os.path.join(audioDir, 'source-%d.mp3' % seconds)
+
+    if not os.path.isfile(wavFile):
+        makeWav(wavFile, seconds)
+
+    if not os.path.isfile(mp3File):
+        makeMp3(mp3File, seconds)
+
+    return wavFile, mp3File
+
+
+def episodeFiles(workDir, seconds):
+    """Return fresh copies of the synthetic WAV and MP3 to process."""
+    wavSource, mp3Source = makeAudio(workDir, seconds)
+    wavFile = os.path.join(workDir, 'episode.wav')
+    mp3File = os.path.join(workDir, 'tagged.mp3')
+
+    for filepath in (wavFile, mp3File, audio.mp3Filename(wavFile)):
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+    shutil.copyfile(wavSource, wavFile)
+    shutil.copyfile(mp3Source, mp3File)
+
+    return wavFile, mp3File
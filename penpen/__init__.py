@@ -1,6 +1,13 @@
 """PenPen package init script."""
 
 from . import core
+from .errors import (PenPenError, ConfigError, AudioError, FeedError,
+                     DuplicateEpisodeError, EpisodeNotFoundError)
+from .feed import Episode, Feed
+
+__all__ = ['core', 'PenPenError', 'ConfigError', 'AudioError', 'FeedError',
+           'DuplicateEpisodeError', 'EpisodeNotFoundError', 'Episode', 'Feed',
+           'main']
 
 
 def main():
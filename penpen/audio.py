@@ -3,160 +3,608 @@
 
 # Standard modules
 import datetime
+import hashlib
+import json
 import logging
 import os
+import shlex
+import struct
 import subprocess
+import threading
 
 
 # Third party modules
-import mutagen.id3
-from mutagen.easyid3 import EasyID3
-from mutagen.id3 import ID3, APIC
+from mutagen import MutagenError
+from mutagen.id3 import ID3, APIC, TALB, TDRC, TIT2, TPE1
 from mutagen.mp3 import MP3
 
 # Custom modules
+from . import buildCache
+from . import coverArt
+from . import errors
 from . import fileUtils
+from . import loudness
+from . import metrics
+from . import probe
 
 
-# Configure logger globally
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Padding (in bytes) reserved after the ID3 tag when the tag has to grow, so
+# that later re-tags fit in place without rewriting the audio.
+DEFAULT_ID3_PADDING = 16384
 
+# Encoder settings (VBR, high quality), unless `lameArgs` is set
+LAME_ARGS = ['-V2', '-h', '--quiet']
+
+# Size of the reads used when streaming audio through LAME
+STREAM_CHUNK_SIZE = 65536
+
+# SHA-256 of an embedded cover => its APIC frame
+_coverFrames = {}
+
+
+@metrics.stage('audio.process')
 def process(filename, config, title, desc):
-    """Transcode the audio file if necessary, then add ID3 tags."""
+    """Transcode the audio file if necessary, then add ID3 tags.
+
+    A WAV is encoded into the main MP3 and into the MP3 of each rendition
+    in the config (see `renditions`), all from a single read of the WAV.
+    MP3s built from the same inputs before are reused (see `buildCache`).
+    Return the main MP3 and its duration.
+    """
     # Check that the file exists
     if not os.path.isfile(filename):
-        logger.fatal("\'" + filename + "\' does not exist.")
-        exit(1)
+        raise errors.AudioError("\'" + filename + "\' does not exist.")
 
     # Check that the file is either a WAV or an MP3
     if not fileUtils.extValid(filename, '.WAV') and \
        not fileUtils.extValid(filename, '.MP3'):
-        logger.fatal("The audio file must be a WAV or MP3.")
-        exit(1)
+        raise errors.AudioError("The audio file must be a WAV or MP3.")
+
+    # An MP3 is only tagged
+    if not fileUtils.extValid(filename, '.WAV'):
+        if loudness.settings(config) is not None or renditions(config):
+            logger.info("Only WAVs are normalized or encoded into " +
+                        "renditions. Only tagging \'" + filename + "\'.")
+
+        length = reuseBuild(filename, config, title)
+
+        if length is None:
+            # Add the meta data and calculate the duration in a single pass
+            length = tagAudio(filename, config, title)
+
+            if buildCache.enabled(config):
+                buildCache.saveEntry(filename, None, None,
+                                     tagKey(config, title), length)
+
+        return filename, splitDuration(length)
+
+    # (MP3, config) of the main MP3 and of each rendition
+    outputs = [(mp3Filename(filename), config)] + \
+        [(mp3Filename(filename, rendition['mp3Suffix']), rendition)
+         for rendition in renditions(config)]
+    normalization = loudness.settings(config)
 
-    # If it's a WAV, then transcode it to MP3
-    if fileUtils.extValid(filename, '.WAV'):
-        filename = transcodeAudio(filename)
+    # Only the MP3s that aren't up to date are encoded
+    lengths = [reuseBuild(mp3File, outputConfig, title, filename,
+                          normalization)
+               for mp3File, outputConfig in outputs]
+    stale = [output for output, length in zip(outputs, lengths)
+             if length is None]
 
-    # Add and calculate meta data
-    addID3Tags(filename, config, title, desc)
-    addCoverArt(filename, config)
-    duration = calcDuration(filename)
+    if stale:
+        length = encodeWav(filename, stale, config, title, normalization)
+    else:
+        length = lengths[0]
 
     # Return the name of the processed audio file and the duration
-    return filename, duration
+    return outputs[0][0], splitDuration(length)
 
 
-def transcodeAudio(filename):
-    """Convert the WAV to an MP3 using Lame."""
-    logger.info("Transcoding to MP3...")
+def reuseBuild(mp3File, config, title, source=None, normalization=None):
+    """Reuse an MP3 built from the same inputs before (see `buildCache`).
 
-    # Check if LAME is installed
-    lamePath = fileUtils.which("lame")
+    `source` is the WAV the MP3 is transcoded from, if any. An MP3 that is
+    up to date except for its tags is re-tagged. Return its length in
+    seconds, or None if it has to be built.
+    """
+    if not buildCache.enabled(config):
+        return None
+
+    entry = buildCache.loadEntry(mp3File)
+
+    if entry is None or not buildCache.outputMatches(entry, mp3File):
+        return None
+
+    if source is not None and \
+            not buildCache.sourceMatches(entry, mp3File, source,
+                                         lameArgs(config), normalization):
+        return None
+
+    tags = tagKey(config, title)
+
+    if entry['tagKey'] != tags:
+        logger.info("\'" + mp3File + "\' is up to date except for its " +
+                    "tags. Re-tagging...")
+        tagAudio(mp3File, config, title)
+        entry['tagKey'] = tags
+        entry['output'] = buildCache.fileStat(mp3File)
+        buildCache.writeEntry(mp3File, entry)
+    else:
+        logger.info("\'" + mp3File + "\' is up to date. Skipping...")
+
+    return entry['length']
 
-    if not lamePath:
-        logger.fatal("LAME could not be found. Please make sure it is " +
-                     "installed (brew install lame // apt-get install lame) " +
-                     "and in the current PATH.")
-        exit(1)
+
+def encodeWav(filename, outputs, config, title, normalization):
+    """Encode a WAV into the tagged MP3 of each (mp3File, config) output.
+
+    The WAV is normalized first if `normalization` is set. Return its length
+    in seconds.
+    """
+    # The exact duration is known from the WAV header, so the MP3s aren't
+    # probed for it
+    wavInfo = probe.probeFile(filename)
+    gain = None
+
+    # The gain is applied while the samples are fed to LAME
+    if normalization is not None:
+        normalization = loudness.analyze(filename, normalization)
+        gain = normalization['gain']
+
+    if config.get('streamingTranscode') == "yes":
+        # The tags are written along with the audio
+        sourceHash = streamTranscode(filename, outputs, title, gain)
+        lengths = [wavInfo.length if wavInfo else mp3Length(mp3File)
+                   for mp3File, _ in outputs]
+    else:
+        sourceHash = transcodeAudio(filename, outputs, gain)
+        lengths = [tagAudio(mp3File, outputConfig, title)
+                   for mp3File, outputConfig in outputs]
+        lengths = [wavInfo.length if wavInfo else length
+                   for length in lengths]
+
+    # The entry is also where the measured loudness is recorded
+    for (mp3File, outputConfig), length in zip(outputs, lengths):
+        if buildCache.enabled(outputConfig) or normalization is not None:
+            # Hashed once for all the outputs
+            if sourceHash is None:
+                sourceHash = buildCache.fileHash(filename)
+
+            buildCache.saveEntry(mp3File, (filename, sourceHash),
+                                 lameArgs(outputConfig),
+                                 tagKey(outputConfig, title), length,
+                                 normalization)
+
+    return lengths[0]
+
+
+@metrics.stage('audio.transcode')
+def transcodeAudio(filename, outputs, gain=None):
+    """Convert the WAV to an MP3 using Lame, for each (mp3File, config).
+
+    A single MP3 is encoded by LAME from the WAV itself. For several, the
+    WAV is read once and fed to one LAME per MP3, all running at once. With
+    a `gain` (dB), the samples are scaled on their way into LAME's stdin.
+    Return the SHA-256 (hex) of the WAV if it was read here, or None.
+    """
+    logger.info("Transcoding to MP3...")
+
+    lamePath = findLame()
 
     # Check if the mp3 already exists. Using the absolute path so that the
     # subprocess call can be done with `shell=False` (for added security).
-    fileroot, _ = os.path.splitext(os.path.abspath(filename))
+    for mp3File, _ in outputs:
+        if os.path.isfile(mp3File):
+            logger.warning("\'" + mp3File + "\' already exists. " +
+                           "Overwriting...")
 
-    if fileUtils.os.path.isfile(fileroot + ".mp3"):
-        logger.warning("\'" + fileroot + ".mp3\' already exists. " +
-                       "Overwriting...")
+    # Each LAME writes to a temporary file next to its MP3. They only
+    # replace the MP3s once every LAME succeeded.
+    tmpFiles = [fileUtils.tempFilepath(mp3File) for mp3File, _ in outputs]
+    sourceHash = None
 
     # Transcode the mp3
     try:
         # Since subprocess is called with `shell=false`, arguments can not be
-        # passed in a string. Must pass in args as a list.
-        cmd = [lamePath,
-               '-V2',
-               '-h',
-               '--quiet',
-               fileroot + ".wav",
-               fileroot + ".mp3"]
+        # passed in a string. Must pass in args as a list. The source keeps
+        # its own extension (e.g. ".WAV").
+        if len(outputs) == 1 and not gain:
+            _, config = outputs[0]
+            cmd = [lamePath] + lameArgs(config) + [os.path.abspath(filename),
+                                                   tmpFiles[0]]
+
+            # Running with shell false for security.
+            failed = subprocess.call(cmd, shell=False) != 0
+        else:
+            lames = [subprocess.Popen([lamePath] + lameArgs(config) +
+                                      ['-', tmpFile],
+                                      stdin=subprocess.PIPE, shell=False)
+                     for (_, config), tmpFile in zip(outputs, tmpFiles)]
+            sourceHash = hashlib.sha256()
+            failures = []
+            feedSource(filename, [lame.stdin for lame in lames],
+                       sourceHash, failures, gain)
+
+            # The others would encode a truncated source
+            if failures:
+                for lame in lames:
+                    lame.kill()
+
+            failed = [lame.wait() for lame in lames] != [0] * len(lames) \
+                or bool(failures)
+
+        if failed:
+            raise errors.AudioError("Transcoding \'" + filename +
+                                    "\' failed.")
+
+        for (mp3File, _), tmpFile in zip(outputs, tmpFiles):
+            fileUtils.replaceFile(tmpFile, mp3File)
+    finally:
+        for tmpFile in tmpFiles:
+            fileUtils.removeTemp(tmpFile)
+
+    # Return the hash of what was transcoded.
+    return sourceHash.hexdigest() if sourceHash else None
+
+
+@metrics.stage('audio.streamTranscode')
+def streamTranscode(filename, outputs, title, gain=None):
+    """Transcode the WAV through LAME's stdin and stdout, tags included.
+
+    There is one LAME per (mp3File, config) output, all fed from a single
+    read of the WAV (scaled by `gain` (dB), if any). The finished ID3 tag
+    of each MP3 is written first and the encoded audio is appended as LAME
+    produces it, so the MP3s are written once and never read back (see
+    `writeStream`). The SHA-256 of the source is computed while feeding it
+    to LAME.
+
+    Return the source's SHA-256 (hex).
+    """
+    logger.info("Transcoding to MP3 and adding ID3 tags...")
+
+    lamePath = findLame()
+    sourceHash = hashlib.sha256()
+    failures = []
+    lames = []
+    writers = []
+
+    for mp3File, config in outputs:
+        if os.path.isfile(mp3File):
+            logger.warning("\'" + mp3File + "\' already exists. " +
+                           "Overwriting...")
+
+        # Built here so that a missing cover stops us before encoding
+        tags = ID3()
+
+        for frame in buildTagFrames(config, title):
+            tags.setall(frame.FrameID, [frame])
+
+        lame = subprocess.Popen([lamePath] + lameArgs(config) + ['-', '-'],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, shell=False)
+        writer = threading.Thread(target=writeStream,
+                                  args=(lame, mp3File, tags,
+                                        id3Padding(config), failures))
+        writer.start()
+        lames.append(lame)
+        writers.append(writer)
+
+    feedSource(filename, [lame.stdin for lame in lames], sourceHash,
+               failures, gain)
+
+    for writer in writers:
+        writer.join()
+
+    for lame in lames:
+        lame.wait()
+
+    if failures:
+        raise errors.AudioError("Transcoding \'" + filename + "\' failed.")
+
+    return sourceHash.hexdigest()
+
+
+def writeStream(lame, mp3File, tags, padding, failures):
+    """Write the MP3 that `lame` encodes to its stdout, after its tag.
+
+    The VBR header, which LAME can't fill in on a pipe, is patched from the
+    frames counted on the way. Errors are added to `failures`.
+    """
+    def writeContents(f):
+        tags.save(f.name, padding=padding)
+        f.seek(0, os.SEEK_END)
+        audioStart = f.tell()
+        counter = probe.FrameCounter()
+
+        while True:
+            chunk = lame.stdout.read(STREAM_CHUNK_SIZE)
 
-        # Running with shell false for security.
-        subprocess.call(cmd, shell=False)
-    except:
-        raise
+            if not chunk:
+                break
 
-    # Return the filename of the transcoded file.
-    return fileroot + ".mp3"
+            counter.update(chunk)
+            f.write(chunk)
 
+        # The input may have been cut short by a failure elsewhere
+        if lame.wait() != 0 or failures or not counter.frames:
+            raise IOError("LAME failed to encode \'" + mp3File + "\'.")
 
-def addID3Tags(filename, config, title, desc):
-    """Add ID3 tags."""
-    logger.info("Adding ID3 tags...")
+        writeVbrHeader(f, audioStart, counter)
 
-    # Get reference to tags, add them if not found
     try:
-        metaData = EasyID3(filename)
-    except mutagen.id3.ID3NoHeaderError:
-        metaData = MP3(filename, ID3=EasyID3)
-        metaData.add_tags()
+        fileUtils.writeAtomic(mp3File, writeContents)
+    except Exception as e:
+        failures.append(e)
+    finally:
+        # LAME stops (instead of waiting for it to be read) if this failed
+        lame.stdout.close()
 
-    # Set tags
-    metaData['title'] = title
-    metaData['artist'] = str(config['episodeAuthor'])
-    metaData['date'] = str(str(datetime.datetime.now().year))
-    metaData['album'] = str(config['rssTitle'])
-    metaData.save()
 
+def feedSource(filename, pipes, sourceHash, failures, gain=None):
+    """Write the source file into the stdin of each LAME, hashing it once.
 
-def addCoverArt(filename, config):
-    """Add cover art."""
-    logger.info("Adding the Cover Image...")
+    The hash is of the source as is. The samples written are scaled by
+    `gain` (dB) if it's set. Errors are added to `failures`.
+    """
+    try:
+        stream = loudness.GainStream(filename, gain) if gain else None
+
+        with open(filename, 'rb') as f:
+            while True:
+                chunk = f.read(STREAM_CHUNK_SIZE)
+
+                if not chunk:
+                    break
+
+                sourceHash.update(chunk)
+
+                if stream:
+                    chunk = stream.process(chunk)
+
+                for pipe in pipes:
+                    pipe.write(chunk)
+    except (IOError, OSError) as e:
+        failures.append(e)
+    finally:
+        for pipe in pipes:
+            try:
+                pipe.close()
+            except (IOError, OSError):
+                pass
+
+
+def writeVbrHeader(f, audioStart, counter):
+    """Fill in the frame and byte counts of the stream's VBR header.
+
+    LAME reserves the first frame for the header and only writes it when it
+    can seek back, which it can't on a pipe. An existing Xing/Info header
+    with both counts is updated. An empty (all zero) first frame gets a new
+    Xing header. Anything else is left alone.
+    """
+    offset, frame = counter.firstFrame
+    f.seek(audioStart + offset)
+    data = bytearray(f.read(frame.length))
+    pos = probe.xingOffset(frame)
+
+    # The header frame isn't counted
+    counts = struct.pack('>II', counter.frames - 1, counter.size - offset)
+
+    if bytes(data[pos:pos + 4]) in (b'Xing', b'Info'):
+        flags = struct.unpack('>I', bytes(data[pos + 4:pos + 8]))[0]
+
+        if flags & 3 != 3:
+            return
+
+        data[pos + 8:pos + 16] = counts
+
+        # Keep the CRC of a LAME tag valid
+        lamePos = pos + 8 + 8 + (100 if flags & 4 else 0) + \
+            (4 if flags & 8 else 0)
+
+        if bytes(data[lamePos:lamePos + 4]) == b'LAME' and \
+                len(data) >= lamePos + 36:
+            data[lamePos + 34:lamePos + 36] = struct.pack(
+                '>H', probe.lameTagCrc(data[:lamePos + 34]))
+    elif not any(data[4:]):
+        data[pos:pos + 16] = b'Xing' + struct.pack('>I', 3) + counts
+    else:
+        return
 
-    # Check that the file exists
-    imageFilepath = config['episodeImageFilepath']
+    f.seek(audioStart + offset)
+    f.write(bytes(data))
+    f.seek(0, os.SEEK_END)
 
-    if not os.path.isfile(imageFilepath):
-        logger.fatal("\'" + imageFilepath + "\' does not exist.")
-        exit(1)
 
-    # Initialize the tag
-    imageTag = APIC()
+def findLame():
+    """Return the path to LAME. Raise AudioError if it isn't installed."""
+    lamePath = fileUtils.which("lame")
 
-    # Determine the file type
-    if fileUtils.extValid(imageFilepath.lower(), '.png'):
-        imageTag.mime = 'image/png'
-    elif fileUtils.extValid(imageFilepath.lower(), '.jpg'):
-        imageTag.mime = 'image/jpeg'
-    else:
-        logger.fatal("Cover image must be a PNG or JPG.")
-        exit(1)
+    if not lamePath:
+        raise errors.AudioError("LAME could not be found. Please make sure " +
+                                "it is installed (brew install lame // " +
+                                "apt-get install lame) and in the current " +
+                                "PATH.")
 
-    # Set the image tags
-    imageTag.encoding = 3  # 3 is for utf-8
-    imageTag.type = 3      # 3 is for cover image
-    imageTag.desc = 'Cover'
+    return lamePath
 
-    with open(imageFilepath, 'rb') as f:
-        imageTag.data = f.read()
 
-    # Add the tag using ID3
-    try:
-        mp3 = MP3(filename, ID3=ID3)
-        mp3.tags.add(imageTag)
-        mp3.save()
-    except:
-        raise
+def mp3Filename(filename, suffix=""):
+    """Return the absolute path of the MP3 that `process` will produce.
+
+    The MP3s of renditions have their `suffix` (`mp3Suffix`) added to the
+    name.
+    """
+    fileroot, _ = os.path.splitext(os.path.abspath(filename))
+    return fileroot + suffix + ".mp3"
+
+
+def lameArgs(config):
+    """Return the LAME arguments (`lameArgs`) in `config` as a list."""
+    if not config.get('lameArgs'):
+        return list(LAME_ARGS)
+
+    return shlex.split(config['lameArgs'])
+
 
+def renditions(config):
+    """Return the config of each rendition listed in `renditions`.
+
+    Renditions are extra MP3s encoded from the same WAV as the main one
+    (e.g. a low bitrate mono one). `renditions` is a comma separated list
+    of names. The config of a rendition is the main config with each
+    `rendition_[name]_[key]` in it replacing `[key]`, e.g.
+    `rendition_mono_lameArgs`. Unless they are replaced:
+
+    - `mp3Suffix` is "-[name]", added to the name of the MP3.
+    - `xmlFilepath` is None: the rendition isn't added to a feed.
+    - `rssBackupDir` is `rendition-[name]` inside the main one.
+
+    The loudness settings of the main config apply to every rendition.
+    """
+    result = []
+
+    for name in config.get('renditions', "").split(','):
+        name = name.strip()
+
+        if not name:
+            continue
+
+        prefix = 'rendition_' + name + '_'
+        rendition = dict(config, renditions="", mp3Suffix="-" + name,
+                         xmlFilepath=None,
+                         rssBackupDir=os.path.join(
+                             config.get('rssBackupDir', ""),
+                             'rendition-' + name))
+        rendition.update((key[len(prefix):], value)
+                         for key, value in config.items()
+                         if key.startswith(prefix))
+        result.append(rendition)
+
+    return result
+
+
+@metrics.stage('audio.tag')
+def tagAudio(filename, config, title):
+    """Write the complete ID3 tag with a single save.
+
+    All frames are built in memory and the file is saved once. The duration
+    is taken from the MPEG header parsed by the same open and returned in
+    seconds.
+    """
+    logger.info("Adding ID3 tags and the Cover Image...")
+
+    mp3 = MP3(filename, ID3=ID3)
+
+    # Add an empty tag if the file doesn't have one yet
+    if mp3.tags is None:
+        mp3.add_tags()
+
+    # Replace any existing frames of the same type
+    for frame in buildTagFrames(config, title):
+        mp3.tags.setall(frame.FrameID, [frame])
+
+    mp3.save(padding=id3Padding(config))
+
+    return mp3.info.length
+
+
+def buildTagFrames(config, title, year=None):
+    """Build the list of ID3 frames for an episode.
+
+    The recording date is `year`, or the current year if it isn't given.
+    """
+    year = year or datetime.datetime.now().year
+
+    # 3 is for utf-8
+    return [TIT2(encoding=3, text=[title]),
+            TPE1(encoding=3, text=[str(config['episodeAuthor'])]),
+            TDRC(encoding=3, text=[str(year)]),
+            TALB(encoding=3, text=[str(config['rssTitle'])]),
+            coverArtFrame(config)]
+
+
+def tagKey(config, title, year=None):
+    """Return a key that changes whenever the tag frames would."""
+    coverHash = None
+
+    # A missing cover is reported when the tag is built. The hash is the
+    # one of the image embedded, so resizing it differently re-tags.
+    if os.path.isfile(config['episodeImageFilepath']):
+        coverHash = coverArt.embeddedImage(config).sha256
+
+    inputs = [title, str(config['episodeAuthor']), str(config['rssTitle']),
+              str(year or datetime.datetime.now().year), coverHash]
+
+    return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()
+
+
+def prepareCoverArt(config):
+    """Prepare the cover art of `config` and of its renditions.
+
+    Done before starting worker processes, so that they find the cover
+    ready (see `coverArt`).
+    """
+    for outputConfig in [config] + renditions(config):
+        coverArt.embeddedImage(outputConfig)
+
+
+def coverArtFrame(config):
+    """Build the APIC frame holding the cover art.
+
+    The cover is prepared once (see `coverArt`) and the frame is shared by
+    all the MP3s tagged with it in this process.
+    """
+    image = coverArt.embeddedImage(config)
+
+    if image.sha256 not in _coverFrames:
+        # 3 is for utf-8, 3 is for cover image
+        _coverFrames[image.sha256] = APIC(encoding=3, mime=image.mime,
+                                          type=3, desc='Cover',
+                                          data=image.data)
+
+    return _coverFrames[image.sha256]
+
+
+def id3Padding(config):
+    """Return a mutagen padding function using `id3Padding` from the config.
+
+    Existing padding is reused whenever the new tag fits, so re-tags are
+    written in place. Otherwise the configured amount is reserved.
+    """
+    size = int(config.get('id3Padding', DEFAULT_ID3_PADDING))
+
+    def padding(info):
+        if info.padding >= 0:
+            return info.padding
+        return size
+
+    return padding
+
+
+def mp3Length(mp3File):
+    """Return the length of an MP3 in seconds.
+
+    The length is read from the file's headers (see `probe`). Files the
+    probe doesn't recognize are parsed by mutagen.
+    """
+    info = probe.probeFile(mp3File)
+
+    if info is not None:
+        return info.length
 
-def calcDuration(filename):
-    """Calculate the duration of the track in hours, mins, and secs."""
     try:
-        mp3 = MP3(filename)
-        hours, rem = divmod(mp3.info.length, 3600)
-        mins, secs = divmod(rem, 60)
-    except:
-        raise
+        return MP3(mp3File).info.length
+    except MutagenError as e:
+        raise errors.AudioError("Can't read the length of \'" + mp3File +
+                                "\' (" + str(e) + ").")
+
+
+def splitDuration(length):
+    """Split a length in seconds into a tuple of hours, mins, and secs."""
+    hours, rem = divmod(length, 3600)
+    mins, secs = divmod(rem, 60)
 
     # Return duration as a tuple
     return (hours, mins, secs)
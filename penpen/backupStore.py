@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""Deduplicated, compressed backups of the RSS feed.
+
+Each backup (a snapshot) splits the feed into blocks: the channel header and
+one block per item. Blocks are stored gzip compressed under
+`rssBackupDir/objects`, named after the SHA-256 of their contents, so an item
+that appears in many snapshots is only stored once. A snapshot is a small
+JSON manifest under `rssBackupDir/snapshots` listing its blocks in order.
+
+Old snapshots are pruned according to the retention settings in the config:
+
+    backupKeepLast   Number of most recent snapshots to keep.
+    backupKeepDaily  Number of days for which the last snapshot is kept.
+    backupKeepWeekly Number of weeks for which the last snapshot is kept.
+
+If none of them are set, every snapshot is kept.
+"""
+
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+
+from . import errors
+from . import fileUtils
+
+logger = logging.getLogger(__name__)
+
+OBJECTS_DIR = "objects"
+SNAPSHOTS_DIR = "snapshots"
+
+# Size of the reads used when splitting the feed into blocks
+READ_CHUNK_SIZE = 65536
+
+# Blocks start at the beginning of the line holding an item's start tag
+BLOCK_START_RE = re.compile(br'\n[ \t]*<item[\s>/]')
+
+TIME_FORMAT = "%Y%m%d-%H%M%S-%f"
+
+RETENTION_KEYS = ('backupKeepLast', 'backupKeepDaily', 'backupKeepWeekly')
+
+
+def createSnapshot(backupDir, xmlFilepath):
+    """Store a snapshot of the feed and return its name."""
+    created = datetime.datetime.utcnow()
+    base = os.path.splitext(os.path.basename(xmlFilepath))[0]
+    name = "%s_%s" % (base, created.strftime(TIME_FORMAT))
+
+    # Two snapshots can't share a name, even if they land in the same tick
+    suffix = 1
+    while os.path.exists(manifestFilepath(backupDir, name)):
+        name = "%s_%s-%d" % (base, created.strftime(TIME_FORMAT), suffix)
+        suffix += 1
+
+    blocks = []
+    totalHash = hashlib.sha256()
+    size = 0
+
+    for block in splitBlocks(xmlFilepath):
+        blocks.append(storeObject(backupDir, block))
+        totalHash.update(block)
+        size += len(block)
+
+    manifest = {'name': name,
+                'feed': os.path.basename(xmlFilepath),
+                'created': created.strftime(TIME_FORMAT),
+                'size': size,
+                'sha256': totalHash.hexdigest(),
+                'blocks': blocks}
+
+    snapshotsDir = os.path.join(backupDir, SNAPSHOTS_DIR)
+    makeDirs(snapshotsDir)
+    fileUtils.writeAtomic(manifestFilepath(backupDir, name),
+                          lambda f: f.write(json.dumps(manifest).encode()))
+
+    return name
+
+
+def splitBlocks(xmlFilepath):
+    """Yield the feed as blocks: the header, then one block per item.
+
+    Only the block being split off is held in memory. The last block also
+    holds the closing tags.
+    """
+    buf = b''
+
+    with open(xmlFilepath, 'rb') as f:
+        while True:
+            chunk = f.read(READ_CHUNK_SIZE)
+
+            if not chunk:
+                break
+
+            buf += chunk
+
+            # Split at every item start found so far, keeping the newline
+            # with the block before it
+            while True:
+                match = BLOCK_START_RE.search(buf, 1)
+
+                if not match:
+                    break
+
+                yield buf[:match.start() + 1]
+                buf = buf[match.start() + 1:]
+
+    if buf:
+        yield buf
+
+
+def storeObject(backupDir, data):
+    """Store a compressed block unless it is already stored. Return its key."""
+    key = hashlib.sha256(data).hexdigest()
+    filepath = objectFilepath(backupDir, key)
+
+    # Blocks aren't synced one by one. The manifest that refers to them is,
+    # and a restore checks the hash of the whole feed.
+    if not os.path.exists(filepath):
+        makeDirs(os.path.dirname(filepath))
+        fileUtils.writeAtomic(filepath,
+                              lambda f: f.write(gzip.compress(data, mtime=0)),
+                              sync=False)
+
+    return key
+
+
+def readObject(backupDir, key):
+    """Return the contents of a stored block."""
+    with open(objectFilepath(backupDir, key), 'rb') as f:
+        return gzip.decompress(f.read())
+
+
+def listSnapshots(backupDir):
+    """Return the manifests of all snapshots, oldest first."""
+    snapshotsDir = os.path.join(backupDir, SNAPSHOTS_DIR)
+
+    if not os.path.isdir(snapshotsDir):
+        return []
+
+    manifests = []
+
+    for filename in os.listdir(snapshotsDir):
+        if filename.endswith(".json"):
+            with open(os.path.join(snapshotsDir, filename)) as f:
+                manifests.append(json.load(f))
+
+    return sorted(manifests, key=lambda m: (m['created'], m['name']))
+
+
+def restoreSnapshot(backupDir, name, outputFilepath):
+    """Rebuild the feed of snapshot `name` into `outputFilepath`."""
+    fileUtils.writeAtomic(outputFilepath, snapshotWriter(backupDir, name))
+
+
+def snapshotWriter(backupDir, name):
+    """Return a `writeContents(f)` writing the feed of snapshot `name`.
+
+    The contents are checked against the snapshot's hash as they are
+    written, and an error is raised at the end if they don't match.
+    """
+    filepath = manifestFilepath(backupDir, name)
+
+    if not os.path.isfile(filepath):
+        raise errors.FeedError("Snapshot \'" + name + "\' does not exist.")
+
+    with open(filepath) as f:
+        manifest = json.load(f)
+
+    def writeContents(f):
+        totalHash = hashlib.sha256()
+
+        for key in manifest['blocks']:
+            block = readObject(backupDir, key)
+            totalHash.update(block)
+            f.write(block)
+
+        # Never swap in a corrupt restore
+        if totalHash.hexdigest() != manifest['sha256']:
+            raise IOError("Snapshot \'" + name + "\' is corrupt.")
+
+    return writeContents
+
+
+def applyRetention(config, backupDir):
+    """Delete snapshots outside the retention policy and unused blocks."""
+    if not any(config.get(key) for key in RETENTION_KEYS):
+        return
+
+    keepLast, keepDaily, keepWeekly = [int(config.get(key) or 0)
+                                       for key in RETENTION_KEYS]
+
+    manifests = listSnapshots(backupDir)
+    newestFirst = list(reversed(manifests))
+    keep = set(m['name'] for m in newestFirst[:keepLast])
+
+    # Keep the newest snapshot of each of the most recent days and weeks
+    for count, period in ((keepDaily, lambda t: t.date()),
+                          (keepWeekly, lambda t: t.isocalendar()[:2])):
+        periods = set()
+
+        for manifest in newestFirst:
+            if len(periods) >= count:
+                break
+
+            key = period(datetime.datetime.strptime(manifest['created'],
+                                                    TIME_FORMAT))
+
+            if key not in periods:
+                periods.add(key)
+                keep.add(manifest['name'])
+
+    pruned = [m for m in manifests if m['name'] not in keep]
+
+    for manifest in pruned:
+        os.remove(manifestFilepath(backupDir, manifest['name']))
+
+    if pruned:
+        logger.info("Pruned %d backup snapshot(s)." % len(pruned))
+        collectGarbage(backupDir)
+
+
+def collectGarbage(backupDir):
+    """Delete stored blocks that no snapshot refers to."""
+    used = set()
+
+    for manifest in listSnapshots(backupDir):
+        used.update(manifest['blocks'])
+
+    objectsDir = os.path.join(backupDir, OBJECTS_DIR)
+
+    for dirpath, _, filenames in os.walk(objectsDir):
+        for filename in filenames:
+            key = filename.split('.', 1)[0]
+
+            if key not in used:
+                os.remove(os.path.join(dirpath, filename))
+
+
+def manifestFilepath(backupDir, name):
+    """Return the location of a snapshot's manifest."""
+    return os.path.join(backupDir, SNAPSHOTS_DIR, name + ".json")
+
+
+def objectFilepath(backupDir, key):
+    """Return the location of a stored block."""
+    return os.path.join(backupDir, OBJECTS_DIR, key[:2], key + ".gz")
+
+
+def makeDirs(directory):
+    """Create a directory (and its parents) if it doesn't already exist."""
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""Remember how each MP3 was built so that unchanged work can be skipped.
+
+A small JSON file in a hidden folder next to the MP3
+(`.penpen-build/[mp3].build`, which the server never serves and uploads
+should leave out) records the SHA-256 of the source it was transcoded from,
+the LAME arguments, the loudness normalization settings along with the
+loudness measured (see `loudness.analyze`), a key of the tag inputs (see
+`audio.tagKey`), the duration, and the size and modification time the MP3
+had when it was written. When PenPen runs on the same source again:
+
+- If the source, the LAME arguments, the normalization settings and the tag
+  inputs all match and the MP3 wasn't touched since, the MP3 is reused as
+  is.
+- If only the tag inputs changed, the MP3 is re-tagged without transcoding.
+- Otherwise it is rebuilt.
+
+Like git's index, the source is only hashed again when its size or
+modification time differ from the ones recorded with the hash.
+
+Set `buildCache` to "no" in the config to always rebuild.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+from . import fileUtils
+
+logger = logging.getLogger(__name__)
+
+# Folder of the cache entries, next to the MP3s
+CACHE_DIR = ".penpen-build"
+
+# Appended to the MP3 filename to get its cache entry
+CACHE_SUFFIX = ".build"
+
+# Bumped whenever the entry format changes, which invalidates old entries
+CACHE_VERSION = 1
+
+# Size of the reads used when hashing a source
+HASH_CHUNK_SIZE = 1048576
+
+
+def enabled(config):
+    """Check whether the build cache is enabled in the config."""
+    return config.get('buildCache', "yes") != "no"
+
+
+def cacheFilepath(mp3File):
+    """Return the location of the cache entry of an MP3."""
+    directory, name = os.path.split(mp3File)
+    return os.path.join(directory, CACHE_DIR, name + CACHE_SUFFIX)
+
+
+def legacyFilepath(mp3File):
+    """Return where older versions kept the cache entry: next to the MP3."""
+    return mp3File + CACHE_SUFFIX
+
+
+def loadEntry(mp3File):
+    """Return the cache entry of an MP3, or None if there isn't a valid one.
+
+    An entry kept next to the MP3 by an older version is still read. It is
+    moved the next time the entry is written.
+    """
+    entry = readEntry(cacheFilepath(mp3File))
+
+    if entry is None:
+        entry = readEntry(legacyFilepath(mp3File))
+
+    if not isinstance(entry, dict) or entry.get('version') != CACHE_VERSION:
+        return None
+
+    return entry
+
+
+def readEntry(filepath):
+    """Return the JSON of a cache entry, or None if it can't be read."""
+    try:
+        with open(filepath) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def saveEntry(mp3File, source, lameArgs, tagKey, length, loudness=None):
+    """Record how the MP3 was just built.
+
+    `source` is a (filename, sha256) tuple for a transcoded MP3, or None if
+    the MP3 is its own source. A missing sha256 is computed here.
+    `loudness` holds the normalization settings and measurements, if the
+    source was normalized.
+    """
+    sourceInfo = None
+
+    if source is not None:
+        filename, sha256 = source
+        sourceInfo = dict(fileStat(filename),
+                          sha256=sha256 or fileHash(filename))
+
+    entry = {'version': CACHE_VERSION,
+             'source': sourceInfo,
+             'lameArgs': lameArgs,
+             'loudness': loudness,
+             'tagKey': tagKey,
+             'length': length,
+             'output': fileStat(mp3File)}
+
+    writeEntry(mp3File, entry)
+
+
+def writeEntry(mp3File, entry):
+    """Write the cache entry of an MP3."""
+    filepath = cacheFilepath(mp3File)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+    # Losing an entry only costs a rebuild
+    fileUtils.writeAtomic(filepath,
+                          lambda f: f.write(json.dumps(entry).encode()),
+                          sync=False)
+
+    # Move an entry left among the episodes by an older version
+    if os.path.exists(legacyFilepath(mp3File)):
+        os.remove(legacyFilepath(mp3File))
+
+
+def sourceMatches(entry, mp3File, filename, lameArgs, loudness=None):
+    """Check that the MP3 of `entry` was transcoded from `filename` as is.
+
+    `loudness` holds the normalization settings now in effect, if any.
+    """
+    source = entry.get('source')
+
+    if not source or entry.get('lameArgs') != lameArgs:
+        return False
+
+    # Normalized to the same target (whatever was measured). If it couldn't
+    # be measured last time (e.g. without NumPy), it's tried again.
+    recorded = entry.get('loudness')
+
+    if (recorded is None) != (loudness is None):
+        return False
+
+    if loudness is not None and (recorded.get('gain') is None or
+                                 any(recorded.get(key) != value
+                                     for key, value in loudness.items())):
+        return False
+
+    if fileStat(filename) != dict((key, source.get(key))
+                                  for key in ('size', 'mtimeNs')):
+        # Touched or copied: only a change of contents counts
+        if fileHash(filename) != source.get('sha256'):
+            return False
+
+        # Don't hash it again next time
+        source.update(fileStat(filename))
+        writeEntry(mp3File, entry)
+
+    return True
+
+
+def outputMatches(entry, mp3File):
+    """Check that the MP3 hasn't changed since its entry was written."""
+    return os.path.isfile(mp3File) and entry.get('output') == fileStat(mp3File)
+
+
+def fileHash(filename):
+    """Return the SHA-256 (hex) of a file's contents."""
+    digest = hashlib.sha256()
+
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+
+            if not chunk:
+                break
+
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def fileStat(filename):
+    """Return the size and modification time recorded for a file."""
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtimeNs': stat.st_mtime_ns}
@@ -4,31 +4,48 @@
 import argparse
 import logging
 import os
+import sys
 
-from . import audio
-from . import rss
+# Only light modules are imported up front. The rest (mutagen, asyncio, the
+# process pool, ...) are imported by the commands that need them, so that
+# feed-only commands start quickly.
+from . import errors
+from . import metrics
 
-# Configure logger globally
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
-def parseArgs():
+def parseArgs(argv=None):
     """Parse the command line arguments."""
     # Define the parser
     parser = argparse.ArgumentParser(description='Transcode, tag, and upload \
-                                     podcast episodes.')
+                                     podcast episodes.',
+                                     epilog='Any command also takes \
+                                     --metrics (print the time and resources \
+                                     used by each stage), --metrics-json FILE \
+                                     (write them as JSON lines, "-" for \
+                                     stdout) and --profile FILE (write a \
+                                     cProfile dump).')
     parser.add_argument('-c', '--config', required=True,
                         help='Configuration file with the feed parameters.')
     parser.add_argument('-t', '--title', type=str, required=False,
                         help='Title of the episode.')
     parser.add_argument('-d', '--description', type=str, required=False,
                         help='Description of the episode.')
-    parser.add_argument('audioFile', help='WAV or MP3 file to be added to the \
-                        feed. WAV files will be transcoded to 128 Kbps MP3s.')
+    parser.add_argument('-m', '--manifest', required=False,
+                        help='CSV file listing "file,title,description" \
+                        rows to add to the feed in a single batch.')
+    parser.add_argument('audioFiles', nargs='*', help='WAV or MP3 files to be \
+                        added to the feed. WAV files will be transcoded to \
+                        128 Kbps MP3s.')
 
     # Returns a namespace containing the parsed arguments
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+
+    if not args.audioFiles and not args.manifest:
+        parser.error("an audio file or a manifest must be supplied.")
+
+    return args
 
 
 def validateTextField(fieldName, field):
@@ -40,8 +57,8 @@ def validateTextField(fieldName, field):
 
         # Check that something was entered, enforcing a non-empty title
         if not field:
-            logging.fatal("\'" + fieldName + "\' must be supplied.")
-            exit(1)
+            raise errors.ConfigError("\'" + fieldName + "\' must be " +
+                                     "supplied.")
 
     return field
 
@@ -50,8 +67,7 @@ def parseConfigFile(configFile):
     """Parse the configuration file."""
     # Read in the config file
     if not os.path.isfile(configFile):
-        logger.fatal("\'" + configFile + "\' does not exist.")
-        exit(1)
+        raise errors.ConfigError("\'" + configFile + "\' does not exist.")
 
     with open(configFile) as f:
         contents = f.readlines()
@@ -87,19 +103,528 @@ def parseConfigFile(configFile):
     return config
 
 
+def parseManifest(manifestFile):
+    """Parse a batch manifest into (filename, title, desc) tuples.
+
+    Each row is "file,title,description" in CSV form so that titles and
+    descriptions may contain quoted commas. Blank rows and rows starting with
+    "#" are skipped. Relative paths are resolved against the manifest's
+    directory. Rows are expected oldest episode first.
+    """
+    import csv
+
+    if not os.path.isfile(manifestFile):
+        raise errors.ConfigError("\'" + manifestFile + "\' does not exist.")
+
+    manifestDir = os.path.dirname(os.path.abspath(manifestFile))
+    episodes = []
+
+    with open(manifestFile) as f:
+        for row in csv.reader(f):
+            # Skip blank lines and comments
+            if not row or not row[0].strip() or row[0].startswith("#"):
+                continue
+
+            if len(row) < 3:
+                raise errors.ConfigError("Manifest rows must have a file, " +
+                                         "title, and description: " +
+                                         ",".join(row))
+
+            filename = os.path.join(manifestDir, row[0].strip())
+            episodes.append((filename, row[1].strip(), row[2].strip()))
+
+    return episodes
+
+
+def collectEpisodes(args):
+    """Build the list of (filename, title, desc) tuples to be published."""
+    episodes = []
+
+    if args.manifest:
+        episodes.extend(parseManifest(args.manifest))
+
+    # A single file keeps the original behavior of taking the title and
+    # description from the command line. Every file of a batch is prompted.
+    for audioFile in args.audioFiles:
+        if len(args.audioFiles) == 1 and not args.manifest:
+            title, desc = args.title, args.description
+        else:
+            logger.info("Episode details for \'" + audioFile + "\'")
+            title, desc = None, None
+
+        title = validateTextField('Title', title)
+        desc = validateTextField('Description', desc)
+        episodes.append((audioFile, title, desc))
+
+    return episodes
+
+
+def processEpisode(episode, config):
+    """Transcode and tag a single (filename, title, desc) episode.
+
+    Return a (title, desc, mp3File, duration) tuple for the RSS feed.
+    """
+    from . import audio
+
+    filename, title, desc = episode
+    mp3File, duration = audio.process(filename, config, title, desc)
+
+    return title, desc, mp3File, duration
+
+
+@metrics.stage('core.processEpisodes')
+def processEpisodes(episodes, config):
+    """Transcode and tag the episodes using one worker per core.
+
+    Results are returned in the same order as `episodes`.
+    """
+    if len(episodes) == 1:
+        return [processEpisode(episodes[0], config)]
+
+    import concurrent.futures
+    import multiprocessing
+
+    from . import audio
+
+    audio.prepareCoverArt(config)
+
+    workers = min(len(episodes), multiprocessing.cpu_count())
+    logger.info("Processing %d episodes with %d workers..." %
+                (len(episodes), workers))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        # Bring back what the workers measured
+        if metrics.isEnabled():
+            futures = [pool.submit(metrics.collect, processEpisode, episode,
+                                   config)
+                       for episode in episodes]
+            results = []
+
+            for future in futures:
+                result, records = future.result()
+                metrics.merge(records)
+                results.append(result)
+
+            return results
+
+        futures = [pool.submit(processEpisode, episode, config)
+                   for episode in episodes]
+
+        return [future.result() for future in futures]
+
+
+def renditionFeeds(config):
+    """Return the configs of the renditions that have a feed of their own."""
+    from . import audio
+
+    return [rendition for rendition in audio.renditions(config)
+            if rendition['xmlFilepath']]
+
+
+def renditionFile(rendition, filename):
+    """Return the MP3 of a rendition of `filename`, or None if it has none.
+
+    Only WAVs have renditions.
+    """
+    from . import audio
+    from . import fileUtils
+
+    if not fileUtils.extValid(filename, '.WAV'):
+        return None
+
+    return audio.mp3Filename(filename, rendition['mp3Suffix'])
+
+
+def renditionEpisodes(rendition, episodes, processed):
+    """Return the episodes to add to the feed of a rendition.
+
+    `episodes` are the (filename, title, desc) tuples that were processed
+    into the (title, desc, mp3File, duration) tuples of `processed`.
+    """
+    return [(title, desc, renditionFile(rendition, filename), duration)
+            for (filename, _, _), (title, desc, _, duration)
+            in zip(episodes, processed)
+            if renditionFile(rendition, filename)]
+
+
+def renditionGuids(rendition, guids):
+    """Return the guids the episodes `guids` have in a rendition's feed."""
+    from . import audio
+    from . import rss
+
+    # The guid is the public link to the MP3 (see `rss.episodeGuid`)
+    return [rss.episodeGuid(rendition,
+                            audio.mp3Filename(guid.rsplit('/', 1)[-1],
+                                              rendition['mp3Suffix']))
+            for guid in guids]
+
+
+def checkDuplicates(config, feeds, filenames, index=None):
+    """Raise DuplicateEpisodeError if an episode was already published.
+
+    `filenames` are the audio files to publish. The feeds of the renditions
+    (`feeds`, see `renditionFeeds`) are checked too. The `index` of the main
+    feed can be passed in by long running callers.
+    """
+    from . import audio
+    from . import episodeIndex
+    from . import rss
+
+    with episodeIndex.usingIndex(config, index) as index:
+        rss.checkDuplicates(index,
+                            [rss.episodeGuid(config,
+                                             audio.mp3Filename(filename))
+                             for filename in filenames])
+
+    for rendition in feeds:
+        mp3Files = [renditionFile(rendition, filename)
+                    for filename in filenames]
+
+        with episodeIndex.usingIndex(rendition) as renditionIndex:
+            rss.checkDuplicates(renditionIndex,
+                                [rss.episodeGuid(rendition, mp3File)
+                                 for mp3File in mp3Files if mp3File])
+
+
+def addToFeeds(config, feeds, episodes, processed, index=None):
+    """Add processed episodes to the feed, and their renditions to `feeds`.
+
+    `feeds` are the configs of the renditions with a feed (see
+    `renditionFeeds`). Each feed is rewritten once. The `index` of the main
+    feed can be passed in by long running callers.
+    """
+    from . import episodeIndex
+    from . import rss
+
+    rss.addEpisodes(config, processed, index)
+
+    for rendition in feeds:
+        rendered = renditionEpisodes(rendition, episodes, processed)
+
+        if rendered:
+            with episodeIndex.usingIndex(rendition) as renditionIndex:
+                rss.addEpisodes(rendition, rendered, renditionIndex)
+
+
+def listEpisodes(argv):
+    """List the episodes in the feed using the episode index."""
+    from . import episodeIndex
+
+    parser = argparse.ArgumentParser(prog='penpen list',
+                                     description='List the episodes in the \
+                                     feed, newest first.')
+    parser.add_argument('-c', '--config', required=True,
+                        help='Configuration file with the feed parameters.')
+    args = parser.parse_args(argv)
+
+    config = parseConfigFile(args.config)
+    index = episodeIndex.openIndex(config)
+
+    for guid, title, pubDate, _, length, duration, _, _ in \
+            episodeIndex.listEpisodes(index):
+        print("%s  %8s  %12s  %s  (%s)" % (pubDate, duration, length, title,
+                                           guid))
+
+    index.close()
+
+
+def manageBackups(argv):
+    """List the feed backups or restore one of them."""
+    from . import backupStore
+    from . import feedLock
+    from . import rss
+
+    configParser = argparse.ArgumentParser(add_help=False)
+    configParser.add_argument('-c', '--config', required=True,
+                              help='Configuration file with the feed \
+                              parameters.')
+
+    parser = argparse.ArgumentParser(prog='penpen backups',
+                                     description='List or restore backups \
+                                     of the feed.')
+    actions = parser.add_subparsers(dest='action')
+    actions.required = True
+    actions.add_parser('list', parents=[configParser],
+                       help='List the backup snapshots, oldest first.')
+    restoreParser = actions.add_parser('restore', parents=[configParser],
+                                       help='Restore a backup snapshot.')
+    restoreParser.add_argument('-o', '--output', required=False,
+                               help='Where to write the restored feed. \
+                               Defaults to the feed itself (after backing \
+                               it up).')
+    restoreParser.add_argument('snapshot',
+                               help='Name of the snapshot to restore.')
+    args = parser.parse_args(argv)
+
+    config = parseConfigFile(args.config)
+    backupDir = config['rssBackupDir']
+
+    if args.action == 'list':
+        for manifest in backupStore.listSnapshots(backupDir):
+            print("%s  %10d bytes  %5d blocks" % (manifest['name'],
+                                                  manifest['size'],
+                                                  len(manifest['blocks'])))
+        return
+
+    output = args.output or config['xmlFilepath']
+
+    # Publishers update the feed and prune the backups holding the lock too
+    with feedLock.locked(config):
+        # Restoring over the feed can be undone with the snapshot made here.
+        # Old snapshots are only pruned after the restore, so the one being
+        # restored can't be pruned first.
+        if os.path.isfile(output) and not args.output:
+            name = backupStore.createSnapshot(backupDir, output)
+            logger.info("Creating backup XML => " + name)
+
+        # The compressed copies and the sidecar of the feed are updated too
+        if args.output:
+            backupStore.restoreSnapshot(backupDir, args.snapshot, output)
+        else:
+            rss.replaceFeed(config, backupStore.snapshotWriter(
+                backupDir, args.snapshot))
+
+        logger.info("Restored \'" + args.snapshot + "\' => " + output)
+
+        backupStore.applyRetention(config, backupDir)
+
+
+def watchFolder(argv):
+    """Publish the recordings dropped into a folder as they arrive."""
+    from . import watch
+
+    parser = argparse.ArgumentParser(prog='penpen watch',
+                                     description='Watch a folder and publish \
+                                     new WAV and MP3 files as they arrive.')
+    parser.add_argument('-c', '--config', required=True,
+                        help='Configuration file with the feed parameters.')
+    parser.add_argument('--settle', type=float, default=5.0,
+                        help='Seconds a file must stay unchanged before it \
+                        is picked up when polling (default: 5).')
+    parser.add_argument('--window', type=float, default=10.0,
+                        help='Episodes finishing within this many seconds \
+                        of each other are published together (default: 10).')
+    parser.add_argument('--poll', action='store_true',
+                        help='Poll the folder instead of using inotify.')
+    parser.add_argument('directory', help='Folder to watch.')
+    args = parser.parse_args(argv)
+
+    config = parseConfigFile(args.config)
+    watch.watch(config, args.directory, args.settle, args.window, args.poll)
+
+
+def serveFeed(argv):
+    """Serve the feed and the episodes over HTTP."""
+    from . import server
+
+    parser = argparse.ArgumentParser(prog='penpen serve',
+                                     description='Serve the feed and the \
+                                     episodes locally for testing.')
+    parser.add_argument('-c', '--config', required=True,
+                        help='Configuration file with the feed parameters.')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on (default: 127.0.0.1).')
+    parser.add_argument('-p', '--port', type=int, default=8000,
+                        help='Port to listen on (default: 8000).')
+    parser.add_argument('--episodes',
+                        help='Local folder holding the episodes (default: \
+                        the folder of the feed).')
+    args = parser.parse_args(argv)
+
+    config = parseConfigFile(args.config)
+    episodeDir = args.episodes or \
+        os.path.dirname(os.path.abspath(config['xmlFilepath']))
+    server.serve(config, args.host, args.port, episodeDir)
+
+
+def validateFeed(argv):
+    """Check the feed without changing anything. Raise FeedError on
+    problems, after logging them."""
+    from . import validate
+
+    parser = argparse.ArgumentParser(prog='penpen validate',
+                                     description='Check that the feed, its \
+                                     archive pages and its sidecar are \
+                                     complete and consistent.')
+    parser.add_argument('-c', '--config', required=True,
+                        help='Configuration file with the feed parameters.')
+    args = parser.parse_args(argv)
+
+    config = parseConfigFile(args.config)
+    problems, count = validate.validateFeed(config)
+
+    for problem in problems:
+        logger.error(problem)
+
+    if problems:
+        raise errors.FeedError("\'" + config['xmlFilepath'] + "\' has " +
+                               "%d problems." % len(problems))
+
+    logger.info("\'" + config['xmlFilepath'] + "\' is valid (%d episodes)." %
+                count)
+
+
+def rebuildFeedFiles(argv):
+    """Rebuild the files derived from the feed: the index and variants."""
+    from . import episodeIndex
+    from . import feedLock
+    from . import rss
+
+    parser = argparse.ArgumentParser(prog='penpen rebuild',
+                                     description='Rebuild the episode index, \
+                                     the compressed copies and the sidecar \
+                                     from the feed (e.g. after editing it by \
+                                     hand).')
+    parser.add_argument('-c', '--config', required=True,
+                        help='Configuration file with the feed parameters.')
+    args = parser.parse_args(argv)
+
+    config = parseConfigFile(args.config)
+
+    if not os.path.isfile(config['xmlFilepath']):
+        raise errors.FeedError("\'" + config['xmlFilepath'] + "\' does " +
+                               "not exist.")
+
+    with feedLock.locked(config):
+        # Start the index over rather than trusting the stored feed stat
+        if os.path.exists(episodeIndex.indexFilepath(config)):
+            os.remove(episodeIndex.indexFilepath(config))
+
+        episodeIndex.openIndex(config).close()
+        rss.writeFeedVariants(config)
+
+
+def retagEpisodes(argv):
+    """Update the ID3 tags of the published MP3s after a config change."""
+    from . import retag
+
+    parser = argparse.ArgumentParser(prog='penpen retag',
+                                     description='Update the ID3 tags of the \
+                                     episodes in the feed to match the \
+                                     configuration (e.g. after changing \
+                                     rssTitle or episodeAuthor).')
+    parser.add_argument('-c', '--config', required=True,
+                        help='Configuration file with the feed parameters.')
+    parser.add_argument('--episodes',
+                        help='Local folder holding the episodes (default: \
+                        the folder of the feed).')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='Worker processes (default: one per core).')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='Only list the MP3s whose tags are stale.')
+    args = parser.parse_args(argv)
+
+    config = parseConfigFile(args.config)
+    episodeDir = args.episodes or \
+        os.path.dirname(os.path.abspath(config['xmlFilepath']))
+    results = retag.retag(config, episodeDir, args.jobs, args.dry_run)
+    counts = {}
+
+    for mp3File, outcome, frameIds in results:
+        counts[outcome] = counts.get(outcome, 0) + 1
+
+        if outcome == retag.MISSING:
+            logger.warning("\'" + mp3File + "\' does not exist. Skipping...")
+        elif outcome == retag.STALE:
+            logger.info("\'" + mp3File + "\': " + ", ".join(frameIds) +
+                        " would change.")
+        elif outcome == retag.REWRITTEN:
+            logger.info("\'" + mp3File + "\' was rewritten: the new " +
+                        "tag didn't fit in the old one's padding.")
+
+    logger.info("%d MP3s: " % len(results) +
+                ", ".join("%d %s" % (count, outcome)
+                          for outcome, count in sorted(counts.items())) +
+                ".")
+
+
+# Subcommands, selected by the first argument. Anything else publishes.
+COMMANDS = {'list': listEpisodes,
+            'backups': manageBackups,
+            'watch': watchFolder,
+            'serve': serveFeed,
+            'validate': validateFeed,
+            'rebuild': rebuildFeedFiles,
+            'retag': retagEpisodes}
+
+
 def main():
     """Main function."""
+    # Configure logger globally
+    logging.basicConfig(level=logging.DEBUG)
+
+    options, argv = parseGlobalArgs(sys.argv[1:])
+    command = argv[0] if argv and argv[0] in COMMANDS else 'publish'
+
+    if options.metrics or options.metrics_json:
+        metrics.enable()
+
+    profiler = None
+
+    if options.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+
+    try:
+        if profiler:
+            profiler.enable()
+
+        with metrics.stage(command):
+            if command in COMMANDS:
+                COMMANDS[command](argv[1:])
+            else:
+                publish(argv)
+    except errors.PenPenError as e:
+        logger.fatal(str(e))
+        exit(1)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(options.profile)
+            logger.info("Saved profile => " + options.profile)
+
+        reportMetrics(options)
+
+
+def parseGlobalArgs(argv):
+    """Split off the options that apply to every command."""
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument('--metrics', action='store_true')
+    parser.add_argument('--metrics-json')
+    parser.add_argument('--profile')
+
+    return parser.parse_known_args(argv)
+
+
+def reportMetrics(options):
+    """Print the stage metrics or write them as JSON lines."""
+    if options.metrics:
+        sys.stderr.write(metrics.formatTable() + "\n")
+
+    if options.metrics_json == '-':
+        metrics.writeJsonLines(sys.stdout)
+    elif options.metrics_json:
+        with open(options.metrics_json, 'w') as f:
+            metrics.writeJsonLines(f)
+
+
+def publish(argv):
+    """Transcode, tag, and add episodes to the feed."""
     # Parse arguments and load parameters
-    args = parseArgs()
+    args = parseArgs(argv)
     config = parseConfigFile(args.config)
-    title = validateTextField('Title', args.title)
-    desc = validateTextField('Description', args.description)
+    episodes = collectEpisodes(args)
+    feeds = renditionFeeds(config)
+
+    # Fail before any transcoding if an episode was already published
+    checkDuplicates(config, feeds,
+                    [filename for filename, _, _ in episodes])
 
     # Transcode and tag the audio
-    mp3File, duration = audio.process(args.audioFile, config, title, desc)
+    processed = processEpisodes(episodes, config)
 
-    # Add to the RSS feed
-    rss.addEpisode(config, title, desc, mp3File, duration)
+    # Add everything to the RSS feed in one rewrite
+    addToFeeds(config, feeds, episodes, processed)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""Prepare the cover art embedded in the ID3 tag of each episode.
+
+The cover (`episodeImageFilepath`) is embedded in every MP3, so a 3000x3000
+PNG adds megabytes to each episode and to each download of it. If
+`coverArtSize` is set, the cover is downscaled to fit in that many pixels
+and recompressed as a JPEG (`coverArtQuality`) before being embedded.
+
+The result is cached next to the cover (`[cover].[hash]-[size]px-q[quality]
+.jpg`, where the hash is the cover's SHA-256), so a cover is only resized
+once whatever the number of episodes, runs or batch workers. A cover better
+embedded as is (a small enough JPEG, or no bigger than the result) is cached
+as an empty file, so that it isn't decoded again either. Within a process
+the prepared image is also kept in memory, keyed by the cover's size and
+modification time, so the cover is read once per run.
+
+Resizing needs Pillow (pip install penpen[cover]), which is only loaded when a
+cover has to be resized. Without it the cover is embedded as is.
+"""
+
+import collections
+import glob
+import hashlib
+import io
+import logging
+import os
+
+from . import errors
+from . import fileUtils
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# JPEG quality used unless `coverArtQuality` is set
+DEFAULT_QUALITY = 85
+
+# Color used under transparent parts of the cover (JPEG has no alpha)
+BACKGROUND = (255, 255, 255)
+
+# The image embedded for a cover and the SHA-256 (hex) of its data
+CoverImage = collections.namedtuple('CoverImage', 'mime data sha256')
+
+# (filepath, size, mtimeNs, settings) => CoverImage
+_images = {}
+
+
+def settings(config):
+    """Return the downscaling settings in `config`, or None if it's off.
+
+    Downscaling is on when `coverArtSize` (pixels) is set.
+    """
+    if not config.get('coverArtSize'):
+        return None
+
+    if int(config['coverArtSize']) <= 0:
+        raise errors.ConfigError("\'coverArtSize\' must be a number of " +
+                                 "pixels above 0.")
+
+    return {'size': int(config['coverArtSize']),
+            'quality': int(config.get('coverArtQuality') or
+                           DEFAULT_QUALITY)}
+
+
+def importImage():
+    """Return Pillow's Image module, or None if it isn't installed."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+
+    return Image
+
+
+def embeddedImage(config):
+    """Return the CoverImage to embed for the cover in `config`."""
+    filepath = config['episodeImageFilepath']
+
+    # Check that the file exists
+    if not os.path.isfile(filepath):
+        raise errors.ConfigError("\'" + filepath + "\' does not exist.")
+
+    # Determine the file type
+    if fileUtils.extValid(filepath.lower(), '.png'):
+        mime = 'image/png'
+    elif fileUtils.extValid(filepath.lower(), '.jpg'):
+        mime = 'image/jpeg'
+    else:
+        raise errors.ConfigError("Cover image must be a PNG or JPG.")
+
+    embed = settings(config)
+    stat = os.stat(filepath)
+    key = (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns,
+           embed and (embed['size'], embed['quality']))
+
+    if key in _images:
+        return _images[key]
+
+    with open(filepath, 'rb') as f:
+        data = f.read()
+
+    sha256 = hashlib.sha256(data).hexdigest()
+
+    if embed is not None:
+        resized = downscale(filepath, data, sha256, embed)
+
+        if resized is not None:
+            mime, data = 'image/jpeg', resized
+            sha256 = hashlib.sha256(data).hexdigest()
+
+    _images[key] = CoverImage(mime, data, sha256)
+
+    return _images[key]
+
+
+def cacheFilepath(filepath, sha256, embed):
+    """Return the location of the resized cover cached for `filepath`."""
+    return "%s.%s-%dpx-q%d.jpg" % (filepath, sha256[:16], embed['size'],
+                                   embed['quality'])
+
+
+@metrics.stage('audio.coverArt')
+def downscale(filepath, data, sha256, embed):
+    """Return the cover `data` resized and recompressed, as JPEG data.
+
+    `sha256` is the hash of `data`. Return None if the cover is better
+    embedded as is: Pillow is missing, it can't read the cover, or the cover
+    is already a JPEG small enough (or smaller than the result).
+    """
+    cachedFilepath = cacheFilepath(filepath, sha256, embed)
+
+    if os.path.isfile(cachedFilepath):
+        with open(cachedFilepath, 'rb') as f:
+            # Empty if the cover is embedded as is
+            return f.read() or None
+
+    Image = importImage()
+
+    if Image is None:
+        logger.warning("Pillow is not installed (pip install " +
+                       "penpen[cover]). Embedding the cover art as is.")
+        return None
+
+    output = io.BytesIO()
+
+    try:
+        with Image.open(filepath) as source:
+            if source.format == 'JPEG' and \
+                    max(source.size) <= embed['size']:
+                saveCached(filepath, sha256, cachedFilepath, b'')
+                return None
+
+            logger.info("Resizing the cover art to %dpx..." % embed['size'])
+
+            # JPEGs are decoded at the smallest scale still big enough
+            source.draft('RGB', (embed['size'], embed['size']))
+            image = flatten(Image, source)
+
+        image.thumbnail((embed['size'], embed['size']), Image.LANCZOS)
+        image.save(output, 'JPEG', quality=embed['quality'], optimize=True)
+    except (IOError, OSError, ValueError) as e:
+        logger.warning("Can't resize \'" + filepath + "\' (" + str(e) +
+                       "). Embedding the cover art as is.")
+        return None
+
+    resized = output.getvalue()
+
+    if len(resized) >= len(data):
+        saveCached(filepath, sha256, cachedFilepath, b'')
+        return None
+
+    saveCached(filepath, sha256, cachedFilepath, resized)
+
+    return resized
+
+
+def saveCached(filepath, sha256, cachedFilepath, resized):
+    """Cache the `resized` cover, or an empty file to embed it as is."""
+    try:
+        fileUtils.writeAtomic(cachedFilepath, lambda f: f.write(resized),
+                              sync=False)
+        removeStale(filepath, sha256)
+    except (IOError, OSError) as e:
+        # It's only resized again next time
+        logger.warning("Can't cache the resized cover art (" + str(e) + ").")
+
+
+def flatten(Image, image):
+    """Return `image` in RGB, over `BACKGROUND` where it's transparent."""
+    if image.mode == 'P' and 'transparency' in image.info:
+        image = image.convert('RGBA')
+
+    if image.mode in ('RGBA', 'LA'):
+        background = Image.new('RGB', image.size, BACKGROUND)
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+
+    return image.convert('RGB')
+
+
+def removeStale(filepath, sha256):
+    """Remove the covers cached for previous versions of `filepath`."""
+    current = "%s.%s-" % (filepath, sha256[:16])
+
+    for cached in glob.glob(glob.escape(filepath) + ".*px-q*.jpg"):
+        if not cached.startswith(current):
+            os.remove(cached)
@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+"""Keep an on-disk index of the episodes in the RSS feed.
+
+The index is a SQLite database stored next to the feed (`xmlFilepath` +
+".idx"). It records the guid, title, pubDate, enclosure length, duration and
+byte offset of every item so that the copyright year, duplicate detection and
+episode listing don't need a scan of the whole feed.
+
+Items frozen into archive pages (see `feedPageSize`) are recorded with the
+number of their page. Items in the feed itself are on page 0.
+
+The size and modification time of the feed are stored along with the
+episodes. If they don't match the feed on disk (e.g. the feed was edited by
+hand or the index went missing), the index is rebuilt from the XML.
+
+The SHA-256 of the bytes PenPen last wrote for each item of the feed is kept
+too (the `fragments` table). An item whose bytes still match is copied from
+the old feed as is when the whole feed is rewritten (see
+`rss.feedFragments`). Rebuilding the index from the XML leaves these alone.
+"""
+
+import contextlib
+import logging
+import os
+import re
+import sqlite3
+import xml.parsers.expat
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Appended to `xmlFilepath` to get the index location
+INDEX_SUFFIX = ".idx"
+
+# Size of the reads used when scanning the feed
+SCAN_CHUNK_SIZE = 65536
+
+# Archive page `n` of "feed.xml" is "feed-archive-n.xml"
+ARCHIVE_FORMAT = "%s-archive-%d%s"
+
+# Bumped whenever the schema changes, which triggers a rebuild
+SCHEMA_VERSION = "2"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS episodes (
+    guid TEXT PRIMARY KEY,
+    title TEXT,
+    pubDate TEXT,
+    year INTEGER,
+    length INTEGER,
+    duration TEXT,
+    offset INTEGER,
+    page INTEGER
+);
+CREATE INDEX IF NOT EXISTS episodesPage ON episodes (page, offset);
+CREATE TABLE IF NOT EXISTS fragments (
+    guid TEXT PRIMARY KEY,
+    sha256 TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Item child elements recorded in the index
+RECORDED_TAGS = ('guid', 'title', 'pubDate', 'itunes:duration')
+
+
+def indexFilepath(config):
+    """Return the location of the index for the feed in `config`."""
+    return config['xmlFilepath'] + INDEX_SUFFIX
+
+
+@metrics.stage('index.open')
+def openIndex(config):
+    """Open the index, rebuilding it if it is missing or out of date."""
+    xmlFilepath = config['xmlFilepath']
+    conn = sqlite3.connect(indexFilepath(config))
+    conn.executescript(SCHEMA)
+
+    # Start over if the index was made by an older version
+    if getMeta(conn, 'schemaVersion') != SCHEMA_VERSION:
+        with conn:
+            conn.execute("DROP TABLE episodes")
+            conn.execute("DELETE FROM meta")
+        conn.executescript(SCHEMA)
+
+        with conn:
+            setMeta(conn, 'schemaVersion', SCHEMA_VERSION)
+
+    refreshIndex(conn, xmlFilepath)
+
+    return conn
+
+
+@contextlib.contextmanager
+def usingIndex(config, index=None):
+    """Yield `index`, or an index opened for the duration if it is None.
+
+    Lets functions take the index of long running callers, who close it
+    themselves, without leaking the connections they open otherwise.
+    """
+    if index is not None:
+        yield index
+        return
+
+    conn = openIndex(config)
+
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def refreshIndex(conn, xmlFilepath):
+    """Rebuild the index if the feed changed since it was last recorded.
+
+    Long running callers keeping the index open call this before using it,
+    in case another process updated the feed in the meantime.
+    """
+    if getMeta(conn, 'feedStat') != feedStat(xmlFilepath):
+        logger.info("Rebuilding the episode index for \'" + xmlFilepath +
+                    "\'...")
+        rebuildIndex(conn, xmlFilepath)
+
+
+def rebuildIndex(conn, xmlFilepath):
+    """Replace the contents of the index with a scan of the feed.
+
+    The archive pages next to the feed are scanned too.
+    """
+    with conn:
+        conn.execute("DELETE FROM episodes")
+
+        page = 1
+        while os.path.isfile(archiveFilepath(xmlFilepath, page)):
+            insertRecords(conn, scanFeed(archiveFilepath(xmlFilepath, page),
+                                         page))
+            page += 1
+
+    records = scanFeed(xmlFilepath) if os.path.isfile(xmlFilepath) else []
+    replaceEpisodes(conn, xmlFilepath, records)
+
+
+def replaceEpisodes(conn, xmlFilepath, records, fragments=None):
+    """Replace the feed's items in the index after it was rewritten.
+
+    `fragments` maps the guids of the items serialized anew to the SHA-256
+    of their bytes. The hashes of items no longer in the feed are dropped.
+    """
+    with conn:
+        conn.execute("DELETE FROM episodes WHERE page = 0")
+        insertRecords(conn, records)
+        setMeta(conn, 'feedStat', feedStat(xmlFilepath))
+
+        if fragments is not None:
+            insertFragments(conn, fragments)
+            conn.execute("DELETE FROM fragments WHERE guid NOT IN "
+                         "(SELECT guid FROM episodes WHERE page = 0)")
+
+
+def addArchivePage(conn, records):
+    """Record the items of a newly written archive page.
+
+    The items are moved off page 0. The feed itself is rewritten afterwards,
+    which updates the remaining items.
+    """
+    with conn:
+        insertRecords(conn, records)
+
+
+def addEpisodes(conn, xmlFilepath, records, shift, shiftFrom,
+                fragments=None):
+    """Record newly spliced items after the feed has been written.
+
+    Items that were at or after `shiftFrom` before the write are moved
+    `shift` bytes down. The feed and the index are committed together from
+    the index's point of view: if this fails, the stored feed stat no longer
+    matches and the index is rebuilt on the next open. `fragments` maps the
+    guids of the new items to the SHA-256 of their bytes.
+    """
+    with conn:
+        conn.execute("UPDATE episodes SET offset = offset + ? "
+                     "WHERE page = 0 AND offset >= ?", (shift, shiftFrom))
+        insertRecords(conn, records)
+        setMeta(conn, 'feedStat', feedStat(xmlFilepath))
+
+        if fragments is not None:
+            insertFragments(conn, fragments)
+
+
+def firstYear(conn):
+    """Return the earliest publication year as a string, or None."""
+    year = conn.execute("SELECT MIN(year) FROM episodes").fetchone()[0]
+    return str(year) if year else None
+
+
+def hasEpisode(conn, guid):
+    """Check whether an episode with `guid` is already in the feed."""
+    return conn.execute("SELECT 1 FROM episodes WHERE guid = ?",
+                        (guid,)).fetchone() is not None
+
+
+def episodePage(conn, guid):
+    """Return the page an episode is on (0 for the feed), or None."""
+    row = conn.execute("SELECT page FROM episodes WHERE guid = ?",
+                       (guid,)).fetchone()
+    return row[0] if row else None
+
+
+def countEpisodes(conn, page=0):
+    """Return the number of episodes on a page (by default the feed)."""
+    return conn.execute("SELECT COUNT(*) FROM episodes WHERE page = ?",
+                        (page,)).fetchone()[0]
+
+
+def archivePageCount(conn):
+    """Return the number of archive pages."""
+    return conn.execute("SELECT MAX(page) FROM episodes").fetchone()[0] or 0
+
+
+def listEpisodes(conn):
+    """Return all of the episode records, newest first.
+
+    The feed's items come first, followed by the archive pages from the
+    newest to the oldest.
+    """
+    return conn.execute("SELECT guid, title, pubDate, year, length, "
+                        "duration, offset, page FROM episodes "
+                        "ORDER BY page = 0 DESC, page DESC, "
+                        "offset").fetchall()
+
+
+def feedOffsets(conn):
+    """Yield the offset of each of the feed's items (page 0), in order."""
+    for (offset,) in conn.execute("SELECT offset FROM episodes "
+                                  "WHERE page = 0 ORDER BY offset"):
+        yield offset
+
+
+def feedRecords(conn):
+    """Yield (record, SHA-256) for the feed's items (page 0) in file order.
+
+    The SHA-256 is the hash of the bytes last written for the item, or None
+    if it wasn't recorded.
+    """
+    for row in conn.execute("SELECT e.guid, e.title, e.pubDate, e.year, "
+                            "e.length, e.duration, e.offset, e.page, "
+                            "f.sha256 FROM episodes e LEFT JOIN fragments f "
+                            "ON f.guid = e.guid WHERE e.page = 0 "
+                            "ORDER BY e.offset"):
+        yield row[:8], row[8]
+
+
+def archiveFilepath(xmlFilepath, page):
+    """Return the location of archive page `page` of a feed."""
+    root, ext = os.path.splitext(xmlFilepath)
+    return ARCHIVE_FORMAT % (root, page, ext)
+
+
+def insertRecords(conn, records):
+    """Insert or replace episode records."""
+    conn.executemany("INSERT OR REPLACE INTO episodes VALUES "
+                     "(?, ?, ?, ?, ?, ?, ?, ?)", records)
+
+
+def insertFragments(conn, fragments):
+    """Record the SHA-256 of the bytes written for items, by guid."""
+    conn.executemany("INSERT OR REPLACE INTO fragments VALUES (?, ?)",
+                     fragments.items())
+
+
+def makeRecord(fields, length, offset, page=0):
+    """Build an index record from the text of an item's child elements."""
+    pubDate = fields.get('pubDate') or ''
+    years = re.findall(r" (\d{4}) ", pubDate)
+
+    return (fields.get('guid'),
+            fields.get('title'),
+            pubDate,
+            int(years[0]) if years else None,
+            int(length) if length else None,
+            fields.get('itunes:duration'),
+            offset,
+            page)
+
+
+def recordFromElement(item, offset, page=0):
+    """Build an index record from an ElementTree `item`."""
+    fields = dict((tag, item.findtext(tag)) for tag in RECORDED_TAGS)
+    enclosure = item.find('enclosure')
+    length = enclosure.get('length') if enclosure is not None else None
+
+    return makeRecord(fields, length, offset, page)
+
+
+def scanFeed(xmlFilepath, page=0):
+    """Yield an index record for every item in the feed.
+
+    The feed is read with a streaming expat parser so that the byte offset
+    of each `<item>` start tag is known and memory use stays flat.
+    """
+    parser = xml.parsers.expat.ParserCreate()
+    records = []
+    state = {'item': None, 'tag': None, 'length': None, 'offset': None}
+
+    def startElement(name, attrs):
+        if name == 'item':
+            state['item'] = {}
+            state['offset'] = parser.CurrentByteIndex
+            state['length'] = None
+        elif state['item'] is not None:
+            state['tag'] = name
+            if name == 'enclosure':
+                state['length'] = attrs.get('length')
+
+    def endElement(name):
+        if name == 'item':
+            records.append(makeRecord(state['item'], state['length'],
+                                      state['offset'], page))
+            state['item'] = None
+        state['tag'] = None
+
+    def characterData(data):
+        if state['item'] is not None and state['tag'] in RECORDED_TAGS:
+            item = state['item']
+            item[state['tag']] = item.get(state['tag'], '') + data
+
+    parser.StartElementHandler = startElement
+    parser.EndElementHandler = endElement
+    parser.CharacterDataHandler = characterData
+
+    with open(xmlFilepath, 'rb') as f:
+        while True:
+            chunk = f.read(SCAN_CHUNK_SIZE)
+            parser.Parse(chunk, not chunk)
+
+            # Hand over the items found in this chunk
+            for record in records:
+                yield record
+            del records[:]
+
+            if not chunk:
+                break
+
+
+def feedStat(xmlFilepath):
+    """Return a string identifying the current version of the feed."""
+    try:
+        stat = os.stat(xmlFilepath)
+    except OSError:
+        return "missing"
+
+    return "%d:%d" % (stat.st_size, stat.st_mtime_ns)
+
+
+def getMeta(conn, key):
+    """Get a value from the meta table."""
+    row = conn.execute("SELECT value FROM meta WHERE key = ?",
+                       (key,)).fetchone()
+    return row[0] if row else None
+
+
+def setMeta(conn, key, value):
+    """Set a value in the meta table."""
+    conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+"""Errors reported by PenPen.
+
+The library raises these instead of exiting, so that a long running caller
+(see `feed.Feed`) can report a failed episode and carry on. The command line
+logs their message and exits with status 1. Failures of the system itself
+(e.g. a full disk or LAME crashing) are raised as `IOError`/`OSError`.
+"""
+
+
+class PenPenError(Exception):
+    """Base class of the errors PenPen reports."""
+
+
+class ConfigError(PenPenError):
+    """The configuration, a manifest or an argument is missing or invalid."""
+
+
+class AudioError(PenPenError):
+    """An audio file can't be published (missing, wrong type, no LAME)."""
+
+
+class FeedError(PenPenError):
+    """The feed, its archive pages or its backups can't be updated."""
+
+
+class DuplicateEpisodeError(FeedError):
+    """An episode is already in the feed."""
+
+
+class EpisodeNotFoundError(FeedError):
+    """An episode isn't in the feed."""
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""Publish to a feed from Python rather than from the command line.
+
+A long running service can keep a Feed open and publish episodes without
+starting a PenPen process, or reading the config and the feed, for each one:
+
+    feed = penpen.Feed.fromConfigFile('podcast.conf')
+    feed.addEpisode('episode12.wav', 'Episode 12', 'About the twelfth.')
+    feed.save()
+
+A Feed keeps the config, the episode index and the episodes (an `Episode`
+per item) in memory. Episodes are transcoded and tagged as they are added,
+and `save` publishes them with a single update of the feed, along with the
+removed episodes. The feeds of the renditions (see `audio.renditions`) are
+updated with it. Other PenPen runs may update the feed in the meantime: the
+feed is only changed holding its lock (see `feedLock`), and `reload` picks
+up their changes.
+
+Problems are raised as `errors.PenPenError` subclasses instead of exiting.
+"""
+
+import logging
+
+from . import core
+from . import episodeIndex
+
+logger = logging.getLogger(__name__)
+
+
+class Episode(object):
+    """An episode of the feed, as recorded in the episode index.
+
+    `page` is 0 for the items of the feed itself, otherwise the number of
+    the archive page holding the item.
+    """
+
+    __slots__ = ('guid', 'title', 'pubDate', 'year', 'length', 'duration',
+                 'page')
+
+    def __init__(self, guid, title, pubDate=None, year=None, length=None,
+                 duration=None, page=0):
+        self.guid = guid
+        self.title = title
+        self.pubDate = pubDate
+        self.year = year
+        self.length = length
+        self.duration = duration
+        self.page = page
+
+    @classmethod
+    def fromRecord(cls, record):
+        """Build an Episode from an episode index record."""
+        guid, title, pubDate, year, length, duration, _, page = record
+        return cls(guid, title, pubDate, year, length, duration, page)
+
+    def __repr__(self):
+        return "Episode(%r, %r)" % (self.guid, self.title)
+
+
+class Feed(object):
+    """A feed and its episodes, kept in memory between updates."""
+
+    def __init__(self, config):
+        self.config = config
+        self.index = episodeIndex.openIndex(config)
+        self.feeds = core.renditionFeeds(config)
+        # Episodes of the feed and its archive pages, newest first
+        self.episodes = []
+        # The (filename, title, desc) of the episodes added since the last
+        # save, and the (title, desc, mp3File, duration) they were
+        # processed into
+        self.added = []
+        self.processed = []
+        # Guids of the episodes to remove on the next save
+        self.removed = []
+
+        self.reload()
+
+    @classmethod
+    def fromConfigFile(cls, configFile):
+        """Open the feed described by a configuration file."""
+        return cls(core.parseConfigFile(configFile))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def reload(self):
+        """Pick up the changes made to the feed by other PenPen runs."""
+        episodeIndex.refreshIndex(self.index, self.config['xmlFilepath'])
+        self.episodes = [Episode.fromRecord(record)
+                         for record in episodeIndex.listEpisodes(self.index)]
+
+    def addEpisode(self, filename, title, desc):
+        """Transcode and tag an episode to publish on the next `save`.
+
+        `filename` is a WAV or an MP3. Return the guid of the episode. Raise
+        DuplicateEpisodeError if it is already in the feed or was already
+        added, and AudioError if the file can't be published.
+        """
+        from . import audio
+        from . import rss
+
+        episodeIndex.refreshIndex(self.index, self.config['xmlFilepath'])
+
+        # Fail before transcoding, like the command line
+        core.checkDuplicates(self.config, self.feeds,
+                             [added[0] for added in self.added] + [filename],
+                             self.index)
+
+        episode = (filename, title, desc)
+        self.processed.append(core.processEpisode(episode, self.config))
+        self.added.append(episode)
+
+        return rss.episodeGuid(self.config, audio.mp3Filename(filename))
+
+    def removeEpisode(self, guid):
+        """Remove an episode from the feed on the next `save`.
+
+        An episode added since the last save is simply dropped. Its MP3s are
+        left alone. Raise EpisodeNotFoundError if the episode isn't in the
+        feed, and FeedError if it is on an archive page (they are never
+        rewritten).
+        """
+        from . import rss
+
+        for i, (_, _, mp3File, _) in enumerate(self.processed):
+            if rss.episodeGuid(self.config, mp3File) == guid:
+                del self.added[i]
+                del self.processed[i]
+                return
+
+        episodeIndex.refreshIndex(self.index, self.config['xmlFilepath'])
+        rss.checkRemovable(self.index, guid)
+
+        if guid not in self.removed:
+            self.removed.append(guid)
+
+    def save(self):
+        """Publish the episodes added and removed since the last save.
+
+        The removed episodes go first, with a rewrite of the feed. The added
+        ones are then published together (see `rss.addEpisodes`).
+        """
+        from . import rss
+
+        if self.removed:
+            rss.removeEpisodes(self.config, self.removed, self.index)
+
+            for rendition in self.feeds:
+                removeFromRendition(rendition, self.removed)
+
+            self.removed = []
+
+        if self.added:
+            core.addToFeeds(self.config, self.feeds, self.added,
+                            self.processed, self.index)
+            self.added = []
+            self.processed = []
+
+        self.reload()
+
+    def close(self):
+        """Close the episode index. Unsaved changes are dropped."""
+        if self.added or self.removed:
+            logger.warning("Closing \'" + self.config['xmlFilepath'] +
+                           "\' with unsaved changes.")
+
+        self.index.close()
+
+
+def removeFromRendition(rendition, guids):
+    """Remove the items of the episodes `guids` from a rendition's feed.
+
+    Only renditions of WAVs exist, so episodes without one are skipped.
+    """
+    from . import rss
+
+    index = episodeIndex.openIndex(rendition)
+    guids = [guid for guid in core.renditionGuids(rendition, guids)
+             if episodeIndex.episodePage(index, guid) == 0]
+
+    if guids:
+        rss.removeEpisodes(rendition, guids, index)
+
+    index.close()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""Serialize the updates of a feed between PenPen processes.
+
+A feed update reads the feed, changes it and writes it back. Two runs
+overlapping (two hosts publishing at once, or a retry racing the original)
+would otherwise both read the same feed, and the last one to write would
+drop the other's episodes.
+
+Every update of the feed is done holding an advisory lock (`flock`) on
+`[xmlFilepath].lock`. Publishers don't add their items themselves: each
+first queues them as a request in `[xmlFilepath].spool/`, then waits for the
+lock. Whoever gets the lock commits every request queued at that point with
+a single rewrite and a single backup (a group commit). Publishers that were
+waiting meanwhile find their request gone when they get the lock and are
+done.
+
+A request that can't be committed (e.g. its episode is already in the feed)
+is answered with a `.failed` file holding the reason, for its publisher to
+report. A publisher that gives up before its request was committed (it was
+interrupted, or failed) withdraws it, so that the next run doesn't publish
+its episodes.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import time
+
+from . import fileUtils
+
+logger = logging.getLogger(__name__)
+
+# Appended to `xmlFilepath` for the lock file and the request queue
+LOCK_SUFFIX = ".lock"
+SPOOL_SUFFIX = ".spool"
+
+REQUEST_EXT = ".json"
+FAILED_EXT = ".failed"
+
+# Answers nobody picked up (their publisher died) are removed after this
+FAILED_MAX_AGE = 86400
+
+
+def lockFilepath(config):
+    """Return the location of the lock file of the feed in `config`."""
+    return config['xmlFilepath'] + LOCK_SUFFIX
+
+
+def spoolDir(config):
+    """Return the directory holding the queued requests of the feed."""
+    return config['xmlFilepath'] + SPOOL_SUFFIX
+
+
+@contextlib.contextmanager
+def locked(config):
+    """Hold the lock of the feed in `config` for the duration.
+
+    Waits for other PenPen processes to release it first. Without `fcntl`
+    (e.g. on Windows) the feed isn't locked.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        logger.warning("File locking isn't available. Concurrent runs may " +
+                       "drop each other's episodes.")
+        yield
+        return
+
+    fd = os.open(lockFilepath(config), os.O_RDWR | os.O_CREAT, 0o644)
+
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            logger.info("Waiting for another PenPen run to finish with " +
+                        "\'" + config['xmlFilepath'] + "\'...")
+            fcntl.flock(fd, fcntl.LOCK_EX)
+
+        yield
+    finally:
+        # Closing the file releases the lock
+        os.close(fd)
+
+
+def enqueue(config, data):
+    """Queue a request holding `data` (JSON) and return its location.
+
+    Requests are named so that they sort in the order they were queued.
+    """
+    directory = spoolDir(config)
+
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created by another publisher in the meantime
+            if not os.path.isdir(directory):
+                raise
+
+    request = os.path.join(directory, "%020d-%d-%s%s" %
+                           (time.time() * 1e6, os.getpid(),
+                            os.urandom(4).hex(), REQUEST_EXT))
+    fileUtils.writeAtomic(request,
+                          lambda f: f.write(json.dumps(data).encode('utf-8')))
+
+    return request
+
+
+def pendingRequests(config):
+    """Return the (request, data) of the queued requests, oldest first.
+
+    Must be called holding the lock. Old answers are cleaned up on the way.
+    """
+    directory = spoolDir(config)
+    requests = []
+
+    if not os.path.isdir(directory):
+        return requests
+
+    for name in sorted(os.listdir(directory)):
+        filepath = os.path.join(directory, name)
+
+        if name.endswith(FAILED_EXT):
+            if time.time() - os.path.getmtime(filepath) > FAILED_MAX_AGE:
+                os.remove(filepath)
+        elif name.endswith(REQUEST_EXT) and not name.startswith('.'):
+            try:
+                with open(filepath, 'rb') as f:
+                    data = f.read()
+            except (IOError, OSError):
+                # Withdrawn in the meantime
+                if os.path.exists(filepath):
+                    raise
+                continue
+
+            requests.append((filepath, json.loads(data.decode('utf-8'))))
+
+    return requests
+
+
+def finishRequest(request, error=None):
+    """Remove a committed request, or answer it with `error` if it failed.
+
+    Must be called holding the lock.
+    """
+    if error is not None:
+        fileUtils.writeAtomic(failedFilepath(request),
+                              lambda f: f.write(error.encode('utf-8')),
+                              sync=False)
+
+    removeFile(request)
+
+
+def withdraw(request):
+    """Remove a request its publisher gave up on, and any answer to it.
+
+    Doesn't need the lock, as a publisher may be interrupted while waiting
+    for it. A run committing the request at that moment still publishes it.
+    """
+    removeFile(request)
+    removeFile(failedFilepath(request))
+
+
+def takeResult(request):
+    """Return the outcome of a request, once another process handled it.
+
+    Must be called holding the lock. Return None if the request is still
+    queued, otherwise (True, None) if it was committed, or (False, error).
+    """
+    if os.path.exists(request):
+        return None
+
+    if not os.path.exists(failedFilepath(request)):
+        return True, None
+
+    with open(failedFilepath(request), 'rb') as f:
+        error = f.read().decode('utf-8')
+
+    os.remove(failedFilepath(request))
+
+    return False, error
+
+
+def failedFilepath(request):
+    """Return the location of the answer to a failed request."""
+    return request[:-len(REQUEST_EXT)] + FAILED_EXT
+
+
+def removeFile(filepath):
+    """Remove a file unless it is already gone."""
+    try:
+        os.remove(filepath)
+    except (IOError, OSError):
+        if os.path.exists(filepath):
+            raise
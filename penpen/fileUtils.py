@@ -3,11 +3,22 @@
 
 import logging
 import os
+import shutil
+import tempfile
 
-# Configure logger globally
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# The umask can only be read by setting it, which would briefly apply to
+# the files other threads create (e.g. the MP3 writers of
+# `audio.streamTranscode`). It is read once, on import.
+_umask = os.umask(0)
+os.umask(_umask)
+
+# Appended to `xmlFilepath` for the sidecar holding the validators (ETag and
+# Last-Modified) of the feed, written by `rss.writeFeedVariants` and read by
+# modules that don't load `rss` (see `validate`)
+META_SUFFIX = ".meta"
+
 
 def extValid(filename, ext):
     """Check that the file has the specified extension."""
@@ -31,3 +42,83 @@ def which(exe):
         fPath = os.path.join(pDir, exe)
         if os.path.exists(fPath) and os.access(fPath, os.X_OK):
             return fPath
+
+
+def writeAtomic(filepath, writeContents, sync=True):
+    """Replace a file with the output of `writeContents(f)` atomically.
+
+    The contents are written to a temporary file in the same directory,
+    flushed to disk (unless `sync` is False), and renamed over `filepath`.
+    Readers see either the old or the new file, never a partial one. The
+    temporary file is removed if anything fails.
+    """
+    directory = os.path.dirname(os.path.abspath(filepath))
+    tmpFilepath = tempFilepath(filepath)
+
+    try:
+        # Opened by name so that `f.name` can be handed to other writers
+        with open(tmpFilepath, 'w+b') as f:
+            writeContents(f)
+            f.flush()
+
+            if sync:
+                os.fsync(f.fileno())
+
+        replaceFile(tmpFilepath, filepath)
+    except:
+        removeTemp(tmpFilepath)
+        raise
+
+    # Make the rename itself durable
+    if sync:
+        fsyncDir(directory)
+
+
+def tempFilepath(filepath):
+    """Create an empty temporary file next to `filepath` for replacing it.
+
+    Return its path. It is hidden and named after `filepath`.
+    """
+    fd, tmpFilepath = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filepath)), suffix='.tmp',
+        prefix='.' + os.path.basename(filepath))
+    os.close(fd)
+
+    return tmpFilepath
+
+
+def replaceFile(tmpFilepath, filepath):
+    """Rename a finished temporary file (see `tempFilepath`) over a file."""
+    # `mkstemp` only gives the owner access. Keep the permissions of the
+    # file being replaced, or use the default ones for a new file.
+    if os.path.exists(filepath):
+        shutil.copymode(filepath, tmpFilepath)
+    else:
+        os.chmod(tmpFilepath, 0o666 & ~_umask)
+
+    os.replace(tmpFilepath, filepath)
+
+
+def removeTemp(tmpFilepath):
+    """Remove a temporary file that won't be used, if it still exists."""
+    try:
+        if os.path.exists(tmpFilepath):
+            os.remove(tmpFilepath)
+    except OSError:
+        logger.warning("Could not remove the temporary file \'" +
+                       tmpFilepath + "\'")
+
+
+def fsyncDir(directory):
+    """Flush a directory entry to disk where the platform supports it."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
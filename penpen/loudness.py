@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+"""Measure the loudness of WAV files and normalize them while encoding.
+
+Loudness is measured as in ITU-R BS.1770-4 (EBU R 128): the samples are
+K-weighted, their energy is taken over 400 ms blocks overlapping by 75% and
+the blocks are gated (absolute gate at -70 LUFS, relative gate 10 LU below
+the loudness of the blocks above it). The true peak is the highest sample
+after oversampling (4x below 96 kHz).
+
+The WAV is read through an mmap in fixed-size blocks and the filters keep
+their state from one block to the next, so memory doesn't grow with the
+length of the episode (only the 100 ms energies used for gating are kept, 80
+bytes per second). The gain is applied to the samples as they are written
+into the encoder (see `GainStream`), so normalizing doesn't write another
+WAV.
+
+Needs NumPy (pip install penpen[loudness]), which is only loaded when a
+loudness target is set.
+"""
+
+import array
+import logging
+import math
+import mmap
+
+from . import metrics
+from . import probe
+
+logger = logging.getLogger(__name__)
+
+# Default maximum true peak after normalizing (dBTP)
+DEFAULT_TRUE_PEAK_LIMIT = -1.0
+
+# Size of the FFTs used for K-weighting, relative to the length of its
+# response. The WAV is read in blocks that fit them.
+FFT_RESPONSE_RATIO = 8
+
+# Gating (BS.1770-4): 400 ms blocks made of four 100 ms steps
+STEP_SECONDS = 0.1
+STEPS_PER_BLOCK = 4
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+
+# Taps per phase of the true peak interpolation filter (48 taps at 4x, as in
+# BS.1770-4)
+TRUE_PEAK_TAPS = 12
+
+# The K-weighting response is cut where it has decayed below this
+RESPONSE_CUTOFF = 1e-10
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+
+
+def settings(config):
+    """Return the normalization settings in `config`, or None if it's off.
+
+    Normalization is on when `loudnessTarget` (LUFS) is set.
+    """
+    if not config.get('loudnessTarget'):
+        return None
+
+    return {'target': float(config['loudnessTarget']),
+            'truePeakLimit': float(config.get('loudnessTruePeakLimit') or
+                                   DEFAULT_TRUE_PEAK_LIMIT)}
+
+
+def importNumpy():
+    """Return the numpy module, or None if it isn't installed."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+
+    return numpy
+
+
+@metrics.stage('audio.loudness')
+def analyze(filename, normalization):
+    """Measure a WAV and work out the gain needed to normalize it.
+
+    Return `normalization` with the integrated loudness (LUFS), true peak
+    (dBTP) and gain (dB) added. The gain meets the target unless that would
+    push the true peak over its limit. They are None if the WAV couldn't be
+    measured.
+    """
+    result = dict(normalization, integrated=None, truePeak=None, gain=None)
+
+    if importNumpy() is None:
+        logger.warning("NumPy is not installed (pip install " +
+                       "penpen[loudness]). Skipping loudness normalization.")
+        return result
+
+    logger.info("Measuring loudness...")
+    measured = measure(filename)
+
+    if measured is None:
+        logger.warning("Unsupported WAV format. Skipping loudness " +
+                       "normalization.")
+        return result
+
+    integrated, truePeak = measured
+    gain = 0.0
+
+    # Silence can't be normalized
+    if not math.isinf(integrated):
+        gain = normalization['target'] - integrated
+
+        if truePeak + gain > normalization['truePeakLimit']:
+            gain = normalization['truePeakLimit'] - truePeak
+            logger.warning("Limiting the gain to %.1f dB to keep the true " %
+                           gain + "peak under %.1f dBTP." %
+                           normalization['truePeakLimit'])
+
+    logger.info("Loudness %.1f LUFS, true peak %.1f dBTP. Applying " %
+                (integrated, truePeak) + "%+.1f dB." % gain)
+
+    # JSON has no infinity
+    result.update(integrated=None if math.isinf(integrated) else
+                  round(integrated, 2),
+                  truePeak=None if math.isinf(truePeak) else
+                  round(truePeak, 2),
+                  gain=round(gain, 2))
+
+    return result
+
+
+def measure(filename):
+    """Return the (integrated loudness, true peak) of a WAV.
+
+    Both are -inf for silence. Return None if the sample format isn't
+    supported.
+    """
+    np = importNumpy()
+
+    with open(filename, 'rb') as f:
+        wav = probe.readWavFormat(f)
+
+        if wav is None or sampleCodec(wav) is None:
+            return None
+
+        decode, _ = sampleCodec(wav)
+        frames = wav.dataSize // wav.blockAlign
+
+        if not frames:
+            return float('-inf'), float('-inf')
+
+        kWeighting = OverlapAdd(np, kWeightingResponse(wav.sampleRate),
+                                wav.channels)
+        truePeak = TruePeak(np, wav.sampleRate, wav.channels)
+        weights = np.array(channelWeights(wav.channels))
+        stepFrames = max(1, int(round(wav.sampleRate * STEP_SECONDS)))
+
+        # Energies of the 100 ms steps, and of the frames of the last one
+        # that isn't complete yet
+        steps = array.array('d')
+        pending = np.zeros(0)
+
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            for start in range(0, frames, kWeighting.blockFrames):
+                count = min(kWeighting.blockFrames, frames - start)
+                offset = wav.dataOffset + start * wav.blockAlign
+                samples = decode(data[offset:offset + count * wav.blockAlign])
+                samples = samples.reshape(count, wav.channels)
+
+                truePeak.update(samples)
+
+                filtered = kWeighting.process(samples)
+                energy = np.concatenate((pending,
+                                         (filtered * filtered).dot(weights)))
+                whole = len(energy) - len(energy) % stepFrames
+                steps.extend(energy[:whole].reshape(-1, stepFrames)
+                             .sum(axis=1))
+                pending = energy[whole:]
+
+                releasePages(data, offset, offset + count * wav.blockAlign)
+        finally:
+            data.close()
+
+    return gatedLoudness(np, steps, stepFrames), truePeak.decibels()
+
+
+def releasePages(data, start, end):
+    """Drop the pages of an mmap between `start` and `end` from memory.
+
+    They were read already. Without this, every page read stays counted
+    in the resident memory of the process until the mmap is closed.
+    """
+    if hasattr(mmap, 'MADV_DONTNEED'):
+        start -= start % mmap.PAGESIZE
+        data.madvise(mmap.MADV_DONTNEED, start,
+                     max(0, end - end % mmap.PAGESIZE - start))
+
+
+def gatedLoudness(np, steps, stepFrames):
+    """Return the integrated loudness from the energies of the 100 ms steps."""
+    steps = np.asarray(steps, dtype=np.float64)
+
+    if len(steps) < STEPS_PER_BLOCK:
+        return float('-inf')
+
+    # Mean square of each 400 ms block, one block per step
+    blocks = sum(steps[i:len(steps) - STEPS_PER_BLOCK + 1 + i]
+                 for i in range(STEPS_PER_BLOCK))
+    blocks /= STEPS_PER_BLOCK * stepFrames
+
+    with np.errstate(divide='ignore'):
+        levels = -0.691 + 10 * np.log10(blocks)
+
+    gated = blocks[levels > ABSOLUTE_GATE]
+
+    if not len(gated):
+        return float('-inf')
+
+    relativeGate = -0.691 + 10 * math.log10(gated.mean()) + RELATIVE_GATE
+    gated = blocks[(levels > ABSOLUTE_GATE) & (levels > relativeGate)]
+
+    return -0.691 + 10 * math.log10(gated.mean())
+
+
+def channelWeights(channels):
+    """Return the BS.1770 weight of each channel.
+
+    5.1 is taken to be in WAV order (L, R, C, LFE, Ls, Rs). The LFE is left
+    out and the surrounds count 1.41 times. Other layouts weigh 1 each.
+    """
+    if channels == 6:
+        return [1.0, 1.0, 1.0, 0.0, 1.41, 1.41]
+
+    return [1.0] * channels
+
+
+def kWeightingResponse(sampleRate):
+    """Return the impulse response of the K-weighting filter.
+
+    The two biquads (high shelf, then high pass) are designed for
+    `sampleRate` from their analog prototypes, as in libebur128, and
+    match the coefficients given in BS.1770 at 48 kHz. The response is
+    cut once it has decayed below `RESPONSE_CUTOFF`.
+    """
+    # High shelf (the acoustic effect of the head)
+    k = math.tan(math.pi * 1681.974450955533 / sampleRate)
+    vh = math.pow(10.0, 3.999843853973347 / 20.0)
+    vb = math.pow(vh, 0.4996667741545416)
+    q = 0.7071752369554196
+    a0 = 1.0 + k / q + k * k
+    shelf = ([(vh + vb * k / q + k * k) / a0, 2.0 * (k * k - vh) / a0,
+              (vh - vb * k / q + k * k) / a0],
+             [2.0 * (k * k - 1.0) / a0, (1.0 - k / q + k * k) / a0])
+
+    # High pass (RLB weighting)
+    k = math.tan(math.pi * 38.13547087602444 / sampleRate)
+    q = 0.5003270373238773
+    a0 = 1.0 + k / q + k * k
+    highPass = ([1.0, -2.0, 1.0],
+                [2.0 * (k * k - 1.0) / a0, (1.0 - k / q + k * k) / a0])
+
+    # Run an impulse through both, one sample at a time. Only done once per
+    # file, and the response is a few thousand samples long.
+    response = []
+    states = [[0.0, 0.0], [0.0, 0.0]]
+    quiet = 0
+    n = 0
+
+    while quiet < 64:
+        value = 1.0 if n == 0 else 0.0
+
+        # Transposed direct form II
+        for (b, a), state in zip((shelf, highPass), states):
+            out = b[0] * value + state[0]
+            state[0] = b[1] * value - a[0] * out + state[1]
+            state[1] = b[2] * value - a[1] * out
+            value = out
+
+        response.append(value)
+        quiet = quiet + 1 if abs(value) < RESPONSE_CUTOFF else 0
+        n += 1
+
+    return response[:-quiet] or response[:1]
+
+
+class OverlapAdd(object):
+    """Filter blocks of samples with an FIR response, through FFTs.
+
+    The tail of each block's output is carried into the next one, so the
+    blocks come out as if the whole signal had been filtered at once. Blocks
+    can hold up to `blockFrames` frames.
+    """
+
+    def __init__(self, np, response, channels):
+        self.np = np
+
+        # FFTs of about FFT_RESPONSE_RATIO times the response keep the work
+        # per sample low
+        self.size = 1 << (FFT_RESPONSE_RATIO * len(response)).bit_length()
+        self.blockFrames = self.size - len(response) + 1
+        self.spectrum = np.fft.rfft(response, self.size)[:, None]
+        self.tail = np.zeros((len(response) - 1, channels))
+
+    def process(self, samples):
+        """Return the filtered samples (frames x channels)."""
+        np = self.np
+        count = len(samples)
+
+        out = np.fft.irfft(np.fft.rfft(samples, self.size, axis=0) *
+                           self.spectrum, self.size, axis=0)
+        out = out[:count + len(self.tail)]
+        out[:len(self.tail)] += self.tail
+        self.tail = out[count:].copy()
+
+        return out[:count]
+
+
+class TruePeak(object):
+    """Track the true peak of blocks of samples (BS.1770-4 annex 2)."""
+
+    def __init__(self, np, sampleRate, channels):
+        self.np = np
+        self.peak = 0.0
+
+        # 4x oversampling below 96 kHz, 2x below 192 kHz
+        self.factor = 4 if sampleRate < 96000 else \
+            2 if sampleRate < 192000 else 1
+
+        # Windowed sinc interpolation filter, split into one column of taps
+        # per output phase (each with a gain of 1). Phase p interpolates
+        # p / factor of the way to the next sample, so phase 0 gives back
+        # the samples themselves.
+        size = TRUE_PEAK_TAPS * self.factor
+        taps = np.sinc((np.arange(size) - size // 2) / float(self.factor)) * \
+            np.kaiser(size + 1, 5.0)[:size]
+        phases = taps.reshape(TRUE_PEAK_TAPS, self.factor)
+
+        # Reversed, as tap k is applied to the block shifted by k frames
+        self.phases = (phases / phases.sum(axis=0))[::-1].copy()
+
+        self.history = np.zeros((TRUE_PEAK_TAPS - 1, channels))
+
+    def update(self, samples):
+        """Take the samples (frames x channels) of the next block."""
+        np = self.np
+
+        if not len(samples):
+            return
+
+        if self.factor == 1:
+            self.peak = max(self.peak, float(np.abs(samples).max()))
+            return
+
+        padded = np.concatenate((self.history, samples))
+        frames = len(samples)
+
+        # Phase 0 is the samples themselves
+        values = np.abs(samples)
+
+        # One multiply-add of the whole block per tap
+        for phase in self.phases[:, 1:].T:
+            interpolated = np.zeros(samples.shape)
+
+            for tap, coefficient in enumerate(phase):
+                interpolated += coefficient * padded[tap:tap + frames]
+
+            values = np.maximum(values, np.abs(interpolated))
+
+        self.peak = max(self.peak, float(values.max()))
+        self.history = padded[frames:]
+
+    def decibels(self):
+        """Return the true peak so far in dBTP."""
+        if not self.peak:
+            return float('-inf')
+
+        return 20 * math.log10(self.peak)
+
+
+def sampleCodec(wav):
+    """Return (decode, encode) functions for the samples of a WAV.
+
+    `decode` turns the bytes of whole sample frames into floats in [-1, 1)
+    and `encode` turns them back (clipping). Return None if the sample
+    format isn't supported (PCM 8/16/24/32 bits and 32/64 bit floats are).
+    """
+    np = importNumpy()
+    bits = wav.bitsPerSample
+
+    if wav.formatTag == WAVE_FORMAT_IEEE_FLOAT and bits in (32, 64):
+        dtype = np.dtype('<f%d' % (bits // 8))
+
+        return (lambda data: np.frombuffer(data, dtype).astype(np.float64),
+                lambda values: values.astype(dtype).tobytes())
+
+    if wav.formatTag != WAVE_FORMAT_PCM or bits not in (8, 16, 24, 32):
+        return None
+
+    scale = float(1 << (bits - 1))
+
+    def toBytes(values, dtype):
+        return np.clip(np.round(values * scale), -scale, scale - 1) \
+            .astype(dtype)
+
+    if bits == 8:
+        # 8 bit samples are unsigned
+        return (lambda data: (np.frombuffer(data, np.uint8) - scale) / scale,
+                lambda values: (toBytes(values, np.int16) + 128)
+                .astype(np.uint8).tobytes())
+
+    if bits == 24:
+        def decode(data):
+            raw = np.frombuffer(data, np.uint8).reshape(-1, 3)
+            values = raw[:, 0].astype(np.int32) | \
+                (raw[:, 1].astype(np.int32) << 8) | \
+                (raw[:, 2].astype(np.int8).astype(np.int32) << 16)
+            return values / scale
+
+        def encode(values):
+            raw = toBytes(values, '<i4').view(np.uint8).reshape(-1, 4)
+            return raw[:, :3].tobytes()
+
+        return decode, encode
+
+    dtype = np.dtype('<i%d' % (bits // 8))
+
+    return (lambda data: np.frombuffer(data, dtype) / scale,
+            lambda values: toBytes(values, dtype).tobytes())
+
+
+class GainStream(object):
+    """Apply a gain to the samples of a WAV as its bytes go by.
+
+    Feed the whole file through `process`, in chunks of any size. The
+    headers and any chunks after the samples come out unchanged.
+    """
+
+    def __init__(self, filename, gain):
+        with open(filename, 'rb') as f:
+            wav = probe.readWavFormat(f)
+
+        self.decode, self.encode = sampleCodec(wav)
+        self.blockAlign = wav.blockAlign
+        self.start = wav.dataOffset
+        self.end = wav.dataOffset + wav.dataSize
+        self.factor = math.pow(10.0, gain / 20.0)
+
+        # Bytes read so far, and those of a sample frame split between two
+        # chunks
+        self.pos = 0
+        self.carry = b''
+
+    def process(self, chunk):
+        """Return the next chunk of the file with the gain applied."""
+        pos = self.pos
+        self.pos += len(chunk)
+        out = []
+
+        # Headers before the samples
+        if pos < self.start:
+            count = min(len(chunk), self.start - pos)
+            out.append(chunk[:count])
+            chunk = chunk[count:]
+            pos += count
+
+        # Samples, in whole frames
+        if chunk and pos < self.end:
+            count = min(len(chunk), self.end - pos)
+            data = self.carry + chunk[:count]
+            chunk = chunk[count:]
+            whole = len(data) - len(data) % self.blockAlign
+
+            out.append(self.encode(self.decode(data[:whole]) * self.factor))
+            self.carry = data[whole:]
+
+            # A truncated last frame is left as is
+            if pos + count == self.end:
+                out.append(self.carry)
+                self.carry = b''
+
+        # Chunks after the samples
+        out.append(chunk)
+
+        return b''.join(out)
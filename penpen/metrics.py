@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""Measure the time and resources used by each stage of a run.
+
+Functions and blocks are marked as stages with `stage`:
+
+    @metrics.stage('audio.tag')
+    def tagAudio(filename, config, title):
+        ...
+
+    with metrics.stage('rss.backup'):
+        ...
+
+Nothing is recorded unless metrics were enabled (`penpen --metrics` or
+`--metrics-json`). Each time a stage runs, it records:
+
+    wall        Elapsed seconds.
+    cpu         CPU seconds of this process.
+    childCpu    CPU seconds of child processes (e.g. LAME) that finished.
+    readBytes   Bytes passed through read calls (rchar in /proc/self/io).
+    writeBytes  Bytes passed through write calls (wchar in /proc/self/io).
+    peakRssKb   Peak resident memory while the stage ran.
+
+On Linux the kernel's peak RSS is reset at the start of each stage, so the
+peak belongs to the stage (and the stages it contains). Elsewhere it is the
+peak of the process so far. Byte counts need /proc and are 0 without it.
+Without the `resource` module (e.g. on Windows), the child CPU time is 0 and
+so is the peak RSS unless /proc provides it.
+"""
+
+import functools
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Records of the stages that finished, in order
+_records = []
+
+# Stages currently running, innermost last
+_stack = []
+
+_state = {'enabled': False, 'canResetPeak': None, 'started': 0}
+
+
+def enable():
+    """Start recording stages."""
+    _state['enabled'] = True
+
+
+def isEnabled():
+    """Check whether stages are being recorded."""
+    return _state['enabled']
+
+
+def records():
+    """Return the records of the stages that finished so far."""
+    return list(_records)
+
+
+class stage(object):
+    """Record a stage. Use as a decorator or as a context manager."""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.peak = 0
+        self.parent = None
+        self.started = None
+
+    def __call__(self, function):
+        name = self.name
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    def __enter__(self):
+        if not _state['enabled']:
+            return self
+
+        # The enclosing stage keeps the peak reached so far before the
+        # kernel's counter is reset for this one
+        if _stack:
+            _stack[-1].peak = max(_stack[-1].peak, peakRssKb())
+            self.parent = _stack[-1].name
+
+        resetPeakRss()
+        _stack.append(self)
+        _state['started'] += 1
+        self.started = _state['started']
+        self.start = sample()
+
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if self.start is None:
+            return False
+
+        end = sample()
+        peak = max(self.peak, peakRssKb())
+        _stack.pop()
+
+        if _stack:
+            _stack[-1].peak = max(_stack[-1].peak, peak)
+
+        _records.append({'stage': self.name,
+                         'parent': self.parent,
+                         'started': self.started,
+                         'depth': len(_stack),
+                         'pid': os.getpid(),
+                         'wall': end[0] - self.start[0],
+                         'cpu': end[1] - self.start[1],
+                         'childCpu': end[2] - self.start[2],
+                         'readBytes': end[3] - self.start[3],
+                         'writeBytes': end[4] - self.start[4],
+                         'peakRssKb': peak,
+                         'failed': excType is not None})
+
+        return False
+
+
+def sample():
+    """Return the current (wall, cpu, childCpu, readBytes, writeBytes)."""
+    readBytes, writeBytes = ioCounters()
+    childCpu = 0.0
+
+    if resource is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        childCpu = children.ru_utime + children.ru_stime
+
+    return (time.perf_counter(), time.process_time(), childCpu, readBytes,
+            writeBytes)
+
+
+def ioCounters():
+    """Return the bytes read and written by this process so far."""
+    counters = {}
+
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                counters[key] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+
+    return counters.get('rchar', 0), counters.get('wchar', 0)
+
+
+def peakRssKb():
+    """Return the peak RSS (in KB) since it was last reset."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+
+    if resource is None:
+        return 0
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Bytes on macOS, KB elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def resetPeakRss():
+    """Reset the kernel's peak RSS of this process, where supported."""
+    if _state['canResetPeak'] is False:
+        return
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        _state['canResetPeak'] = True
+    except (IOError, OSError):
+        _state['canResetPeak'] = False
+
+
+def collect(function, *args):
+    """Run `function` with metrics enabled and return (result, records).
+
+    Used to bring back the records of work done in other processes (see
+    `merge`).
+    """
+    enable()
+    del _records[:]
+    del _stack[:]
+
+    result = function(*args)
+
+    return result, records()
+
+
+def merge(workerRecords):
+    """Add records collected in another process under the current stage."""
+    parent = _stack[-1].name if _stack else None
+
+    for record in workerRecords:
+        _state['started'] += 1
+        _records.append(dict(record,
+                             depth=record['depth'] + len(_stack),
+                             parent=record['parent'] or parent,
+                             started=_state['started']))
+
+
+def summarize():
+    """Return the totals of each stage, nested stages after their parent.
+
+    A stage that ran several times (e.g. once per episode) is added up. Its
+    peak is the highest one. Stages are listed in the order they started.
+    """
+    totals = {}
+
+    for record in sorted(_records, key=lambda r: r['started']):
+        name = record['stage']
+
+        if name not in totals:
+            totals[name] = dict(record, calls=0, wall=0.0, cpu=0.0,
+                                childCpu=0.0, readBytes=0, writeBytes=0,
+                                peakRssKb=0)
+
+        total = totals[name]
+        total['calls'] += 1
+
+        for key in ('wall', 'cpu', 'childCpu', 'readBytes', 'writeBytes'):
+            total[key] += record[key]
+
+        total['peakRssKb'] = max(total['peakRssKb'], record['peakRssKb'])
+
+    byStart = sorted(totals.values(), key=lambda t: t['started'])
+    ordered = []
+    listed = set()
+
+    def visit(parent, depth):
+        for total in byStart:
+            if total['parent'] == parent and total['stage'] not in listed:
+                listed.add(total['stage'])
+                ordered.append(dict(total, depth=depth))
+                visit(total['stage'], depth + 1)
+
+    visit(None, 0)
+
+    # Stages whose parent was never recorded
+    return ordered + [t for t in byStart if t['stage'] not in listed]
+
+
+def formatTable():
+    """Return the stage totals as a table."""
+    lines = ["%-30s %5s %9s %9s %9s %9s %9s %8s" %
+             ("stage", "calls", "wall s", "cpu s", "child s", "read MB",
+              "write MB", "peak MB")]
+
+    for total in summarize():
+        lines.append("%-30s %5d %9.3f %9.3f %9.3f %9.1f %9.1f %8.1f" %
+                     ("  " * total['depth'] + total['stage'],
+                      total['calls'], total['wall'], total['cpu'],
+                      total['childCpu'], total['readBytes'] / 1048576.0,
+                      total['writeBytes'] / 1048576.0,
+                      total['peakRssKb'] / 1024.0))
+
+    return "\n".join(lines)
+
+
+def writeJsonLines(f):
+    """Write one JSON object per stage run."""
+    for record in _records:
+        f.write(json.dumps(record, sort_keys=True) + "\n")
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+"""Read the duration and format of audio files from their headers.
+
+WAV files are probed from the `fmt ` and `data` chunk headers. MP3 files are
+probed from the first frame and its Xing/Info (LAME) or VBRI header, which
+hold the number of frames. Only a few bounded reads are needed either way.
+MP3 files without such a header (usually CBR) are the exception: their
+frames are walked through an mmap of the file, which touches the frame
+headers only.
+"""
+
+import collections
+import logging
+import mmap
+import os
+import struct
+
+logger = logging.getLogger(__name__)
+
+# Length in seconds, average bitrate in bits per second
+AudioInfo = collections.namedtuple('AudioInfo',
+                                   'length bitrate sampleRate channels')
+
+# Format of a WAV file's samples and where they are. The format tags are
+# WAVE_FORMAT_PCM (1) or WAVE_FORMAT_IEEE_FLOAT (3), usually.
+WavFormat = collections.namedtuple('WavFormat',
+                                   'formatTag channels sampleRate byteRate '
+                                   'blockAlign bitsPerSample dataOffset '
+                                   'dataSize')
+
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# How far past the ID3 tag to look for the first MP3 frame
+SYNC_SEARCH_SIZE = 65536
+
+# Bitrates in kbps by (MPEG 1?, layer), indexed by the header's bitrate bits
+BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384,
+                416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320,
+                384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256,
+                320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224,
+                 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144,
+                 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144,
+                 160)}
+
+# Sample rates by the header's version bits (MPEG 2.5, reserved, 2, 1)
+SAMPLE_RATES = {0: (11025, 12000, 8000),
+                2: (22050, 24000, 16000),
+                3: (44100, 48000, 32000)}
+
+# Mono channel mode in the frame header
+MONO = 3
+
+FrameHeader = collections.namedtuple('FrameHeader',
+                                     'mpeg1 layer sampleRate channels '
+                                     'samples length bitrate')
+
+
+def probeFile(filename):
+    """Return the AudioInfo of a WAV or MP3 file, or None if unrecognized."""
+    with open(filename, 'rb') as f:
+        start = f.read(12)
+        f.seek(0)
+
+        if start[:4] == b'RIFF' and start[8:12] == b'WAVE':
+            return probeWav(f)
+
+        return probeMp3(f)
+
+
+def probeWav(f):
+    """Probe a WAV file from its chunk headers."""
+    wav = readWavFormat(f)
+
+    if wav is None or not wav.byteRate:
+        return None
+
+    return AudioInfo(float(wav.dataSize) / wav.byteRate, wav.byteRate * 8,
+                     wav.sampleRate, wav.channels)
+
+
+def readWavFormat(f):
+    """Return the WavFormat of a WAV file, or None if it has none."""
+    fileSize = os.fstat(f.fileno()).st_size
+    f.seek(12)
+    fmt = None
+
+    while True:
+        header = f.read(8)
+
+        if len(header) < 8:
+            return None
+
+        chunkId, chunkSize = struct.unpack('<4sI', header)
+
+        if chunkId == b'fmt ':
+            data = f.read(chunkSize + (chunkSize & 1))
+
+            if len(data) < 16:
+                return None
+
+            fmt = list(struct.unpack('<HHIIHH', data[:16]))
+
+            # The actual format of WAVE_FORMAT_EXTENSIBLE is in its
+            # sub-format GUID
+            if fmt[0] == WAVE_FORMAT_EXTENSIBLE and len(data) >= 26:
+                fmt[0] = struct.unpack('<H', data[24:26])[0]
+        elif chunkId == b'data':
+            break
+        else:
+            # Chunks are padded to an even size
+            f.seek(chunkSize + (chunkSize & 1), os.SEEK_CUR)
+
+    if fmt is None:
+        return None
+
+    # Streamed recordings can leave the size unset, as 0 or 0xFFFFFFFF
+    dataSize = fileSize - f.tell()
+
+    if chunkSize:
+        dataSize = min(chunkSize, dataSize)
+
+    return WavFormat(*fmt, dataOffset=f.tell(), dataSize=dataSize)
+
+
+def probeMp3(f):
+    """Probe an MP3 file from its first frame and VBR header."""
+    fileSize = os.fstat(f.fileno()).st_size
+    audioStart = id3Size(f.read(10))
+    audioEnd = fileSize - id3v1Size(f, fileSize)
+
+    f.seek(audioStart)
+    window = f.read(SYNC_SEARCH_SIZE)
+    pos = findFrame(window)
+
+    if pos is None:
+        return None
+
+    frame = parseFrameHeader(window[pos:pos + 4])
+    audioStart += pos
+    vbrHeader = window[pos:pos + frame.length]
+
+    frames, audioBytes = readXing(vbrHeader, frame) or \
+        readVbri(vbrHeader) or (None, None)
+
+    if frames:
+        length = float(frames * frame.samples) / frame.sampleRate
+        length -= float(lameGap(vbrHeader, frame)) / frame.sampleRate
+        audioBytes = audioBytes or audioEnd - audioStart
+    else:
+        # No header to tell the number of frames. Walk them.
+        length = scanFrames(f, audioStart, audioEnd)
+        audioBytes = audioEnd - audioStart
+
+    if length <= 0:
+        return AudioInfo(0.0, frame.bitrate, frame.sampleRate, frame.channels)
+
+    return AudioInfo(length, int(audioBytes * 8 / length), frame.sampleRate,
+                     frame.channels)
+
+
+def id3Size(header):
+    """Return the size of the ID3v2 tag starting with `header` (or 0)."""
+    if len(header) < 10 or header[:3] != b'ID3':
+        return 0
+
+    # Sizes are 4 x 7 bits ("syncsafe"), plus a footer if flagged
+    size = 0
+    for byte in bytearray(header[6:10]):
+        size = (size << 7) | (byte & 0x7f)
+
+    footer = 10 if bytearray(header)[5] & 0x10 else 0
+
+    return 10 + size + footer
+
+
+def id3v1Size(f, fileSize):
+    """Return the size of the ID3v1 tag at the end of the file (or 0)."""
+    if fileSize < 128:
+        return 0
+
+    f.seek(fileSize - 128)
+    return 128 if f.read(3) == b'TAG' else 0
+
+
+def parseFrameHeader(data):
+    """Parse a 4 byte MPEG audio frame header, or return None if invalid."""
+    if len(data) < 4:
+        return None
+
+    value = struct.unpack('>I', data)[0]
+
+    if value >> 21 != 0x7ff:
+        return None
+
+    version = (value >> 19) & 3
+    layer = 4 - ((value >> 17) & 3)
+    bitrateIndex = (value >> 12) & 0xf
+    rateIndex = (value >> 10) & 3
+    padding = (value >> 9) & 1
+    channelMode = (value >> 6) & 3
+
+    # Reserved values, and free format which has no fixed frame length
+    if version == 1 or layer == 4 or bitrateIndex in (0, 15) or \
+            rateIndex == 3:
+        return None
+
+    mpeg1 = version == 3
+    bitrate = BITRATES[(mpeg1, layer)][bitrateIndex] * 1000
+    sampleRate = SAMPLE_RATES[version][rateIndex]
+
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sampleRate + padding) * 4
+    else:
+        samples = 1152 if mpeg1 or layer == 2 else 576
+        length = samples // 8 * bitrate // sampleRate + padding
+
+    return FrameHeader(mpeg1, layer, sampleRate,
+                       1 if channelMode == MONO else 2, samples, length,
+                       bitrate)
+
+
+def findFrame(data):
+    """Return the position of the first frame confirmed by the next one."""
+    pos = data.find(b'\xff')
+
+    while pos != -1:
+        frame = parseFrameHeader(data[pos:pos + 4])
+
+        if frame is not None:
+            following = data[pos + frame.length:pos + frame.length + 4]
+
+            # A sync pattern in random data rarely has a valid successor.
+            # Accept a lone frame at the end of the window.
+            if len(following) < 4 or parseFrameHeader(following) is not None:
+                return pos
+
+        pos = data.find(b'\xff', pos + 1)
+
+    return None
+
+
+def xingOffset(frame):
+    """Return where the Xing/Info header sits in the first frame."""
+    if frame.mpeg1:
+        return 4 + (17 if frame.channels == 1 else 32)
+
+    return 4 + (9 if frame.channels == 1 else 17)
+
+
+def readXing(data, frame):
+    """Return (frames, bytes) from a Xing/Info header, or None."""
+    pos = xingOffset(frame)
+
+    if data[pos:pos + 4] not in (b'Xing', b'Info'):
+        return None
+
+    flags = struct.unpack('>I', data[pos + 4:pos + 8])[0]
+    pos += 8
+    frames = audioBytes = None
+
+    if flags & 1:
+        frames = struct.unpack('>I', data[pos:pos + 4])[0]
+        pos += 4
+
+    if flags & 2:
+        audioBytes = struct.unpack('>I', data[pos:pos + 4])[0]
+
+    return (frames, audioBytes) if frames else None
+
+
+def readVbri(data):
+    """Return (frames, bytes) from a VBRI (Fraunhofer) header, or None."""
+    # Always 32 bytes after the frame header
+    if data[36:40] != b'VBRI' or len(data) < 54:
+        return None
+
+    audioBytes, frames = struct.unpack('>II', data[46:54])
+
+    return (frames, audioBytes) if frames else None
+
+
+def lameGap(data, frame):
+    """Return the encoder delay plus padding (in samples) from a LAME tag."""
+    pos = xingOffset(frame)
+
+    if data[pos:pos + 4] not in (b'Xing', b'Info'):
+        return 0
+
+    flags = struct.unpack('>I', data[pos + 4:pos + 8])[0]
+
+    # Skip the Xing fields that are present (frames, bytes, TOC, quality)
+    pos += 8 + sum(size for bit, size in ((1, 4), (2, 4), (4, 100), (8, 4))
+                   if flags & bit)
+
+    if data[pos:pos + 4] != b'LAME' or len(data) < pos + 24:
+        return 0
+
+    # 12 bits of delay then 12 bits of padding, 21 bytes into the tag
+    gap = bytearray(data[pos + 21:pos + 24])
+    delay = (gap[0] << 4) | (gap[1] >> 4)
+    padding = ((gap[1] & 0xf) << 8) | gap[2]
+
+    return delay + padding
+
+
+def scanFrames(f, start, end):
+    """Return the length in seconds found by walking every frame header."""
+    if end <= start:
+        return 0.0
+
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    length = 0.0
+    pos = start
+
+    try:
+        while pos + 4 <= end:
+            frame = parseFrameHeader(mm[pos:pos + 4])
+
+            if frame is None:
+                # Resync after junk between frames
+                pos = mm.find(b'\xff', pos + 1, end)
+
+                if pos == -1:
+                    break
+
+                continue
+
+            length += float(frame.samples) / frame.sampleRate
+            pos += frame.length
+    finally:
+        mm.close()
+
+    return length
+
+
+def lameTagCrc(data):
+    """Return the CRC-16 that a LAME tag stores for its first 190 bytes."""
+    crc = 0
+
+    for byte in bytearray(data[:190]):
+        crc ^= byte
+
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xa001 if crc & 1 else crc >> 1
+
+    return crc
+
+
+class FrameCounter(object):
+    """Count the frames of an MPEG audio stream as it goes by.
+
+    Chunks of the stream are passed to `update` in order. Only the start of
+    a frame header split across two chunks is kept between them.
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self.size = 0
+        # (stream offset, FrameHeader) of the first frame
+        self.firstFrame = None
+        self.buf = b''
+        # Stream offset of buf[0]
+        self.bufStart = 0
+        # Bytes left of a frame that runs past the last chunk
+        self.skip = 0
+
+    def update(self, chunk):
+        """Count the frames whose headers are in `chunk`."""
+        self.size += len(chunk)
+
+        if self.skip >= len(chunk):
+            self.skip -= len(chunk)
+            self.bufStart += len(chunk)
+            return
+
+        buf = self.buf + chunk[self.skip:]
+        self.bufStart += self.skip
+        self.skip = 0
+        pos = 0
+
+        while pos + 4 <= len(buf):
+            frame = parseFrameHeader(buf[pos:pos + 4])
+
+            if frame is None:
+                # Resync after junk between frames
+                pos = buf.find(b'\xff', pos + 1)
+
+                if pos == -1:
+                    pos = len(buf)
+
+                continue
+
+            if self.firstFrame is None:
+                self.firstFrame = (self.bufStart + pos, frame)
+
+            self.frames += 1
+            pos += frame.length
+
+        if pos > len(buf):
+            self.skip = pos - len(buf)
+            pos = len(buf)
+
+        self.buf = buf[pos:]
+        self.bufStart += pos
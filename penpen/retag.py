@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""Bring the ID3 tags of the published MP3s up to date with the config.
+
+After a change of e.g. `rssTitle`, `episodeAuthor` or the cover art, the
+tags of every episode already published are stale. `penpen retag` goes
+through the episodes in the episode index (archive pages included), finds
+the local MP3 of each enclosure along with the MP3s of its renditions (see
+`audio.renditions`), and compares their frames with the ones PenPen writes
+now (see `audio.buildTagFrames`). The recording date is the year the episode
+was published.
+
+Only the MP3s with differing frames are saved, on a pool of worker
+processes. Only the ID3 tag at the start of the file is read. A tag that
+fits in the space of the old one (see `audio.id3Padding`) is written in
+place; otherwise the whole file has to be rewritten to make room, and these
+files are reported.
+"""
+
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+
+from mutagen.id3 import ID3, ID3NoHeaderError
+
+from . import audio
+from . import buildCache
+from . import episodeIndex
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Outcome of retagging a file
+UP_TO_DATE = 'up to date'
+STALE = 'stale'
+IN_PLACE = 'retagged in place'
+REWRITTEN = 'rewritten'
+MISSING = 'missing'
+
+
+def retag(config, episodeDir, workers=None, dryRun=False):
+    """Retag the MP3s of the feed's episodes found in `episodeDir`.
+
+    With `dryRun`, nothing is written. Return a list of (mp3File, outcome,
+    IDs of the differing frames) tuples.
+    """
+    jobs = collectJobs(config, episodeDir)
+
+    if not jobs:
+        return []
+
+    audio.prepareCoverArt(config)
+
+    workers = min(len(jobs), workers or multiprocessing.cpu_count())
+
+    if workers == 1:
+        return [retagFile(job, dryRun) for job in jobs]
+
+    logger.info("Checking the tags of %d MP3s with %d workers..." %
+                (len(jobs), workers))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        # Bring back what the workers measured
+        if metrics.isEnabled():
+            futures = [pool.submit(metrics.collect, retagFile, job, dryRun)
+                       for job in jobs]
+            results = []
+
+            for future in futures:
+                result, records = future.result()
+                metrics.merge(records)
+                results.append(result)
+
+            return results
+
+        futures = [pool.submit(retagFile, job, dryRun) for job in jobs]
+
+        return [future.result() for future in futures]
+
+
+def collectJobs(config, episodeDir):
+    """Return a (mp3File, config, title, year) job for each MP3 to check.
+
+    The MP3 of an episode is the file named like its enclosure in
+    `episodeDir`. Those of its renditions are only checked if they exist.
+    """
+    index = episodeIndex.openIndex(config)
+    outputs = audio.renditions(config)
+    jobs = []
+
+    for guid, title, _, year, _, _, _, _ in episodeIndex.listEpisodes(index):
+        # The guid is the public link to the MP3 (see `rss.episodeGuid`)
+        mp3File = os.path.join(episodeDir, guid.rsplit('/', 1)[-1])
+        jobs.append((mp3File, config, title, year))
+
+        for rendition in outputs:
+            renditionFile = audio.mp3Filename(mp3File,
+                                              rendition['mp3Suffix'])
+
+            if os.path.isfile(renditionFile):
+                jobs.append((renditionFile, rendition, title, year))
+
+    index.close()
+
+    return jobs
+
+
+@metrics.stage('audio.retag')
+def retagFile(job, dryRun=False):
+    """Save the frames of an MP3 that differ from the ones built now.
+
+    Return (mp3File, outcome, IDs of the differing frames).
+    """
+    mp3File, config, title, year = job
+
+    if not os.path.isfile(mp3File):
+        return mp3File, MISSING, []
+
+    try:
+        tags = ID3(mp3File)
+    except ID3NoHeaderError:
+        tags = ID3()
+
+    frames = [frame for frame in audio.buildTagFrames(config, title, year)
+              if frameValues(tags.getall(frame.FrameID)) !=
+              frameValues([frame])]
+    changed = [frame.FrameID for frame in frames]
+
+    if not frames:
+        return mp3File, UP_TO_DATE, changed
+
+    if dryRun:
+        return mp3File, STALE, changed
+
+    # Kept up to date so that publishing the source again doesn't rebuild
+    entry = buildCache.loadEntry(mp3File)
+
+    if entry is not None and not buildCache.outputMatches(entry, mp3File):
+        entry = None
+
+    for frame in frames:
+        tags.setall(frame.FrameID, [frame])
+
+    padding = audio.id3Padding(config)
+    fits = []
+
+    def recordPadding(info):
+        fits.append(info.padding >= 0)
+        return padding(info)
+
+    tags.save(mp3File, padding=recordPadding)
+
+    if entry is not None:
+        entry['tagKey'] = audio.tagKey(config, title, year)
+        entry['output'] = buildCache.fileStat(mp3File)
+        buildCache.writeEntry(mp3File, entry)
+
+    return mp3File, IN_PLACE if all(fits) else REWRITTEN, changed
+
+
+def frameValues(frames):
+    """Return what matters in a list of frames for comparing them."""
+    values = []
+
+    for frame in frames:
+        if frame.FrameID == 'APIC':
+            values.append((frame.mime, frame.type, frame.desc, frame.data))
+        else:
+            values.append([str(text) for text in frame.text])
+
+    return values
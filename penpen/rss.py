@@ -2,43 +2,116 @@
 # -*- coding: utf-8 -*-
 """Create RSS feeds and append items."""
 
+import collections
 import datetime
+import gzip
+import hashlib
+import itertools
+import json
 import logging
 import os
 import re
 import shutil
-import xml.dom.minidom
+import xml.parsers.expat
 
 try:
     import xml.etree.cElementTree as ET
 except ImportError:
     import xml.etree.ElementTree as ET
 
+from . import backupStore
+from . import episodeIndex
+from . import errors
+from . import feedLock
 from . import fileUtils
+from . import metrics
 
-# Configure logger globally
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
-def generateXml(config, newEpisode):
-    """Generate the XML for the RSS feed."""
-    # Register namespaces
-    namespaces = {'itunes': "http://www.itunes.com/dtds/podcast-1.0.dtd",
-                  'atom': "http://www.w3.org/2005/Atom"}
+# Namespaces used by the feed
+NAMESPACES = {'itunes': "http://www.itunes.com/dtds/podcast-1.0.dtd",
+              'atom': "http://www.w3.org/2005/Atom"}
 
-    for prefix, uri in namespaces.items():
-        ET.register_namespace(prefix, uri)
+# Feed history namespace (RFC 5005), only declared on archive pages
+FH_NAMESPACE = "http://purl.org/syndication/history/1.0"
 
-    # Initialize the root node
-    rss = ET.Element("rss", version="2.0")
-    chan = ET.SubElement(rss, 'channel')
+# Channel fields that change on every publish. They are rewritten in place by
+# the append path and ignored when checking whether the channel has changed.
+VOLATILE_CHANNEL_TAGS = ('copyright', 'lastBuildDate')
+
+# Indentation used for the serialized feed
+INDENT = "  "
+
+# Depth of the channel fields and items, which are serialized one at a time
+ITEM_LEVEL = 2
+
+XML_DECLARATION = b'<?xml version="1.0" encoding="utf-8"?>\n'
+
+# Matches the opening tag of the first item in a feed
+ITEM_START_RE = re.compile(br'<item[\s>/]')
+
+# Size of the reads used when scanning the feed for items
+SCAN_CHUNK_SIZE = 65536
+
+# Matches the start tag of the root element
+RSS_START_RE = re.compile(br'<rss[\s>][^>]*>')
+
+# An item of the old feed copied as is when the feed is rewritten: its
+# serialized bytes and its index record (see `feedFragments`)
+Fragment = collections.namedtuple('Fragment', 'data record')
+
+# Appended to `xmlFilepath` for the precompressed copies (the sidecar's is
+# `fileUtils.META_SUFFIX`)
+GZIP_SUFFIX = ".gz"
+BROTLI_SUFFIX = ".br"
+
+
+@metrics.stage('rss.generateXml')
+def generateXml(config, newEpisodes, index=None, oldEpisodeLimit=None,
+                removed=()):
+    """Generate the XML for the RSS feed.
+
+    `newEpisodes` is a list of items ordered newest first. They are placed
+    above the old episodes so that the whole feed is written out once. Only
+    the newest `oldEpisodeLimit` old episodes are kept if it is set, and the
+    ones whose guid is in `removed` are dropped. The episode `index` is
+    opened (and closed) if not given, and is refreshed with the items as
+    they are written.
+    """
+    with episodeIndex.usingIndex(config, index) as index:
+        # Initialize the root node. All tags use prefixes, so the namespaces
+        # are declared on the root.
+        rss = ET.Element("rss", version="2.0")
+
+        for prefix, uri in NAMESPACES.items():
+            rss.set("xmlns:" + prefix, uri)
 
-    # Get old episodes, the first year of publishing (for building the
-    # copyright string), and set RSS attributes
-    oldEpisodes, firstYear = getOldEpisodes(config, rss, chan, namespaces)
+        chan = ET.SubElement(rss, 'channel')
 
-    # Add feed elements
+        # Add feed elements. The first year of publishing (for building the
+        # copyright string) comes from the index.
+        addChannelElements(config, chan, episodeIndex.firstYear(index),
+                           archiveLinks(config, index))
+
+        # Add the new episodes
+        chan.extend(newEpisodes)
+
+        # Save it out, copying the old episodes back in behind the new ones
+        records = []
+        fragments = {}
+        writeXmlFile(config, rss, records, oldEpisodeLimit, index, fragments,
+                     removed)
+        episodeIndex.replaceEpisodes(index, config['xmlFilepath'], records,
+                                     fragments)
+
+
+def addChannelElements(config, chan, firstYear, links=()):
+    """Add the channel elements (everything but the items) to `chan`.
+
+    `links` is a list of (rel, href) pairs added as atom links after the
+    link to the feed itself.
+    """
     addSubElementFromConfig(chan, 'title', config, 'rssTitle')
     addSubElementFromConfig(chan, 'link', config, 'websiteLink')
     addSubElementFromConfig(chan, 'language', config, 'language')
@@ -53,14 +126,13 @@ def generateXml(config, newEpisode):
     # Copyright
     addSubElement(chan, 'copyright', generateCopyrightStr(config, firstYear))
 
-    # Atom link
-    xmlFilepath = config['xmlFilepath']
-    rssLink = generateLink(config['rssDir'], os.path.basename(xmlFilepath))
-    ET.SubElement(chan,
-                  'atom:link',
-                  href=rssLink,
-                  rel="self",
-                  type="application/rss+xml")
+    # Atom links
+    for rel, href in [("self", feedLink(config))] + list(links):
+        ET.SubElement(chan,
+                      'atom:link',
+                      href=href,
+                      rel=rel,
+                      type="application/rss+xml")
 
     # iTunes rss owner
     owner = ET.SubElement(chan, 'itunes:owner')
@@ -87,21 +159,460 @@ def generateXml(config, newEpisode):
     # Last build date
     addSubElement(chan, 'lastBuildDate', getFormattedUtcTime())
 
-    # Add the episode
-    chan.append(newEpisode)
 
-    # Copy old episodes back into the RSS feed and set the attributes
-    if oldEpisodes:
-        chan.extend(oldEpisodes)
+@metrics.stage('rss.append')
+def appendEpisodes(config, newEpisodes, index):
+    """Splice new items into the existing feed without reparsing it.
+
+    Only the channel header is parsed. If the channel still matches the
+    config, the `lastBuildDate` and `copyright` fields are updated in place,
+    the serialized items are inserted above the first old item, and the rest
+    of the file is copied over byte for byte.
+
+    Return False (without writing anything) when there is no feed yet or the
+    channel config has changed, in which case a full rebuild is needed.
+    """
+    xmlFilepath = config['xmlFilepath']
+
+    if not os.path.isfile(xmlFilepath):
+        return False
+
+    header, offset = readFeedHeader(xmlFilepath)
+
+    if header is None:
+        logger.warning("Could not find the items in \'" + xmlFilepath +
+                       "\'. Rebuilding the feed.")
+        return False
+
+    # Parse the channel header on its own
+    try:
+        oldChan = ET.fromstring(header + b'</channel></rss>').find('channel')
+    except ET.ParseError:
+        logger.warning("Unable to parse the channel of \'" + xmlFilepath +
+                       "\'. Rebuilding the feed.")
+        return False
+
+    # Compare with the channel the config would generate now
+    newChan = ET.Element('channel')
+    addChannelElements(config, newChan, episodeIndex.firstYear(index),
+                       archiveLinks(config, index))
+
+    if channelSignature(oldChan) != channelSignature(newChan):
+        logger.info("Channel config has changed. Rebuilding the feed.")
+        return False
+
+    # Update the volatile channel fields in the header
+    for tag in VOLATILE_CHANNEL_TAGS:
+        value = escapeText(newChan.find(tag).text).encode('utf-8')
+        header = re.sub(('<%s>[^<]*</%s>' % (tag, tag)).encode('utf-8'),
+                        lambda m: b'<%s>%s</%s>' % (tag.encode('utf-8'),
+                                                     value,
+                                                     tag.encode('utf-8')),
+                        header, count=1)
+
+    # Serialize the new items and work out where they will land
+    itemStrs = []
+    records = []
+    fragments = {}
+    itemOffset = len(header)
+
+    for item in newEpisodes:
+        itemStr = serializeElement(item, ITEM_LEVEL)
+        records.append(episodeIndex.recordFromElement(
+            item, itemOffset + len(INDENT * ITEM_LEVEL)))
+        fragments[item.findtext('guid')] = hashlib.sha256(itemStr).hexdigest()
+        itemStrs.append(itemStr)
+        itemOffset += len(itemStr)
+
+    checkWellFormed(b'<items>' + b''.join(itemStrs) + b'</items>')
+
+    def writeContents(f, original):
+        f.write(header)
+
+        for itemStr in itemStrs:
+            f.write(itemStr)
+
+        # Copy the old items and the closing tags untouched
+        with open(original, 'rb') as src:
+            src.seek(offset)
+            shutil.copyfileobj(src, f)
+
+    writeFeed(config, writeContents)
+
+    # Old items moved by the change in header size plus the new items
+    episodeIndex.addEpisodes(index, xmlFilepath, records,
+                             itemOffset - offset, offset, fragments)
+
+    return True
+
+
+@metrics.stage('rss.archive')
+def archiveEpisodes(config, index):
+    """Freeze the oldest episodes into archive pages (RFC 5005).
+
+    Does nothing unless `feedPageSize` is set. Archive pages hold exactly
+    `feedPageSize` items and are never rewritten. Once the feed holds twice
+    that many items, the oldest ones are moved to new archive pages so that
+    the feed keeps between `feedPageSize` and twice that many items, and the
+    feed is rewritten with a `prev-archive` link to the newest page.
+    """
+    pageSize = int(config.get('feedPageSize') or 0)
+
+    if pageSize <= 0:
+        return
+
+    count = episodeIndex.countEpisodes(index)
+    newPages = (count - pageSize) // pageSize
+
+    if newPages <= 0:
+        return
+
+    kept = count - newPages * pageSize
+    lastPage = episodeIndex.archivePageCount(index)
+    logger.info("Archiving %d episode(s) into %d page(s)..." %
+                (newPages * pageSize, newPages))
+
+    # The feed is newest first: skip the kept items, then each page's items
+    # follow from the newest page to the oldest one
+    episodes = readEpisodes(config['xmlFilepath'])
+
+    for _ in itertools.islice(episodes, kept):
+        pass
+
+    for page in range(lastPage + newPages, lastPage, -1):
+        writeArchivePage(config, index, page,
+                         itertools.islice(episodes, pageSize))
+
+    episodes.close()
+
+    # Drop the archived items from the feed and link to the newest page
+    generateXml(config, [], index, kept)
+
+
+def writeArchivePage(config, index, page, items):
+    """Write archive page `page` holding `items` and index it."""
+    pageFilepath = episodeIndex.archiveFilepath(config['xmlFilepath'], page)
+
+    if os.path.exists(pageFilepath):
+        raise errors.FeedError("Archive page \'" + pageFilepath + "\' " +
+                               "already exists. Archive pages are never " +
+                               "rewritten.")
+
+    # The page links back to the feed and to the neighboring pages. Pages
+    # are never rewritten, so the next page is only linked if it was frozen
+    # first (newer pages are written first, see `archiveEpisodes`). The
+    # newest page only links to the feed, which links to it.
+    links = [('current', feedLink(config))]
+
+    if os.path.exists(episodeIndex.archiveFilepath(config['xmlFilepath'],
+                                                   page + 1)):
+        links.append(('next-archive', archiveLink(config, page + 1)))
+
+    if page > 1:
+        links.append(('prev-archive', archiveLink(config, page - 1)))
 
-    # Save it out
-    writeXmlFile(config, rss)
+    rss = ET.Element("rss", version="2.0")
+
+    for prefix, uri in NAMESPACES.items():
+        rss.set("xmlns:" + prefix, uri)
+    rss.set("xmlns:fh", FH_NAMESPACE)
+
+    chan = ET.SubElement(rss, 'channel')
+    pageConfig = dict(config, xmlFilepath=pageFilepath)
+    addChannelElements(pageConfig, chan, episodeIndex.firstYear(index), links)
+    ET.SubElement(chan, 'fh:archive')
+
+    records = []
+    fileUtils.writeAtomic(pageFilepath,
+                          lambda f: writeXml(f, rss, items, records))
+    episodeIndex.addArchivePage(index, [record[:-1] + (page,)
+                                        for record in records])
+
+    logger.info("Saved archive page => " + pageFilepath)
+    writeFeedVariants(pageConfig)
+
+
+def archiveLinks(config, index):
+    """Return the atom links from the feed to its archive pages."""
+    pages = episodeIndex.archivePageCount(index)
+
+    if not pages:
+        return []
+
+    return [('prev-archive', archiveLink(config, pages))]
+
+
+def feedLink(config):
+    """Return the public link to the feed."""
+    return generateLink(config['rssDir'],
+                        os.path.basename(config['xmlFilepath']))
+
+
+def archiveLink(config, page):
+    """Return the public link to an archive page."""
+    return generateLink(config['rssDir'], os.path.basename(
+        episodeIndex.archiveFilepath(config['xmlFilepath'], page)))
+
+
+def readFeedHeader(xmlFilepath):
+    """Read the feed up to the line where items are inserted.
+
+    Return the header bytes and their length, which is the offset of the
+    first item (or of `</channel>` for a feed without items). Return
+    (None, None) if neither can be found.
+    """
+    header = b''
+
+    with open(xmlFilepath, 'rb') as f:
+        while True:
+            chunk = f.read(SCAN_CHUNK_SIZE)
+
+            if not chunk:
+                return None, None
+
+            # Keep some overlap in case a tag straddles two reads
+            searchFrom = max(0, len(header) - 16)
+            header += chunk
+
+            match = ITEM_START_RE.search(header, searchFrom)
+            pos = match.start() if match else header.find(b'</channel>',
+                                                          searchFrom)
+
+            if pos >= 0:
+                # Insert at the start of the line to keep the indentation
+                offset = header.rfind(b'\n', 0, pos) + 1
+                return header[:offset], offset
+
+
+def channelSignature(chan):
+    """Return a comparable summary of the non-volatile channel elements."""
+    return [elementSignature(child) for child in chan
+            if prefixTag(child.tag) not in VOLATILE_CHANNEL_TAGS + ('item',)]
+
+
+def elementSignature(elem):
+    """Return a comparable summary of an element and its children."""
+    return (prefixTag(elem.tag),
+            sorted(elem.attrib.items()),
+            (elem.text or '').strip(),
+            [elementSignature(child) for child in elem])
+
+
+def prefixTag(tag):
+    """Convert a `{uri}name` tag from the parser into its `prefix:name` form."""
+    if tag.startswith('{'):
+        uri, name = tag[1:].split('}', 1)
+
+        for prefix, nsUri in NAMESPACES.items():
+            if nsUri == uri:
+                return prefix + ":" + name
+
+    return tag
 
 
 def addEpisode(config, title, desc, mp3File, duration):
     """Add an episode to the RSS feed."""
-    logger.info("Adding episode to the RSS feed...")
+    addEpisodes(config, [(title, desc, mp3File, duration)])
+
+
+@metrics.stage('rss.addEpisodes')
+def addEpisodes(config, episodes, index=None):
+    """Add several episodes to the RSS feed with a single rewrite.
+
+    `episodes` is a list of (title, desc, mp3File, duration) tuples ordered
+    oldest first. The items are queued and committed holding the feed's
+    lock, along with those queued by other PenPen runs in the meantime (see
+    `feedLock`). Each episode is stamped one second after the previous one
+    so that podcast clients keep the intended order. Long running callers
+    can pass in the episode `index` to keep it open between calls.
+    """
+    logger.info("Adding %d episode(s) to the RSS feed..." % len(episodes))
+
+    items = [createItem(config, title, desc, mp3File, duration)
+             for title, desc, mp3File, duration in episodes]
+    request = feedLock.enqueue(config, [itemFields(item) for item in items])
+    result = None
+
+    try:
+        with feedLock.locked(config):
+            result = feedLock.takeResult(request)
+
+            if result is None:
+                result = commitRequests(config, request, index)
+            else:
+                logger.info("Another PenPen run added the episode(s) to " +
+                            "the feed along with its own.")
+    finally:
+        # Interrupted or failed: don't leave the episodes to the next run
+        if result is None:
+            feedLock.withdraw(request)
+
+    committed, error = result
+
+    if not committed:
+        raise errors.DuplicateEpisodeError(error)
+
+
+def commitRequests(config, request, index=None):
+    """Add the items of every queued request to the feed in one rewrite.
+
+    Must be called holding the feed's lock. Requests holding an episode
+    that is already in the feed are answered with an error instead. Return
+    the outcome of our own `request` (see `feedLock.takeResult`).
+    """
+    if index is None:
+        with episodeIndex.usingIndex(config) as index:
+            return commitRequests(config, request, index)
+
+    # Another run may have changed the feed since the index was opened
+    episodeIndex.refreshIndex(index, config['xmlFilepath'])
+
+    accepted = []
+    items = []
+    seen = set()
+
+    for queued, fields in feedLock.pendingRequests(config):
+        queuedItems = [itemFromFields(itemField) for itemField in fields]
+        duplicate = findDuplicate(index, [item.findtext('guid')
+                                          for item in queuedItems], seen)
+
+        if duplicate is None:
+            accepted.append(queued)
+            items.extend(queuedItems)
+        else:
+            feedLock.finishRequest(queued, "\'" + duplicate +
+                                   "\' is already in the feed.")
+
+    if len(accepted) > 1:
+        logger.info("Adding %d episode(s) queued by %d PenPen runs..." %
+                    (len(items), len(accepted)))
+
+    if items:
+        now = datetime.datetime.utcnow()
+
+        for i, item in enumerate(items):
+            pubTime = now - datetime.timedelta(seconds=len(items) - 1 - i)
+            item.find('pubDate').text = getFormattedUtcTime(pubTime)
+
+        # Newest episodes go at the top of the feed
+        items.reverse()
+
+        try:
+            # Append to the existing feed if possible, otherwise rebuild it
+            if not appendEpisodes(config, items, index):
+                generateXml(config, items, index)
+
+            # Move the oldest episodes to archive pages if the feed is paged
+            archiveEpisodes(config, index)
+        except BaseException:
+            # The other requests stay queued for their runs to retry
+            if os.path.exists(request):
+                os.remove(request)
+            raise
+
+        for queued in accepted:
+            feedLock.finishRequest(queued)
+
+    return feedLock.takeResult(request)
+
+
+@metrics.stage('rss.removeEpisodes')
+def removeEpisodes(config, guids, index=None):
+    """Remove episodes from the RSS feed with a single rewrite.
+
+    `guids` must be items of the feed itself: archive pages are never
+    rewritten. The feed is rewritten holding its lock (see `feedLock`). Long
+    running callers can pass in the episode `index` to keep it open between
+    calls.
+    """
+    logger.info("Removing %d episode(s) from the RSS feed..." % len(guids))
+
+    with feedLock.locked(config), \
+            episodeIndex.usingIndex(config, index) as index:
+        # Another run may have changed the feed since the index was opened
+        episodeIndex.refreshIndex(index, config['xmlFilepath'])
+
+        for guid in guids:
+            checkRemovable(index, guid)
+
+        generateXml(config, [], index, removed=set(guids))
+
+
+def checkRemovable(index, guid):
+    """Raise an error unless `guid` is an item of the feed itself.
+
+    EpisodeNotFoundError if it isn't in the feed, FeedError if it is on an
+    archive page.
+    """
+    page = episodeIndex.episodePage(index, guid)
+
+    if page is None:
+        raise errors.EpisodeNotFoundError("\'" + guid + "\' is not in the " +
+                                          "feed.")
+
+    if page > 0:
+        raise errors.FeedError("\'%s\' is on archive page %d. " %
+                               (guid, page) + "Archive pages are never " +
+                               "rewritten.")
+
+
+def checkDuplicates(index, guids):
+    """Raise DuplicateEpisodeError if a guid is in the feed or repeated."""
+    duplicate = findDuplicate(index, guids, set())
+
+    if duplicate is not None:
+        raise errors.DuplicateEpisodeError("\'" + duplicate + "\' is " +
+                                           "already in the feed.")
+
+
+def findDuplicate(index, guids, seen):
+    """Return a guid that is in the feed, in `seen` or repeated, or None.
+
+    If there is none, the guids are added to `seen`.
+    """
+    new = set()
+
+    for guid in guids:
+        if guid in seen or guid in new or \
+                episodeIndex.hasEpisode(index, guid):
+            return guid
+
+        new.add(guid)
+
+    seen.update(new)
+
+    return None
+
+
+def itemGuid(item):
+    """Return the guid of an item or of a Fragment."""
+    if isinstance(item, Fragment):
+        return item.record[0]
+
+    return item.findtext('guid')
+
+
+def itemFields(item):
+    """Return the children of an item as JSON friendly lists.
+
+    Items are queued in this form (see `feedLock`). Each child is a [tag,
+    text, attributes] list.
+    """
+    return [[child.tag, child.text, dict(child.attrib)] for child in item]
+
+
+def itemFromFields(fields):
+    """Build an item from the lists made by `itemFields`."""
+    item = ET.Element('item')
+
+    for tag, text, attrib in fields:
+        ET.SubElement(item, tag, attrib).text = text
 
+    return item
+
+
+def createItem(config, title, desc, mp3File, duration, pubTime=None):
+    """Create the `item` element for an episode."""
     # Create the item for the new episode
     item = ET.Element('item')
 
@@ -115,18 +626,14 @@ def addEpisode(config, title, desc, mp3File, duration):
     addSubElement(item, 'title', title)
     addSubElement(item, 'description', desc)
     addSubElement(item, 'itunes:summary', desc)
-    addSubElement(item, 'pubDate', getFormattedUtcTime())
+    addSubElement(item, 'pubDate', getFormattedUtcTime(pubTime))
 
     # Format the duration
     durationStr = "%0.f:%02.f:%02.f" % duration
     addSubElement(item, 'itunes:duration', durationStr)
 
     # Create the public link to the episode
-    episodeDir = config['episodeDir']
-    if not episodeDir.endswith('/'):
-        episodeDir += "/"
-
-    episodeLink = generateLink(config['episodeDir'], os.path.basename(mp3File))
+    episodeLink = episodeGuid(config, mp3File)
 
     addSubElement(item, 'guid', episodeLink)
 
@@ -137,161 +644,449 @@ def addEpisode(config, title, desc, mp3File, duration):
                   length=str(byteLength),
                   type="audio/mpeg3")
 
-    # Now generate the XML
-    generateXml(config, item)
-
+    return item
 
-def getOldEpisodes(config, rss, chan, namespaces):
-    """Copy old episodes into the new RSS feed and set the attributes."""
-    # Indicates items are to be added. Needed to know whether or not to
-    # manually add namespaces. Yes, it is wonky. A side effect of the way
-    # ElementTree adds namespaces.
-    itemsAdded = False
-    # Return value for the old episode elements which can be empty
-    # if no old episodes exist
-    items = None
-    # Return value for the first year of publication as indicated by the
-    # `pubDate` on the earliest episode. Used for generating the copyright
-    # string. Can be empty if no old episodes exist.
-    firstYear = None
 
-    xmlFilepath = config['xmlFilepath']
-
-    if os.path.isfile(xmlFilepath):
-        # Load and strip the XML
-        with open(xmlFilepath, 'r') as f:
-            xmlStr = ''
-            for line in f:
-                # strip leading and trailing whitespace so minidom can prettify
-                # without adding extraenous new lines
-                xmlStr += line.lstrip().rstrip()
+def readEpisodes(xmlFilepath):
+    """Yield the items of an existing feed one at a time.
 
-        # Parse the XML
-        rssPrev = ET.ElementTree()
+    The feed is parsed incrementally, so only the item being handled is held
+    in memory: each one is cleared and dropped from the tree once the caller
+    is done with it. The parser expands prefixes into `{uri}name`, so the
+    prefixes are put back to let each item serialize without its own
+    namespace declarations.
+    """
+    chan = None
 
+    with open(xmlFilepath, 'rb') as f:
         try:
-            rssPrev = ET.ElementTree(ET.fromstring(xmlStr))
-        except:
-            logger.fatal("Unable to parse \'" + xmlFilepath + "\'")
-            exit(1)
+            for event, elem in ET.iterparse(f, events=('start', 'end')):
+                if event == 'start':
+                    if elem.tag == 'channel':
+                        chan = elem
+                    continue
+
+                if elem.tag != 'item':
+                    continue
+
+                for child in elem.iter():
+                    child.tag = prefixTag(child.tag)
+
+                yield elem
+
+                # Done with the item
+                elem.clear()
+                if chan is not None:
+                    chan.remove(elem)
+        except ET.ParseError:
+            raise errors.FeedError("Unable to parse \'" + xmlFilepath + "\'")
+
+
+def feedFragments(index, xmlFilepath):
+    """Yield the items of an existing feed, reusing their serialized bytes.
+
+    The items are found with the offsets in the episode `index`: each one
+    spans from its offset to the next one (the last one up to the tag after
+    its end), and the file is read one item at a time. The ones whose bytes
+    still have the hash recorded when PenPen wrote them are yielded as
+    Fragments, which `writeXml` copies as is. The others (edited by hand, or
+    written before hashes were recorded) are parsed and yielded as elements.
+    If the items aren't where the index says, the whole feed is parsed (see
+    `readEpisodes`).
+    """
+    pad = (INDENT * ITEM_LEVEL).encode('utf-8')
+
+    with open(xmlFilepath, 'rb') as f:
+        header = fragmentHeader(f, index)
 
-        # Find all the items and append them to the new tree
-        items = rssPrev.getroot().findall('channel/item', namespaces)
+        if header is None:
+            for item in readEpisodes(xmlFilepath):
+                yield item
+            return
 
-        # Append found items and add appropriate namespaces
-        if items:
-            # Indicate items are to be added
-            itemsAdded = True
+        # Declared the same way as in the feed
+        rootTag = RSS_START_RE.search(header).group(0)
+        rows = episodeIndex.feedRecords(index)
+        record, sha256 = next(rows)
 
-            # Items do not carry an Atom namespace element, so add it manually
-            rss.set("xmlns:atom", "http://www.w3.org/2005/Atom")
+        while record is not None:
+            nextRecord, nextSha256 = next(rows, (None, None))
 
-        # Find the earliest `lastBuildDate` to determine copyright
-        pubDates = rssPrev.getroot().findall('channel/item/pubDate',
-                                             namespaces)
+            if nextRecord is not None:
+                data = f.read(nextRecord[6] - record[6])
+            else:
+                # Items being archived may still follow the last one
+                data = readItem(f)
 
-        for pubDate in pubDates:
-            # Parse out the year
-            year = re.findall(r" \d{4} ", pubDate.text)[0].lstrip().rstrip()
+            # The indentation of the next line belongs to the next item
+            fragment = pad + data.rstrip(b' \t')
 
-            # Set the year if empty or lower
-            if not firstYear:
-                firstYear = year
+            if sha256 == hashlib.sha256(fragment).hexdigest():
+                yield Fragment(fragment, record)
             else:
-                if int(year) < int(firstYear):
-                    firstYear = year
+                try:
+                    root = ET.fromstring(rootTag + data + b'</rss>')
+                except ET.ParseError:
+                    raise errors.FeedError("Unable to parse \'" +
+                                           xmlFilepath + "\'")
 
-    # No items were added, then add all namespace attributes manually.
-    if not itemsAdded:
-        for prefix, uri in namespaces.items():
-            rss.set("xmlns:" + prefix, uri)
+                for item in root.iter('item'):
+                    for child in item.iter():
+                        child.tag = prefixTag(child.tag)
+
+                    yield item
+
+            record, sha256 = nextRecord, nextSha256
+
+
+def readItem(f):
+    """Read the item `f` is at, up to the tag that follows it.
 
-    return items, firstYear
+    Only the item is read, not the rest of the feed: once episodes are
+    archived, their items follow the last one in the index until the feed
+    is rewritten.
+    """
+    endTag = b'</item>'
+    data = b''
+    end = -1
+
+    while True:
+        chunk = f.read(SCAN_CHUNK_SIZE)
+
+        # The end tag may straddle chunks
+        start = max(0, len(data) - len(endTag))
+        data += chunk
+
+        if end < 0:
+            end = data.find(endTag, start)
+
+        if end >= 0:
+            nextTag = data.find(b'<', end + len(endTag))
+
+            if nextTag >= 0:
+                return data[:nextTag]
+
+        if not chunk:
+            return data
+
+
+def fragmentHeader(f, index):
+    """Return the bytes of the feed `f` before its first item.
+
+    `f` is left at the first item. Return None if the index has no items or
+    they aren't where it says: every offset must be the start of an item,
+    and nothing before the first one may be an item.
+    """
+    first = None
+
+    for offset in episodeIndex.feedOffsets(index):
+        if first is None:
+            first = offset
+
+        f.seek(offset)
+
+        if f.read(5) != b'<item':
+            return None
+
+    if first is None:
+        return None
+
+    f.seek(0)
+    header = f.read(first)
 
+    if len(header) != first or not RSS_START_RE.search(header) or \
+            ITEM_START_RE.search(header):
+        return None
 
-def writeXmlFile(config, rss):
-    """Write the XML file to disk."""
+    return header
+
+
+@metrics.stage('rss.writeXmlFile')
+def writeXmlFile(config, rss, records=None, oldEpisodeLimit=None, index=None,
+                 fragments=None, removed=()):
+    """Write the XML file to disk.
+
+    The items of the previous feed (only the newest `oldEpisodeLimit` if it
+    is set, without those whose guid is in `removed`) are streamed in after
+    the items of `rss`. With the episode
+    `index`, the old items that didn't change are copied as is (see
+    `feedFragments`). If `records` is a list, an index record is appended
+    to it for every item written. If `fragments` is a dict, the SHA-256 of
+    the bytes of every item serialized is added to it by guid.
+    """
+    def writeContents(f, original):
+        oldEpisodes = ()
+
+        if original:
+            oldEpisodes = readEpisodes(original) if index is None else \
+                feedFragments(index, original)
+
+        if removed:
+            oldEpisodes = (item for item in oldEpisodes
+                           if itemGuid(item) not in removed)
+
+        writeXml(f, rss, itertools.islice(oldEpisodes, oldEpisodeLimit),
+                 records, fragments)
+
+    writeFeed(config, writeContents)
+
+
+def writeFeed(config, writeContents):
+    """Back up the feed, then replace it with `writeContents(f, original)`.
+
+    The new feed is written to a temporary file, synced to disk, and renamed
+    over the old one, so a failed write never leaves a partial feed behind.
+    `original` is the path of the previous feed (or an empty string if there
+    wasn't one), which is left untouched until the rename.
+    """
     # Create a backup first
-    xmlBackupFilepath = createBackup(config)
+    createBackup(config)
 
-    # Overwrite the file
     xmlFilepath = config['xmlFilepath']
+    original = xmlFilepath if os.path.isfile(xmlFilepath) else ''
+
+    replaceFeed(config, lambda f: writeContents(f, original))
+
+
+def replaceFeed(config, writeContents):
+    """Replace the feed with `writeContents(f)` atomically, then its variants.
+
+    Everything that replaces the feed goes through here, so that the
+    compressed copies and the sidecar (see `writeFeedVariants`) always match
+    it.
+    """
     try:
-        with open(xmlFilepath, 'w') as f:
-            f.write(prettifyXml(rss))
+        fileUtils.writeAtomic(config['xmlFilepath'], writeContents)
     except:
-        # Delete the generated file
+        logger.error("XML write failed. The original feed is unchanged.")
+        raise
+
+    logger.info("Saved new XML => " + config['xmlFilepath'])
+
+    writeFeedVariants(config)
+
+
+@metrics.stage('rss.writeFeedVariants')
+def writeFeedVariants(config):
+    """Write the precompressed copies of the feed and its validator sidecar.
+
+    `xmlFilepath`.gz is written unless `precompressFeed` is "no", and
+    `xmlFilepath`.br is written if `feedBrotli` is "yes" and the brotli
+    module is installed. The sidecar (`xmlFilepath`.meta) is a JSON document
+    with a strong ETag (from the content hash) and the size of every
+    variant, and the Last-Modified time taken from `lastBuildDate`.
+    """
+    xmlFilepath = config['xmlFilepath']
+    contentHash = hashlib.sha256()
+    copyFile(xmlFilepath, contentHash.update)
+
+    digest = contentHash.hexdigest()[:32]
+    variants = {'identity': {'etag': '"%s"' % digest,
+                             'size': os.path.getsize(xmlFilepath)}}
+
+    if config.get('precompressFeed', 'yes').lower() != 'no':
+        def writeGzip(f):
+            with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=9,
+                               mtime=0) as gz:
+                copyFile(xmlFilepath, gz.write)
+
+        fileUtils.writeAtomic(xmlFilepath + GZIP_SUFFIX, writeGzip)
+        variants['gzip'] = {'etag': '"%s-gz"' % digest,
+                            'size': os.path.getsize(xmlFilepath +
+                                                    GZIP_SUFFIX)}
+
+    if config.get('feedBrotli', 'no').lower() == 'yes':
+        # Brotli is optional, only needed (and loaded) for `feedBrotli`
         try:
-            os.remove(xmlFilepath)
-        except:
-            logger.warning("Could not remove the generated file \`" +
-                           xmlFilepath + "\`")
-
-        # If a backup exists, restore the original file
-        if os.path.isfile(xmlBackupFilepath):
-            try:
-                shutil.copy(xmlBackupFilepath, xmlFilepath)
-            except:
-                logger.error("XML write and backup restore both failed.")
-                raise
-
-            logger.error("XML write failed. Backup has been restored.")
+            import brotli
+        except ImportError:
+            brotli = None
+
+        if brotli is None:
+            logger.warning("Brotli is not installed (pip install " +
+                           "penpen[brotli]). Skipping \'" + xmlFilepath +
+                           BROTLI_SUFFIX + "\'.")
         else:
-            logger.error("XML write failed. No backups to restore.")
+            def writeBrotli(f):
+                compressor = brotli.Compressor(quality=11)
+                copyFile(xmlFilepath,
+                         lambda data: f.write(compressor.process(data)))
+                f.write(compressor.finish())
 
-        raise
+            fileUtils.writeAtomic(xmlFilepath + BROTLI_SUFFIX, writeBrotli)
+            variants['br'] = {'etag': '"%s-br"' % digest,
+                              'size': os.path.getsize(xmlFilepath +
+                                                      BROTLI_SUFFIX)}
 
-    logger.info("Saved new XML => " + config['xmlFilepath'])
+    meta = {'contentType': 'application/rss+xml; charset=utf-8',
+            'lastModified': lastModified(xmlFilepath),
+            'variants': variants}
+
+    fileUtils.writeAtomic(xmlFilepath + fileUtils.META_SUFFIX,
+                          lambda f: f.write(json.dumps(meta, indent=2,
+                                                       sort_keys=True)
+                                            .encode('utf-8')))
+
+
+def lastModified(xmlFilepath):
+    """Return the feed's `lastBuildDate` as an HTTP date (or None)."""
+    header, _ = readFeedHeader(xmlFilepath)
+    match = re.search(br'<lastBuildDate>([^<]*)</lastBuildDate>',
+                      header or b'')
+
+    if not match:
+        return None
 
+    # RSS dates use "UT", HTTP dates use "GMT"
+    return re.sub(r' UTC?$', ' GMT', match.group(1).decode('utf-8').strip())
 
+
+def copyFile(filepath, write):
+    """Pass the contents of a file to `write` in chunks."""
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(SCAN_CHUNK_SIZE), b''):
+            write(chunk)
+
+
+@metrics.stage('rss.backup')
 def createBackup(config):
     """Create a backup of the XML file.
 
-    Return the location of the backup file so that we can restore it upon
-    a write failure.
+    The feed is stored as a snapshot in the deduplicated backup store in
+    `rssBackupDir`, then old snapshots are pruned according to the retention
+    settings. Return the name of the snapshot.
     """
     xmlFilepath = config['xmlFilepath']
 
     # Only make a backup if an XML already exists
     if os.path.isfile(xmlFilepath):
-        # Create the XML backup directory if it doesn't already exist
         backupDir = config["rssBackupDir"]
 
-        try:
-            os.makedirs(backupDir)
-        except OSError:
-            if not os.path.isdir(backupDir):
-                raise
-
-        # Construct the copy destination filename
-        timeStr = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")
-        base = os.path.basename(xmlFilepath)
-
-        xmlBackupFilepath = "%s/%s_%s.xml" % (backupDir,
-                                              os.path.splitext(base)[0],
-                                              timeStr)
+        name = backupStore.createSnapshot(backupDir, xmlFilepath)
+        logger.info("Creating backup XML => " + name)
 
-        try:
-            shutil.copy(xmlFilepath, xmlBackupFilepath)
-            logger.info("Creating backup XML => " + xmlBackupFilepath)
-        except:
-            raise
+        backupStore.applyRetention(config, backupDir)
 
-        return xmlBackupFilepath
+        return name
     else:
-        # Return an empty string that will fail `os.path.isfile()`
+        # Return an empty string
         return ''
 
 
-def prettifyXml(elem):
-    """Return a pretty-printed XML string for the Element.
+def writeXml(f, rss, moreItems=(), records=None, fragments=None):
+    """Write the XML to the file handle one element at a time.
 
-    Minidom also serves as our validator since it will throw an error if
-    the string is not well formed.
+    The root and the channel tags are written directly, then each channel
+    element of `rss` followed by each of `moreItems` is serialized and
+    written on its own. `moreItems` may also hold Fragments, which are
+    written as is. If `records` is a list, an index record is appended to it
+    for every item along with its offset in the file. If `fragments` is a
+    dict, the SHA-256 of every item serialized is added to it by guid.
+
+    The output is fed through an expat parser before it is written, which
+    serves as our validator: an error is raised if the document is not well
+    formed, without building a second copy of the feed. Fragments were
+    checked when they were first written and are skipped.
     """
-    uglyStr = ET.tostring(elem, 'utf-8')
-    reparsedStr = xml.dom.minidom.parseString(uglyStr)
-    return reparsedStr.toprettyxml(indent="  ", encoding="utf-8")
+    parser = xml.parsers.expat.ParserCreate()
+
+    def write(data):
+        parser.Parse(data, False)
+        f.write(data)
+
+    chan = rss.find('channel')
+
+    write(XML_DECLARATION)
+    write(startTag(rss, 0))
+    write(startTag(chan, 1))
+
+    for elem in itertools.chain(chan, moreItems):
+        offset = f.tell() + len(INDENT * ITEM_LEVEL)
+
+        if isinstance(elem, Fragment):
+            if records is not None:
+                records.append(elem.record[:6] + (offset, 0))
+
+            f.write(elem.data)
+            continue
+
+        data = serializeElement(elem, ITEM_LEVEL)
+
+        if elem.tag == 'item':
+            if records is not None:
+                records.append(episodeIndex.recordFromElement(elem, offset))
+
+            if fragments is not None:
+                fragments[elem.findtext('guid')] = \
+                    hashlib.sha256(data).hexdigest()
+
+        write(data)
+
+    write(endTag(chan, 1))
+    write(endTag(rss, 0))
+    parser.Parse(b'', True)
+
+
+def startTag(elem, level):
+    """Return the indented start tag of an element on its own line."""
+    attrs = ''.join(' %s=%s' % (key, quoteAttr(value))
+                    for key, value in elem.attrib.items())
+
+    return ("%s<%s%s>\n" % (INDENT * level, elem.tag, attrs)).encode('utf-8')
+
+
+def escapeText(text):
+    """Escape `&`, `<` and `>` in character data.
+
+    Same as `xml.sax.saxutils.escape`, which isn't used because importing it
+    loads `urllib.request` (and with it `http` and `email`).
+    """
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def quoteAttr(value):
+    """Escape and double quote an attribute value."""
+    value = escapeText(value).replace('"', "&quot;")
+
+    return '"' + value.replace("\n", "&#10;").replace("\r", "&#13;") \
+        .replace("\t", "&#9;") + '"'
+
+
+def endTag(elem, level):
+    """Return the indented end tag of an element on its own line."""
+    return ("%s</%s>\n" % (INDENT * level, elem.tag)).encode('utf-8')
+
+
+def checkWellFormed(data):
+    """Raise an error if `data` is not a well formed XML document."""
+    xml.parsers.expat.ParserCreate().Parse(data, True)
+
+
+def serializeElement(elem, level):
+    """Serialize an element indented as if it were `level` deep in the feed.
+
+    The output matches `writeXml` so it can be spliced into a feed.
+    """
+    indentElement(elem, level)
+    elem.tail = None
+
+    return (INDENT * level + ET.tostring(elem, encoding='unicode') +
+            "\n").encode('utf-8')
+
+
+def indentElement(elem, level):
+    """Set the text and tails of an element's children for pretty printing."""
+    childPad = "\n" + INDENT * (level + 1)
+
+    if len(elem):
+        elem.text = childPad
+
+        for child in elem:
+            indentElement(child, level + 1)
+            child.tail = childPad
+
+        # The last child closes the parent at the parent's indentation
+        child.tail = "\n" + INDENT * level
 
 
 def addSubElement(element, tag, value):
@@ -310,6 +1105,11 @@ def addSubElementFromConfig(element, tag, config, key):
         logger.warning("Key \'" + key + "\' was not found in the conf file.")
 
 
+def episodeGuid(config, mp3File):
+    """Return the public link to an episode, which also serves as its guid."""
+    return generateLink(config['episodeDir'], os.path.basename(mp3File))
+
+
 def generateLink(folder, filename):
     """Generate a web link from a folder and a filename."""
     if not folder.endswith('/'):
@@ -330,12 +1130,15 @@ def generateCopyrightStr(config, firstYear):
         copyrightStr = "©" + firstYear + "—" + thisYear + " " + \
                        config['rssAuthor'] + ". All rights reserved."
 
-    return str(copyrightStr, 'utf-8')
+    return copyrightStr
+
 
+def getFormattedUtcTime(utcTime=None):
+    """Get a UTC time (default: now) formatted to the XML specification."""
+    if utcTime is None:
+        utcTime = datetime.datetime.utcnow()
 
-def getFormattedUtcTime():
-    """Get the current time in UTC formatted to the XML specification."""
     # Formatting must conform to RFC 822 (Section 5.1). Notably, UTC is
     # abbreviated UT, because the world has not suffered enough.
-    timeStr = datetime.datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S")
+    timeStr = utcTime.strftime("%a, %d %b %Y %H:%M:%S")
     return timeStr + " UT"
@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+"""Serve the feed and the episodes over HTTP for local testing.
+
+The feed directory is served under the path of `rssDir` and the episode
+directory under the path of `episodeDir`, so the links in the feed work as
+is when both point at this server. Only feeds, episodes and images are
+served.
+
+Responses carry an ETag and Last-Modified and answer conditional requests
+(If-None-Match, If-Modified-Since) with 304. The feed's validators come from
+its sidecar (see `rss.writeFeedVariants`), and its precompressed copies are
+sent to clients that accept them. Single byte ranges are supported for
+seeking in episodes; other Range headers are ignored and the whole file is
+sent. Files are sent with `loop.sendfile`, which uses
+`os.sendfile` to skip copying the bytes through userspace.
+"""
+
+import asyncio
+import email.utils
+import json
+import logging
+import os
+import re
+import time
+
+try:
+    from urllib.parse import unquote, urlsplit
+except ImportError:
+    from urllib import unquote
+    from urlparse import urlsplit
+
+from . import fileUtils
+from . import rss
+
+logger = logging.getLogger(__name__)
+
+# Content types of the files that are served
+CONTENT_TYPES = {'.xml': 'application/rss+xml; charset=utf-8',
+                 '.mp3': 'audio/mpeg',
+                 '.jpg': 'image/jpeg',
+                 '.jpeg': 'image/jpeg',
+                 '.png': 'image/png'}
+
+# Precompressed feed variants, in order of preference
+ENCODINGS = (('br', rss.BROTLI_SUFFIX), ('gzip', rss.GZIP_SUFFIX))
+
+# Seconds to wait for a request on an idle connection
+IDLE_TIMEOUT = 30
+
+# Largest request head accepted
+MAX_HEAD_SIZE = 16384
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+REASONS = {200: 'OK', 206: 'Partial Content', 304: 'Not Modified',
+           400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed',
+           416: 'Range Not Satisfiable'}
+
+
+def serve(config, host, port, episodeDir):
+    """Serve the feed and episodes until interrupted."""
+    mounts = getMounts(config, episodeDir)
+
+    for prefix, directory in mounts:
+        logger.info("Serving \'" + directory + "\' at http://%s:%d%s" %
+                    (host, port, prefix))
+
+    async def handler(reader, writer):
+        await handleClient(reader, writer, mounts)
+
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(
+        asyncio.start_server(handler, host, port, limit=MAX_HEAD_SIZE,
+                             backlog=1024))
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopping...")
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+
+
+def getMounts(config, episodeDir):
+    """Return (url path prefix, local directory) pairs, longest first."""
+    feedDir = os.path.dirname(os.path.abspath(config['xmlFilepath']))
+    mounts = [(urlPath(config['rssDir']), feedDir),
+              (urlPath(config['episodeDir']), os.path.abspath(episodeDir))]
+
+    return sorted(mounts, key=lambda mount: -len(mount[0]))
+
+
+def urlPath(url):
+    """Return the path of a URL with a trailing slash."""
+    path = urlsplit(url).path or '/'
+    return path if path.endswith('/') else path + '/'
+
+
+def resolvePath(mounts, path):
+    """Map a request path to a file we are willing to serve (or None)."""
+    for prefix, directory in mounts:
+        if not path.startswith(prefix):
+            continue
+
+        name = path[len(prefix):]
+
+        # Only plain file names of known types, nothing hidden or nested
+        if not name or '/' in name or '\\' in name or name.startswith('.'):
+            continue
+
+        if os.path.splitext(name)[1].lower() not in CONTENT_TYPES:
+            continue
+
+        filepath = os.path.join(directory, name)
+
+        if os.path.isfile(filepath):
+            return filepath
+
+    return None
+
+
+async def handleClient(reader, writer, mounts):
+    """Answer requests on a connection until it is closed or idle."""
+    try:
+        while True:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                              IDLE_TIMEOUT)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                    asyncio.TimeoutError, ConnectionError, ValueError):
+                break
+
+            request = parseRequest(head)
+
+            if request is None:
+                await sendResponse(writer, 400, {}, keepAlive=False)
+                break
+
+            method, path, version, headers = request
+            keepAlive = wantsKeepAlive(version, headers)
+
+            await respond(writer, method, path, headers, mounts, keepAlive)
+
+            if not keepAlive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def parseRequest(head):
+    """Parse a request head into (method, path, version, headers)."""
+    try:
+        lines = head.decode('iso-8859-1').split('\r\n')
+        method, target, version = lines[0].split(' ')
+    except ValueError:
+        return None
+
+    headers = {}
+
+    for line in lines[1:]:
+        if ':' in line:
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+
+    return method, unquote(urlsplit(target).path), version, headers
+
+
+def wantsKeepAlive(version, headers):
+    """Check whether the connection should stay open after the response."""
+    connection = headers.get('connection', '').lower()
+
+    if version == 'HTTP/1.1':
+        return connection != 'close'
+
+    return connection == 'keep-alive'
+
+
+async def respond(writer, method, path, headers, mounts, keepAlive):
+    """Send the response to a single request."""
+    if method not in ('GET', 'HEAD'):
+        await sendResponse(writer, 405, {'Allow': 'GET, HEAD'}, keepAlive)
+        return
+
+    filepath = resolvePath(mounts, path)
+
+    if filepath is None:
+        await sendResponse(writer, 404, {}, keepAlive)
+        return
+
+    # The file is kept open from here, in case it is deleted meanwhile
+    try:
+        filepath, respHeaders = representation(filepath, headers)
+        f = open(filepath, 'rb')
+    except (IOError, OSError):
+        await sendResponse(writer, 404, {}, keepAlive)
+        return
+
+    with f:
+        size = os.fstat(f.fileno()).st_size
+
+        if notModified(headers, respHeaders):
+            del respHeaders['Content-Type']
+            await sendResponse(writer, 304, respHeaders, keepAlive)
+            return
+
+        # Byte ranges only apply to the unencoded file
+        status, offset, count = 200, 0, size
+        rangeHeader = headers.get('range')
+
+        if rangeHeader and 'Content-Encoding' not in respHeaders and \
+                ifRangeMatches(headers, respHeaders):
+            byteRange = parseRange(rangeHeader, size)
+
+            if byteRange is not None and byteRange[1] == 0:
+                respHeaders['Content-Range'] = 'bytes */%d' % size
+                await sendResponse(writer, 416, respHeaders, keepAlive)
+                return
+
+            if byteRange is not None:
+                offset, count = byteRange
+                status = 206
+                respHeaders['Content-Range'] = 'bytes %d-%d/%d' % (
+                    offset, offset + count - 1, size)
+
+        respHeaders['Content-Length'] = str(count)
+        await sendResponse(writer, status, respHeaders, keepAlive,
+                           body=f if method == 'GET' else None,
+                           offset=offset, count=count)
+
+
+def representation(filepath, headers):
+    """Pick the file to send and the headers describing it.
+
+    Feeds with a sidecar use its validators and may be sent precompressed.
+    Anything else gets validators from its size and modification time.
+    """
+    ext = os.path.splitext(filepath)[1].lower()
+    respHeaders = {'Content-Type': CONTENT_TYPES[ext],
+                   'Accept-Ranges': 'bytes'}
+    meta = readMeta(filepath)
+
+    if meta is None:
+        stat = os.stat(filepath)
+        respHeaders['ETag'] = '"%x-%x"' % (stat.st_size,
+                                           int(stat.st_mtime * 1000))
+        respHeaders['Last-Modified'] = email.utils.formatdate(stat.st_mtime,
+                                                              usegmt=True)
+        return filepath, respHeaders
+
+    variants = meta['variants']
+    accepted = [e.split(';')[0].strip().lower()
+                for e in headers.get('accept-encoding', '').split(',')]
+    respHeaders['Vary'] = 'Accept-Encoding'
+    respHeaders['ETag'] = variants['identity']['etag']
+
+    if meta.get('lastModified'):
+        respHeaders['Last-Modified'] = meta['lastModified']
+
+    for encoding, suffix in ENCODINGS:
+        if encoding in accepted and encoding in variants and \
+                os.path.isfile(filepath + suffix):
+            respHeaders['Content-Encoding'] = encoding
+            respHeaders['ETag'] = variants[encoding]['etag']
+            return filepath + suffix, respHeaders
+
+    return filepath, respHeaders
+
+
+def readMeta(filepath):
+    """Return the feed sidecar of a file, or None if it doesn't have one."""
+    try:
+        with open(filepath + fileUtils.META_SUFFIX) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def notModified(headers, respHeaders):
+    """Check the conditional request headers against the validators."""
+    ifNoneMatch = headers.get('if-none-match')
+
+    if ifNoneMatch is not None:
+        tags = [tag.strip() for tag in ifNoneMatch.split(',')]
+        return '*' in tags or respHeaders['ETag'] in tags or \
+            'W/' + respHeaders['ETag'] in tags
+
+    ifModifiedSince = headers.get('if-modified-since')
+    lastModified = respHeaders.get('Last-Modified')
+
+    if ifModifiedSince and lastModified:
+        since = email.utils.parsedate_tz(ifModifiedSince)
+        modified = email.utils.parsedate_tz(lastModified)
+
+        if since and modified:
+            return email.utils.mktime_tz(modified) <= \
+                email.utils.mktime_tz(since)
+
+    return False
+
+
+def ifRangeMatches(headers, respHeaders):
+    """Check whether a Range header applies, given If-Range.
+
+    If-Range holds either an ETag or a date, which must be exactly the
+    Last-Modified of the file. Otherwise the whole file is sent.
+    """
+    ifRange = headers.get('if-range')
+
+    if ifRange is None:
+        return True
+
+    if ifRange.startswith(('"', 'W/')):
+        return ifRange == respHeaders['ETag']
+
+    since = email.utils.parsedate_tz(ifRange)
+    lastModified = respHeaders.get('Last-Modified')
+    modified = email.utils.parsedate_tz(lastModified) if lastModified \
+        else None
+
+    if not since or not modified:
+        return False
+
+    return email.utils.mktime_tz(since) == email.utils.mktime_tz(modified)
+
+
+def parseRange(rangeHeader, size):
+    """Parse a single byte range into (offset, count).
+
+    The count is 0 if the range lies past the end of the file. Return None
+    if the header isn't a single valid byte range, so that it is ignored.
+    """
+    match = RANGE_RE.match(rangeHeader.strip())
+
+    if not match:
+        return None
+
+    start, end = match.groups()
+
+    if start:
+        start = int(start)
+
+        if end and int(end) < start:
+            return None
+
+        end = min(int(end), size - 1) if end else size - 1
+    elif end:
+        # Suffix range: the last `end` bytes
+        start = max(0, size - int(end))
+        end = size - 1
+    else:
+        return None
+
+    if start >= size or end < start:
+        return 0, 0
+
+    return start, end - start + 1
+
+
+async def sendResponse(writer, status, headers, keepAlive, body=None,
+                       offset=0, count=0):
+    """Write the status line and headers, then the body from a file."""
+    headers = dict(headers)
+    headers.setdefault('Content-Length', '0')
+    headers['Date'] = email.utils.formatdate(time.time(), usegmt=True)
+    headers['Server'] = 'PenPen'
+    headers['Connection'] = 'keep-alive' if keepAlive else 'close'
+
+    head = "HTTP/1.1 %d %s\r\n" % (status, REASONS[status])
+    head += "".join("%s: %s\r\n" % item for item in headers.items())
+    writer.write((head + "\r\n").encode('iso-8859-1'))
+    await writer.drain()
+
+    if body is not None and count:
+        loop = asyncio.get_running_loop()
+        await loop.sendfile(writer.transport, body, offset, count)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""Check the feed, its archive pages and its sidecar without changing them.
+
+The files are read once with a streaming expat parser, so this is cheap
+enough to run from cron or a hook. Problems found:
+
+- files that aren't well-formed XML;
+- a missing `rss`/`channel` root, or channel `title`, `link` and
+  `description`;
+- items without a `title`, `guid`, `pubDate` or a complete `enclosure`;
+- the same guid published twice (across the feed and its archive pages);
+- a `.meta` sidecar whose ETag doesn't match the feed any more.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import xml.parsers.expat
+
+from . import episodeIndex
+from . import fileUtils
+
+logger = logging.getLogger(__name__)
+
+# Size of the reads used when parsing
+READ_CHUNK_SIZE = 65536
+
+REQUIRED_CHANNEL_TAGS = ('title', 'link', 'description')
+REQUIRED_ITEM_TAGS = ('title', 'guid', 'pubDate')
+REQUIRED_ENCLOSURE_ATTRS = ('url', 'length', 'type')
+
+
+def validateFeed(config):
+    """Return (problems, number of episodes) for the feed in `config`."""
+    xmlFilepath = config['xmlFilepath']
+
+    if not os.path.isfile(xmlFilepath):
+        return ["\'" + xmlFilepath + "\' does not exist."], 0
+
+    problems = []
+    guids = {}
+    filepaths = [xmlFilepath]
+
+    page = 1
+    while os.path.isfile(episodeIndex.archiveFilepath(xmlFilepath, page)):
+        filepaths.append(episodeIndex.archiveFilepath(xmlFilepath, page))
+        page += 1
+
+    for filepath in filepaths:
+        digest = checkFile(filepath, guids, problems)
+
+        if filepath == xmlFilepath:
+            checkSidecar(xmlFilepath, digest, problems)
+
+    for guid, seen in sorted(guids.items()):
+        if len(seen) > 1:
+            problems.append("Episode \'" + guid + "\' is published " +
+                            "%d times (%s)." % (len(seen), ", ".join(seen)))
+
+    return problems, len(guids)
+
+
+def checkFile(filepath, guids, problems):
+    """Check one feed file. Return the SHA-256 (hex) of its contents."""
+    name = os.path.basename(filepath)
+    parser = xml.parsers.expat.ParserCreate()
+    digest = hashlib.sha256()
+    # Element names from the root down to the current one
+    path = []
+    state = {'channel': False, 'channelTags': set(), 'item': None,
+             'itemLine': 0}
+
+    def startElement(tag, attrs):
+        path.append(tag)
+
+        if len(path) == 1 and tag != 'rss':
+            problems.append(name + ": the root element is \'" + tag +
+                            "\', not \'rss\'.")
+        elif len(path) == 2 and tag == 'channel':
+            state['channel'] = True
+        elif len(path) == 3 and path[1] == 'channel':
+            state['channelTags'].add(tag)
+
+            if tag == 'item':
+                state['item'] = {'tags': set(), 'guid': ''}
+                state['itemLine'] = parser.CurrentLineNumber
+        elif len(path) == 4 and state['item'] is not None:
+            state['item']['tags'].add(tag)
+
+            if tag == 'enclosure':
+                missing = [a for a in REQUIRED_ENCLOSURE_ATTRS
+                           if not attrs.get(a)]
+
+                if missing:
+                    problems.append(name + ":%d: the enclosure has no %s." %
+                                    (parser.CurrentLineNumber,
+                                     ", ".join(missing)))
+
+    def endElement(tag):
+        if len(path) == 3 and tag == 'item' and state['item'] is not None:
+            item = state['item']
+            missing = [t for t in REQUIRED_ITEM_TAGS + ('enclosure',)
+                       if t not in item['tags']]
+
+            if missing:
+                problems.append(name + ":%d: the item has no %s." %
+                                (state['itemLine'], ", ".join(missing)))
+
+            guid = item['guid'].strip()
+
+            if guid:
+                guids.setdefault(guid, []).append(name)
+
+            state['item'] = None
+
+        path.pop()
+
+    def characterData(data):
+        if len(path) == 4 and path[3] == 'guid' and \
+                state['item'] is not None:
+            state['item']['guid'] += data
+
+    parser.StartElementHandler = startElement
+    parser.EndElementHandler = endElement
+    parser.CharacterDataHandler = characterData
+
+    try:
+        with open(filepath, 'rb') as f:
+            while True:
+                chunk = f.read(READ_CHUNK_SIZE)
+                digest.update(chunk)
+                parser.Parse(chunk, not chunk)
+
+                if not chunk:
+                    break
+    except xml.parsers.expat.ExpatError as e:
+        problems.append(name + ": not well-formed XML (" + str(e) + ").")
+        return digest.hexdigest()
+
+    if not state['channel']:
+        problems.append(name + ": there is no channel.")
+    else:
+        missing = [t for t in REQUIRED_CHANNEL_TAGS
+                   if t not in state['channelTags']]
+
+        if missing:
+            problems.append(name + ": the channel has no %s." %
+                            ", ".join(missing))
+
+    return digest.hexdigest()
+
+
+def checkSidecar(xmlFilepath, digest, problems):
+    """Check that the sidecar's ETag was made from the current feed."""
+    metaFilepath = xmlFilepath + fileUtils.META_SUFFIX
+
+    if not os.path.isfile(metaFilepath):
+        return
+
+    try:
+        with open(metaFilepath) as f:
+            etag = json.load(f)['variants']['identity']['etag']
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        problems.append(os.path.basename(metaFilepath) + " can't be read.")
+        return
+
+    if etag.strip('"') != digest[:len(etag.strip('"'))]:
+        problems.append(os.path.basename(metaFilepath) + " is out of date. " +
+                        "Run \'penpen rebuild\' to refresh it.")
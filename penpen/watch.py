@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+"""Watch a drop folder and publish new recordings as they arrive.
+
+New WAV and MP3 files are picked up once they have been completely written
+(inotify `IN_CLOSE_WRITE`/`IN_MOVED_TO` on Linux, otherwise the size and
+modification time must stay the same for `settle` seconds). They are
+transcoded and tagged on a pool of workers, and episodes that finish close
+together are published with a single feed rewrite.
+
+The episode title is the file name without its extension and the
+description is the same as the title, unless a text file with the same name
+(e.g. "episode.txt" for "episode.wav") exists. Its first line is then the
+title and the rest is the description.
+
+The MP3s of renditions (see `audio.renditions`) are ignored when they land
+in the folder: MP3s whose name ends with the `mp3Suffix` of a rendition.
+"""
+
+import concurrent.futures
+import ctypes
+import ctypes.util
+import logging
+import multiprocessing
+import os
+import select
+import signal
+import struct
+import time
+
+from . import audio
+from . import core
+from . import episodeIndex
+from . import errors
+from . import fileUtils
+from . import rss
+
+logger = logging.getLogger(__name__)
+
+# inotify event masks (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+# struct inotify_event without the trailing name
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class InotifyWatcher(object):
+    """Report files closed after writing, or moved into the directory."""
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+        self.directory = directory
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        wd = libc.inotify_add_watch(self.fd,
+                                    os.fsencode(directory),
+                                    IN_CLOSE_WRITE | IN_MOVED_TO)
+
+        if wd < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+    def poll(self, timeout):
+        """Wait up to `timeout` seconds and return the completed files."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+
+        if not readable:
+            return []
+
+        data = os.read(self.fd, 65536)
+        paths = []
+        pos = 0
+
+        while pos < len(data):
+            _, _, _, length = INOTIFY_EVENT.unpack_from(data, pos)
+            pos += INOTIFY_EVENT.size
+            name = data[pos:pos + length].rstrip(b'\0')
+            pos += length
+
+            if name:
+                paths.append(os.path.join(self.directory, os.fsdecode(name)))
+
+        return paths
+
+    def close(self):
+        """Stop watching."""
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """Report files whose size and mtime haven't changed for `settle` secs."""
+
+    def __init__(self, directory, settle):
+        self.directory = directory
+        self.settle = settle
+        # path => (size, mtime, time the file was first seen like this)
+        self.files = {}
+        self.reported = set()
+
+    def poll(self, timeout):
+        """Wait up to `timeout` seconds and return the completed files."""
+        time.sleep(timeout)
+        now = time.time()
+        paths = []
+
+        for path in listFiles(self.directory):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            state = (stat.st_size, stat.st_mtime)
+            previous = self.files.get(path)
+
+            if previous is None or previous[:2] != state:
+                self.files[path] = state + (now,)
+                self.reported.discard(path)
+            elif now - previous[2] >= self.settle and \
+                    path not in self.reported:
+                self.reported.add(path)
+                paths.append(path)
+
+        return paths
+
+    def close(self):
+        """Stop watching."""
+        pass
+
+
+def createWatcher(directory, settle, polling=False):
+    """Return an inotify watcher, or a polling one if it isn't available."""
+    if not polling:
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError, TypeError):
+            logger.info("inotify is not available. Polling \'" +
+                        directory + "\' instead.")
+
+    return PollingWatcher(directory, settle)
+
+
+def watch(config, directory, settle=5.0, window=10.0, polling=False):
+    """Publish audio files dropped into `directory` until interrupted.
+
+    Episodes that finish processing within `window` seconds of each other
+    are published together. The config and the episode index stay loaded
+    between publishes.
+    """
+    if not os.path.isdir(directory):
+        raise errors.ConfigError("\'" + directory + "\' is not a directory.")
+
+    index = episodeIndex.openIndex(config)
+    suffixes = [rendition['mp3Suffix'] + ".mp3"
+                for rendition in audio.renditions(config)]
+    feeds = core.renditionFeeds(config)
+    watcher = createWatcher(directory, settle, polling)
+    pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=multiprocessing.cpu_count(), initializer=ignoreInterrupt)
+
+    # Guids of the episodes seen so far. A WAV and the MP3 transcoded from it
+    # (which also lands in the folder) share the same guid.
+    queued = set()
+    pending = {}
+
+    # Episodes that were processed (the files, and what became of them)
+    sources = []
+    finished = []
+    lastFinished = 0
+
+    def guidOf(path):
+        return rss.episodeGuid(config, audio.mp3Filename(path))
+
+    def publish(sources, finished):
+        # The watch goes on. The episodes are picked up again if they are
+        # dropped again (their MP3s are reused).
+        try:
+            core.addToFeeds(config, feeds, sources, finished, index)
+        except (errors.PenPenError, IOError, OSError):
+            logger.exception("Publishing %d episode(s) failed." %
+                             len(finished))
+
+            for episode in sources:
+                queued.discard(guidOf(episode[0]))
+
+    def enqueue(path):
+        if not isAudioFile(path) or \
+                any(path.lower().endswith(suffix.lower())
+                    for suffix in suffixes):
+            return
+
+        guid = guidOf(path)
+
+        if guid in queued:
+            return
+
+        queued.add(guid)
+
+        if episodeIndex.hasEpisode(index, guid):
+            logger.info("\'" + path + "\' is already in the feed. Skipping.")
+            return
+
+        episode = (path,) + episodeText(path)
+        logger.info("Queued \'" + path + "\'")
+        pending[pool.submit(core.processEpisode, episode, config)] = episode
+
+    logger.info("Watching \'" + directory + "\' for new episodes...")
+
+    # Files that were dropped while we weren't running. With polling they
+    # are reported once they are seen to be stable.
+    if isinstance(watcher, InotifyWatcher):
+        for path in listFiles(directory):
+            enqueue(path)
+
+    try:
+        while True:
+            for path in watcher.poll(1.0):
+                enqueue(path)
+
+            for future in [f for f in pending if f.done()]:
+                episode = pending.pop(future)
+
+                try:
+                    finished.append(future.result())
+                    sources.append(episode)
+                    lastFinished = time.time()
+                except Exception:
+                    logger.exception("Processing \'" + episode[0] +
+                                     "\' failed.")
+
+                    # Picked up again if the file is fixed or dropped again
+                    queued.discard(guidOf(episode[0]))
+
+            # Wait for the burst to end before rewriting the feed
+            if finished and time.time() - lastFinished >= window:
+                publish(sources, finished)
+                sources = []
+                finished = []
+    except KeyboardInterrupt:
+        logger.info("Stopping...")
+
+        if finished:
+            publish(sources, finished)
+    finally:
+        watcher.close()
+        pool.shutdown(wait=False, cancel_futures=True)
+        index.close()
+
+
+def ignoreInterrupt():
+    """Leave Ctrl-C to the watcher, which stops the workers itself."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def episodeText(path):
+    """Return the (title, desc) of an episode from its text file or name."""
+    fileroot, _ = os.path.splitext(path)
+    title = os.path.basename(fileroot)
+    desc = title
+
+    if os.path.isfile(fileroot + ".txt"):
+        with open(fileroot + ".txt") as f:
+            lines = f.read().strip().split("\n", 1)
+
+        title = lines[0].strip() or title
+        desc = lines[1].strip() if len(lines) > 1 else title
+
+    return title, desc
+
+
+def isAudioFile(path):
+    """Check for a visible WAV or MP3 file."""
+    return (not os.path.basename(path).startswith(".") and
+            os.path.isfile(path) and
+            (fileUtils.extValid(path, '.WAV') or
+             fileUtils.extValid(path, '.MP3')))
+
+
+def listFiles(directory):
+    """Return the paths of the files in a directory."""
+    return [os.path.join(directory, name)
+            for name in sorted(os.listdir(directory))]
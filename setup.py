@@ -42,6 +42,13 @@ setup(
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=['mutagen==1.33.2'],
 
+    # Optional features, e.g. pip install penpen[loudness]
+    extras_require={
+        'loudness': ['numpy'],
+        'cover': ['Pillow'],
+        'brotli': ['brotli'],
+    },
+
     # To provide executable scripts, use entry points in preference to the
     # "scripts" keyword. Entry points provide cross-platform support and allow
     # pip to create the appropriate form of executable for the target platform.
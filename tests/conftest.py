@@ -0,0 +1,85 @@
+"""Fixtures shared by the tests: a config in a scratch folder and episodes."""
+
+import os
+import struct
+
+import pytest
+
+from penpen import core
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Silent MPEG 1 Layer III frame: 128 kbps, 44.1 kHz, stereo
+MP3_FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+
+# CD quality WAVs
+WAV_RATE = 44100
+WAV_CHANNELS = 2
+
+
+@pytest.fixture
+def config(tmp_path):
+    """Return the example config with its files moved into `tmp_path`."""
+    config = core.parseConfigFile(os.path.join(REPO_DIR,
+                                               'configurationExample.conf'))
+    config['xmlFilepath'] = str(tmp_path / 'feed.xml')
+    config['rssBackupDir'] = str(tmp_path / 'backups')
+    config['episodeImageFilepath'] = str(tmp_path / 'cover.jpg')
+
+    # Only the extension of the cover is checked
+    with open(config['episodeImageFilepath'], 'wb') as f:
+        f.write(os.urandom(1024))
+
+    return config
+
+
+@pytest.fixture
+def makeEpisode(tmp_path):
+    """Return a function building the (title, desc, mp3File, duration) of an
+    episode with a small untagged MP3."""
+    def makeEpisode(name, frames=40):
+        mp3File = str(tmp_path / (name + '.mp3'))
+
+        with open(mp3File, 'wb') as f:
+            f.write(MP3_FRAME * frames)
+
+        return ("Episode " + name, "About " + name + ".", mp3File, (0, 0, 1))
+
+    return makeEpisode
+
+
+@pytest.fixture
+def makeWav(tmp_path):
+    """Return a function writing a 16 bit stereo WAV of the given samples.
+
+    `samples` are the values of the left and right channels, one per frame.
+    Silence is written if only a length in seconds is given.
+    """
+    def makeWav(name, seconds=1.0, samples=None):
+        wavFile = str(tmp_path / (name + '.wav'))
+
+        if samples is None:
+            samples = [0] * int(seconds * WAV_RATE)
+
+        data = struct.pack('<%dh' % (len(samples) * WAV_CHANNELS),
+                           *[value for value in samples
+                             for _ in range(WAV_CHANNELS)])
+
+        with open(wavFile, 'wb') as f:
+            f.write(b'RIFF' + struct.pack('<I', 36 + len(data)) + b'WAVE')
+            f.write(b'fmt ' + struct.pack('<IHHIIHH', 16, 1, WAV_CHANNELS,
+                                          WAV_RATE,
+                                          WAV_RATE * WAV_CHANNELS * 2,
+                                          WAV_CHANNELS * 2, 16))
+            f.write(b'data' + struct.pack('<I', len(data)) + data)
+
+        return wavFile
+
+    return makeWav
+
+
+@pytest.fixture
+def lame(monkeypatch):
+    """Put the stand-in for LAME of the benchmarks first on the PATH."""
+    monkeypatch.setenv('PATH', os.path.join(REPO_DIR, 'benchmarks', 'bin') +
+                       os.pathsep + os.environ.get('PATH', ''))
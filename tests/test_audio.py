@@ -0,0 +1,144 @@
+"""Tests of transcoding WAVs into MP3s and their renditions."""
+
+import io
+import os
+import stat
+import struct
+
+import pytest
+from mutagen.id3 import ID3
+
+from penpen import audio
+from penpen import errors
+from penpen import probe
+
+from .conftest import MP3_FRAME as FRAME
+
+FRAME_LENGTH = len(FRAME)
+
+# Where the Xing header goes in the first frame (MPEG 1, stereo)
+XING_POS = 36
+
+
+@pytest.fixture
+def mono(config):
+    """Return the config with a mono rendition, without the build cache."""
+    config.update(renditions="mono", buildCache="no",
+                  rendition_mono_lameArgs="-b 64 -m m --quiet",
+                  rendition_mono_rssTitle="Mono")
+    return config
+
+
+def testRenditions(mono):
+    rendition, = audio.renditions(mono)
+
+    assert rendition['mp3Suffix'] == "-mono"
+    assert rendition['lameArgs'] == "-b 64 -m m --quiet"
+    assert rendition['rssTitle'] == "Mono"
+    assert rendition['xmlFilepath'] is None
+    assert rendition['renditions'] == ""
+    assert audio.renditions(dict(mono, renditions=" ")) == []
+
+
+def testRenditionsEncoded(mono, makeWav, lame):
+    wavFile = makeWav("episode", 2)
+    mp3File, duration = audio.process(wavFile, mono, "Episode", "About it.")
+    monoFile = audio.mp3Filename(wavFile, "-mono")
+
+    assert mp3File == audio.mp3Filename(wavFile)
+    assert duration == (0, 0, 2)
+    assert ID3(mp3File).getall('TALB')[0].text == ["My Podcast"]
+    assert ID3(monoFile).getall('TALB')[0].text == ["Mono"]
+
+
+def testFailedEncoderKeepsMp3s(mono, makeWav, tmp_path, monkeypatch):
+    wavFile = makeWav("episode", 1)
+    outputs = [(audio.mp3Filename(wavFile), mono),
+               (audio.mp3Filename(wavFile, "-mono"),
+                audio.renditions(mono)[0])]
+
+    for mp3File, _ in outputs:
+        with open(mp3File, 'wb') as f:
+            f.write(b'published')
+
+    # A LAME that fails after reading its input
+    binDir = tmp_path / 'bin'
+    binDir.mkdir()
+    lamePath = str(binDir / 'lame')
+
+    with open(lamePath, 'w') as f:
+        f.write("#!/bin/sh\ncat > /dev/null\nexit 1\n")
+
+    os.chmod(lamePath, os.stat(lamePath).st_mode | stat.S_IXUSR)
+    monkeypatch.setenv('PATH', str(binDir))
+
+    with pytest.raises(errors.AudioError):
+        audio.transcodeAudio(wavFile, outputs)
+
+    for mp3File, _ in outputs:
+        with open(mp3File, 'rb') as f:
+            assert f.read() == b'published'
+
+    assert sorted(os.listdir(str(tmp_path))) == \
+        ['bin', 'cover.jpg', 'episode-mono.mp3', 'episode.mp3', 'episode.wav']
+
+
+def audioData(mp3File):
+    """Return the bytes of an MP3 after its ID3 tag."""
+    with open(mp3File, 'rb') as f:
+        data = f.read()
+
+    return data[probe.id3Size(data[:10]):]
+
+
+def testStreamedMatchesOnDisk(config, makeWav, lame):
+    config['buildCache'] = "no"
+    wavFile = makeWav("episode", 2)
+    results = {}
+
+    for streaming in ("no", "yes"):
+        config['streamingTranscode'] = streaming
+        mp3File, duration = audio.process(wavFile, config, "Episode", "")
+        frames = sorted((frame.HashKey, frame)
+                        for frame in ID3(mp3File).values())
+        results[streaming] = (duration, frames, audioData(mp3File))
+
+    assert results['yes'][:2] == results['no'][:2]
+
+    # LAME can't seek back on a pipe: the empty first frame it reserves was
+    # filled in with the count of the other frames and the stream's size
+    onDisk, streamed = results['no'][2], results['yes'][2]
+
+    assert len(streamed) == len(onDisk)
+    assert streamed[XING_POS:XING_POS + 16] == b'Xing' + struct.pack(
+        '>III', 3, len(onDisk) // FRAME_LENGTH - 1, len(onDisk))
+    assert streamed[FRAME_LENGTH:] == onDisk[FRAME_LENGTH:]
+
+
+def testVbrHeaderKeepsLameCrc():
+    # A Xing header with every field, then a LAME tag, before 10 frames
+    header = bytearray(FRAME)
+    header[XING_POS:XING_POS + 8] = b'Xing' + struct.pack('>I', 0xf)
+    lamePos = XING_POS + 8 + 4 + 4 + 100 + 4
+    header[lamePos:lamePos + 9] = b'LAME3.100'
+    header[lamePos + 34:lamePos + 36] = struct.pack(
+        '>H', probe.lameTagCrc(header[:lamePos + 34]))
+    stream = bytes(header) + FRAME * 10
+
+    # Counted in chunks that split frame headers
+    counter = probe.FrameCounter()
+
+    for start in range(0, len(stream), 1000):
+        counter.update(stream[start:start + 1000])
+
+    f = io.BytesIO(b'ID3' + stream)
+    audio.writeVbrHeader(f, 3, counter)
+    data = f.getvalue()[3:3 + FRAME_LENGTH]
+
+    assert data[XING_POS + 8:XING_POS + 16] == struct.pack(
+        '>II', 10, len(stream))
+    assert data[lamePos + 34:lamePos + 36] == struct.pack(
+        '>H', probe.lameTagCrc(data[:lamePos + 34]))
+    assert data[lamePos + 34:lamePos + 36] != \
+        bytes(header[lamePos + 34:lamePos + 36])
+
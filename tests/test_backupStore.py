@@ -0,0 +1,52 @@
+"""Tests of the deduplicated feed backups."""
+
+import os
+
+from penpen import backupStore
+from penpen import rss
+
+
+def readFile(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read()
+
+
+def testRestoreRoundTrips(config, makeEpisode, tmp_path):
+    backupDir = config['rssBackupDir']
+    snapshots = []
+
+    for i in range(3):
+        rss.addEpisodes(config, [makeEpisode("%d" % i)])
+        snapshots.append((backupStore.createSnapshot(
+            backupDir, config['xmlFilepath']),
+            readFile(config['xmlFilepath'])))
+
+    for name, data in snapshots:
+        restored = str(tmp_path / (name + '.xml'))
+        backupStore.restoreSnapshot(backupDir, name, restored)
+        assert readFile(restored) == data
+
+
+def testRetentionKeepsLast(config, makeEpisode, tmp_path):
+    backupDir = config['rssBackupDir']
+    config['backupKeepLast'] = "1"
+    config['backupKeepDaily'] = ""
+    config['backupKeepWeekly'] = ""
+
+    for i in range(3):
+        rss.addEpisodes(config, [makeEpisode("%d" % i)])
+        name = backupStore.createSnapshot(backupDir, config['xmlFilepath'])
+
+    backupStore.applyRetention(config, backupDir)
+
+    manifests = backupStore.listSnapshots(backupDir)
+    assert [manifest['name'] for manifest in manifests] == [name]
+
+    # The blocks of the snapshot kept are still there, no others
+    restored = str(tmp_path / 'restored.xml')
+    backupStore.restoreSnapshot(backupDir, name, restored)
+    assert readFile(restored) == readFile(config['xmlFilepath'])
+
+    stored = sum(len(filenames) for _, _, filenames in os.walk(
+        os.path.join(backupDir, backupStore.OBJECTS_DIR)))
+    assert stored == len(set(manifests[0]['blocks']))
@@ -0,0 +1,93 @@
+"""Tests of reusing the MP3s built from unchanged inputs."""
+
+import json
+import os
+
+import pytest
+from mutagen.id3 import ID3
+
+from penpen import audio
+from penpen import buildCache
+
+
+@pytest.fixture
+def encodes(config, lame, monkeypatch):
+    """Record the WAVs transcoded, with the build cache on."""
+    config['buildCache'] = "yes"
+    encoded = []
+    encodeWav = audio.encodeWav
+
+    def recordEncode(filename, *args):
+        encoded.append(os.path.basename(filename))
+        return encodeWav(filename, *args)
+
+    monkeypatch.setattr(audio, 'encodeWav', recordEncode)
+
+    return encoded
+
+
+def testHit(config, makeWav, encodes):
+    wavFile = makeWav("episode", 1)
+    mp3File, duration = audio.process(wavFile, config, "Episode", "")
+    mtimeNs = os.stat(mp3File).st_mtime_ns
+
+    assert audio.process(wavFile, config, "Episode", "") == \
+        (mp3File, duration)
+    assert encodes == ["episode.wav"]
+    assert os.stat(mp3File).st_mtime_ns == mtimeNs
+
+    # A copy of the same WAV is only hashed again
+    os.utime(wavFile, ns=(0, 0))
+    audio.process(wavFile, config, "Episode", "")
+    assert encodes == ["episode.wav"]
+
+
+def testRetagOnly(config, makeWav, encodes):
+    wavFile = makeWav("episode", 1)
+    mp3File, _ = audio.process(wavFile, config, "Episode", "")
+    audio.process(wavFile, config, "Renamed", "")
+
+    assert encodes == ["episode.wav"]
+    assert ID3(mp3File).getall('TIT2')[0].text == ["Renamed"]
+
+
+def testMiss(config, makeWav, encodes):
+    wavFile = makeWav("episode", 1)
+    mp3File, _ = audio.process(wavFile, config, "Episode", "")
+
+    # New contents, then new LAME arguments, then an edited MP3
+    makeWav("episode", 2)
+    assert audio.process(wavFile, config, "Episode", "")[1] == (0, 0, 2)
+
+    config['lameArgs'] = config['lameArgs'] + " -q 2"
+    audio.process(wavFile, config, "Episode", "")
+
+    with open(mp3File, 'ab') as f:
+        f.write(b'\x00')
+
+    audio.process(wavFile, config, "Episode", "")
+
+    assert encodes == ["episode.wav"] * 4
+
+
+def testEntriesAreHidden(config, makeWav, encodes, tmp_path):
+    wavFile = makeWav("episode", 1)
+    mp3File, _ = audio.process(wavFile, config, "Episode", "")
+
+    assert not [name for name in os.listdir(str(tmp_path))
+                if name.endswith(buildCache.CACHE_SUFFIX)]
+    assert os.path.isfile(str(tmp_path / buildCache.CACHE_DIR /
+                              'episode.mp3.build'))
+
+    # Entries written next to the MP3 by older versions are moved
+    entry = buildCache.loadEntry(mp3File)
+    os.remove(buildCache.cacheFilepath(mp3File))
+
+    with open(mp3File + buildCache.CACHE_SUFFIX, 'w') as f:
+        json.dump(entry, f)
+
+    audio.process(wavFile, config, "Renamed", "")
+
+    assert encodes == ["episode.wav"]
+    assert not os.path.exists(mp3File + buildCache.CACHE_SUFFIX)
+    assert buildCache.loadEntry(mp3File)['tagKey'] != entry['tagKey']
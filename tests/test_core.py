@@ -0,0 +1,77 @@
+"""Tests of publishing episodes to the feed and the feeds of renditions."""
+
+import sqlite3
+
+import pytest
+
+from penpen import core
+from penpen import episodeIndex
+from penpen import errors
+from penpen import rss
+
+
+@pytest.fixture
+def monoFeed(config, tmp_path):
+    """Return the config with a mono rendition that has a feed."""
+    config.update(renditions="mono", buildCache="no",
+                  rendition_mono_xmlFilepath=str(tmp_path / 'mono.xml'))
+    return config
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    """Record the connections opened to episode indexes."""
+    opened = []
+    openIndex = episodeIndex.openIndex
+
+    def recordIndex(config):
+        opened.append(openIndex(config))
+        return opened[-1]
+
+    monkeypatch.setattr(episodeIndex, 'openIndex', recordIndex)
+
+    return opened
+
+
+def isClosed(conn):
+    try:
+        conn.execute("SELECT 1")
+    except sqlite3.ProgrammingError:
+        return True
+
+    return False
+
+
+def testRenditionFeeds(monoFeed, makeWav, lame, connections):
+    feeds = core.renditionFeeds(monoFeed)
+    episodes = [(makeWav("episode", 1), "Episode", "About it.")]
+
+    core.checkDuplicates(monoFeed, feeds, [episodes[0][0]])
+    processed = [core.processEpisode(episodes[0], monoFeed)]
+    core.addToFeeds(monoFeed, feeds, episodes, processed)
+
+    assert connections and all(isClosed(conn) for conn in connections)
+
+    for config in [monoFeed] + feeds:
+        index = episodeIndex.openIndex(config)
+        assert [record[1] for record in
+                episodeIndex.listEpisodes(index)] == ["Episode"]
+        index.close()
+
+    with open(feeds[0]['xmlFilepath'], 'rb') as f:
+        assert b'episode-mono.mp3' in f.read()
+
+    with pytest.raises(errors.DuplicateEpisodeError):
+        core.checkDuplicates(monoFeed, feeds, [episodes[0][0]])
+
+    assert all(isClosed(conn) for conn in connections)
+
+
+def testIndexesAreClosed(config, makeEpisode, connections):
+    episode = makeEpisode("1")
+    rss.addEpisodes(config, [episode])
+    rss.generateXml(config, [])
+    rss.removeEpisodes(config, [rss.episodeGuid(config, episode[2])])
+
+    assert len(connections) == 3
+    assert all(isClosed(conn) for conn in connections)
@@ -0,0 +1,87 @@
+"""Tests of downscaling the cover art and caching the result."""
+
+import glob
+import hashlib
+import io
+
+import pytest
+from PIL import Image
+
+from penpen import coverArt
+from penpen import errors
+
+
+@pytest.fixture
+def cover(config, monkeypatch):
+    """Return a function writing the cover in `config` with Pillow."""
+    monkeypatch.setattr(coverArt, '_images', {})
+    config['coverArtSize'] = "100"
+
+    def cover(size, format):
+        filepath = config['episodeImageFilepath'].rsplit('.', 1)[0] + \
+            ('.png' if format == 'PNG' else '.jpg')
+        Image.new('RGB', (size, size), (200, 20, 20)).save(filepath, format)
+        config['episodeImageFilepath'] = filepath
+        return filepath
+
+    return cover
+
+
+def notDecoded(monkeypatch):
+    """Fail the test if a cover is opened with Pillow from now on."""
+    def fail(filepath):
+        raise AssertionError("The cover was decoded again")
+
+    monkeypatch.setattr(Image, 'open', fail)
+    monkeypatch.setattr(coverArt, '_images', {})
+
+
+def testLargeCoverIsResized(config, cover, monkeypatch):
+    filepath = cover(400, 'PNG')
+    image = coverArt.embeddedImage(config)
+
+    assert image.mime == 'image/jpeg'
+    assert image.sha256 == hashlib.sha256(image.data).hexdigest()
+
+    with Image.open(io.BytesIO(image.data)) as resized:
+        assert resized.size == (100, 100)
+
+    # Other runs read the cached copy
+    notDecoded(monkeypatch)
+    assert coverArt.embeddedImage(config) == image
+    assert len(glob.glob(filepath + ".*px-q85.jpg")) == 1
+
+
+def testSmallJpegIsCachedAsIs(config, cover, monkeypatch):
+    filepath = cover(50, 'JPEG')
+
+    with open(filepath, 'rb') as f:
+        data = f.read()
+
+    image = coverArt.embeddedImage(config)
+    assert (image.mime, image.data) == ('image/jpeg', data)
+
+    notDecoded(monkeypatch)
+    assert coverArt.embeddedImage(config) == image
+
+
+def testStaleCachesAreRemoved(config, cover, monkeypatch):
+    filepath = cover(400, 'PNG')
+    coverArt.embeddedImage(config)
+    first = glob.glob(filepath + ".*px-q85.jpg")
+
+    # A new cover
+    monkeypatch.setattr(coverArt, '_images', {})
+    cover(300, 'PNG')
+    coverArt.embeddedImage(config)
+    cached = glob.glob(filepath + ".*px-q85.jpg")
+
+    assert len(cached) == 1 and cached != first
+
+
+@pytest.mark.parametrize('size', ["0", "-600"])
+def testInvalidSize(config, size):
+    config['coverArtSize'] = size
+
+    with pytest.raises(errors.ConfigError):
+        coverArt.embeddedImage(config)
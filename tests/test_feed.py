@@ -0,0 +1,109 @@
+"""Tests of publishing from Python with `feed.Feed`, and of the errors it
+raises instead of exiting."""
+
+import pytest
+
+from penpen import core
+from penpen import errors
+from penpen import feed
+from penpen import rss
+
+
+def mp3Episode(makeEpisode, name):
+    """Return the (filename, title, desc) of an untagged MP3 to add."""
+    title, desc, mp3File, _ = makeEpisode(name)
+    return mp3File, title, desc
+
+
+def feedTitles(podcast):
+    return [episode.title for episode in podcast.episodes]
+
+
+def testAddAndRemove(config, makeEpisode):
+    with feed.Feed(config) as podcast:
+        guid = podcast.addEpisode(*mp3Episode(makeEpisode, "1"))
+        podcast.addEpisode(*mp3Episode(makeEpisode, "2"))
+
+        # Nothing is published before saving
+        assert podcast.episodes == []
+
+        podcast.save()
+        assert feedTitles(podcast) == ["Episode 2", "Episode 1"]
+
+        podcast.removeEpisode(guid)
+        podcast.save()
+        assert feedTitles(podcast) == ["Episode 2"]
+
+    with open(config['xmlFilepath'], 'rb') as f:
+        data = f.read()
+
+    assert b'Episode 2' in data
+    assert b'Episode 1' not in data
+
+
+def testUnsavedEpisodeIsDropped(config, makeEpisode):
+    with feed.Feed(config) as podcast:
+        guid = podcast.addEpisode(*mp3Episode(makeEpisode, "1"))
+        podcast.removeEpisode(guid)
+        podcast.save()
+
+        assert podcast.episodes == []
+
+
+def testDuplicates(config, makeEpisode):
+    episode = mp3Episode(makeEpisode, "1")
+
+    with feed.Feed(config) as podcast:
+        podcast.addEpisode(*episode)
+
+        # Added twice before saving, then once saved
+        with pytest.raises(errors.DuplicateEpisodeError):
+            podcast.addEpisode(*episode)
+
+        podcast.save()
+
+        with pytest.raises(errors.DuplicateEpisodeError):
+            podcast.addEpisode(*episode)
+
+
+def testRemoveErrors(config, makeEpisode):
+    config['feedPageSize'] = "2"
+    episodes = [makeEpisode("%d" % i) for i in range(5)]
+    rss.addEpisodes(config, episodes)
+
+    with feed.Feed(config) as podcast:
+        with pytest.raises(errors.EpisodeNotFoundError):
+            podcast.removeEpisode("missing")
+
+        archived = rss.episodeGuid(config, episodes[0][2])
+
+        with pytest.raises(errors.FeedError) as excinfo:
+            podcast.removeEpisode(archived)
+
+        assert excinfo.type is errors.FeedError
+
+        assert podcast.removed == []
+
+
+def testMissingAudio(config, tmp_path):
+    with feed.Feed(config) as podcast:
+        with pytest.raises(errors.AudioError):
+            podcast.addEpisode(str(tmp_path / 'missing.wav'), "Missing", "")
+
+        assert podcast.added == []
+
+
+def testValidateRaises(config, makeEpisode, tmp_path):
+    configFile = str(tmp_path / 'podcast.conf')
+
+    with open(configFile, 'w') as f:
+        f.write("".join("%s = %s\n" % item for item in config.items()))
+
+    rss.addEpisodes(config, [makeEpisode("1")])
+    core.validateFeed(['-c', configFile])
+
+    with open(config['xmlFilepath'], 'ab') as f:
+        f.write(b'<item>')
+
+    with pytest.raises(errors.FeedError):
+        core.validateFeed(['-c', configFile])
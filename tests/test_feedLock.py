@@ -0,0 +1,72 @@
+"""Tests of the feed lock and the queue of publish requests."""
+
+import contextlib
+import os
+
+import pytest
+
+from penpen import feedLock
+from penpen import rss
+
+
+def spooled(config):
+    directory = feedLock.spoolDir(config)
+    return os.listdir(directory) if os.path.isdir(directory) else []
+
+
+def testInterruptedPublishIsWithdrawn(config, makeEpisode, monkeypatch):
+    rss.addEpisodes(config, [makeEpisode("1")])
+    locked = feedLock.locked
+
+    @contextlib.contextmanager
+    def interrupted(config):
+        raise KeyboardInterrupt
+        yield
+
+    # Interrupted while waiting for the lock
+    monkeypatch.setattr(feedLock, 'locked', interrupted)
+
+    with pytest.raises(KeyboardInterrupt):
+        rss.addEpisodes(config, [makeEpisode("aborted")])
+
+    assert spooled(config) == []
+
+    # The next run only publishes its own episode
+    monkeypatch.setattr(feedLock, 'locked', locked)
+    rss.addEpisodes(config, [makeEpisode("2")])
+
+    with open(config['xmlFilepath'], 'rb') as f:
+        data = f.read()
+
+    assert b'Episode 2' in data
+    assert b'Episode aborted' not in data
+
+
+def testFailedCommitIsWithdrawn(config, makeEpisode, monkeypatch):
+    def fail(config, request, index=None):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(rss, 'commitRequests', fail)
+
+    with pytest.raises(OSError):
+        rss.addEpisodes(config, [makeEpisode("1")])
+
+    assert spooled(config) == []
+
+
+def testAnswersAreTaken(config):
+    committed = feedLock.enqueue(config, [])
+    failed = feedLock.enqueue(config, [])
+
+    with feedLock.locked(config):
+        assert [request for request, _ in
+                feedLock.pendingRequests(config)] == [committed, failed]
+        assert feedLock.takeResult(committed) is None
+
+        feedLock.finishRequest(committed)
+        feedLock.finishRequest(failed, "Already in the feed.")
+
+        assert feedLock.takeResult(committed) == (True, None)
+        assert feedLock.takeResult(failed) == (False, "Already in the feed.")
+
+    assert spooled(config) == []
@@ -0,0 +1,22 @@
+"""Tests of the helpers replacing published files."""
+
+import os
+import stat
+
+from penpen import fileUtils
+
+
+def testUmaskIsNotToggled(tmp_path, monkeypatch):
+    # Streamed transcodes write MP3s from other threads meanwhile
+    def umask(mask):
+        raise AssertionError("The umask was set while writing")
+
+    monkeypatch.setattr(os, 'umask', umask)
+    filepath = str(tmp_path / 'feed.xml')
+    fileUtils.writeAtomic(filepath, lambda f: f.write(b'<rss/>'))
+
+    with open(filepath, 'rb') as f:
+        assert f.read() == b'<rss/>'
+
+    assert stat.S_IMODE(os.stat(filepath).st_mode) == \
+        0o666 & ~fileUtils._umask
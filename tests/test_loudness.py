@@ -0,0 +1,45 @@
+"""Tests of the ITU-R BS.1770 loudness measurement."""
+
+import math
+
+import pytest
+
+from penpen import loudness
+
+from .conftest import WAV_RATE
+
+pytest.importorskip('numpy')
+
+
+def sine(frequency, amplitude, seconds):
+    """Return the 16 bit samples of a sine wave."""
+    return [int(round(amplitude * 32767 *
+                      math.sin(2 * math.pi * frequency * i / WAV_RATE)))
+            for i in range(int(seconds * WAV_RATE))]
+
+
+def testSineLoudness(makeWav):
+    # A full scale 1 kHz sine reads -3.01 LUFS per channel, so 0 LUFS in
+    # both channels of a stereo file
+    for amplitude, expected in ((1.0, 0.0), (0.5, -6.02), (0.1, -20.0)):
+        wavFile = makeWav("sine", samples=sine(1000, amplitude, 5))
+        integrated, truePeak = loudness.measure(wavFile)
+
+        assert integrated == pytest.approx(expected, abs=0.1)
+        assert truePeak == pytest.approx(expected, abs=0.1)
+
+
+def testSilence(makeWav):
+    assert loudness.measure(makeWav("silence", 1)) == \
+        (float('-inf'), float('-inf'))
+
+
+def testGainIsLimitedByTruePeak(makeWav):
+    wavFile = makeWav("sine", samples=sine(1000, 0.5, 5))
+    normalization = {'target': 0.0, 'truePeakLimit': -1.0}
+    result = loudness.analyze(wavFile, normalization)
+
+    # 6 dB louder would peak at 0 dBTP
+    assert result['integrated'] == pytest.approx(-6.02, abs=0.1)
+    assert result['gain'] == pytest.approx(-1.0 - result['truePeak'],
+                                           abs=0.01)
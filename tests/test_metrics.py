@@ -0,0 +1,94 @@
+"""Tests of the stage metrics."""
+
+import io
+import json
+
+import pytest
+
+from penpen import metrics
+
+
+@pytest.fixture(autouse=True)
+def recording(monkeypatch):
+    """Record into fresh state, with metrics enabled."""
+    monkeypatch.setattr(metrics, '_records', [])
+    monkeypatch.setattr(metrics, '_stack', [])
+    monkeypatch.setattr(metrics, '_state', dict(metrics._state,
+                                                enabled=True, started=0))
+
+
+@metrics.stage('inner')
+def inner():
+    pass
+
+
+def testDisabled(monkeypatch):
+    monkeypatch.setitem(metrics._state, 'enabled', False)
+
+    with metrics.stage('outer'):
+        inner()
+
+    assert metrics.records() == []
+
+
+def testNestedStages():
+    with metrics.stage('outer'):
+        inner()
+        inner()
+
+    with pytest.raises(ValueError):
+        with metrics.stage('failing'):
+            raise ValueError
+
+    assert [(record['stage'], record['parent'], record['depth'],
+             record['failed']) for record in metrics.records()] == \
+        [('inner', 'outer', 1, False), ('inner', 'outer', 1, False),
+         ('outer', None, 0, False), ('failing', None, 0, True)]
+
+    assert [(total['stage'], total['calls'], total['depth'])
+            for total in metrics.summarize()] == \
+        [('outer', 1, 0), ('inner', 2, 1), ('failing', 1, 0)]
+    assert metrics.formatTable().splitlines()[2].startswith("  inner ")
+
+
+def testWorkerRecordsAreMerged():
+    # Recorded in a worker: a top level stage
+    workerRecord = {'stage': 'worker', 'parent': None, 'depth': 0,
+                    'started': 1, 'pid': 0, 'wall': 1.0, 'cpu': 0.0,
+                    'childCpu': 0.0, 'readBytes': 0, 'writeBytes': 0,
+                    'peakRssKb': 0, 'failed': False}
+
+    with metrics.stage('outer'):
+        metrics.merge([workerRecord])
+
+    totals = dict((total['stage'], total) for total in metrics.summarize())
+    assert (totals['worker']['parent'], totals['worker']['depth']) == \
+        ('outer', 1)
+
+
+def testPeakBelongsToStage():
+    metrics.resetPeakRss()
+
+    if not metrics._state['canResetPeak']:
+        pytest.skip("The peak RSS can't be reset here")
+
+    with metrics.stage('large'):
+        data = bytearray(64 * 1048576)
+        data[::4096] = b'\x01' * len(data[::4096])
+        del data
+
+    with metrics.stage('small'):
+        pass
+
+    peaks = dict((record['stage'], record['peakRssKb'])
+                 for record in metrics.records())
+    assert peaks['large'] - peaks['small'] > 32 * 1024
+
+
+def testJsonLines():
+    inner()
+    f = io.StringIO()
+    metrics.writeJsonLines(f)
+
+    assert [json.loads(line)['stage'] for line in
+            f.getvalue().splitlines()] == ['inner']
@@ -0,0 +1,67 @@
+"""Tests of reading durations from the headers of WAVs and MP3s."""
+
+import struct
+
+import pytest
+
+from penpen import probe
+
+from .conftest import MP3_FRAME as FRAME
+from .conftest import WAV_CHANNELS, WAV_RATE
+
+# Samples per MPEG 1 Layer III frame
+FRAME_SAMPLES = 1152
+
+
+def setDataSize(wavFile, size):
+    """Overwrite the size of the `data` chunk, as a streamed recorder
+    would leave it."""
+    with open(wavFile, 'r+b') as f:
+        f.seek(40)
+        f.write(struct.pack('<I', size))
+
+
+def testWavDuration(makeWav):
+    info = probe.probeFile(makeWav("episode", 1.5))
+
+    assert info.length == pytest.approx(1.5)
+    assert info.bitrate == WAV_RATE * WAV_CHANNELS * 16
+    assert (info.sampleRate, info.channels) == (WAV_RATE, WAV_CHANNELS)
+
+
+@pytest.mark.parametrize('size', [0, 0xFFFFFFFF])
+def testUnsetWavSize(makeWav, size):
+    wavFile = makeWav("episode", 2)
+    setDataSize(wavFile, size)
+
+    assert probe.probeFile(wavFile).length == pytest.approx(2)
+
+
+def testMp3FramesAreScanned(tmp_path):
+    mp3File = str(tmp_path / 'episode.mp3')
+
+    # Behind an ID3 tag, without a VBR header
+    with open(mp3File, 'wb') as f:
+        f.write(b'ID3\x03\x00\x00\x00\x00\x00\x10' + b'\x00' * 16)
+        f.write(FRAME * 100)
+
+    info = probe.probeFile(mp3File)
+
+    assert info.length == pytest.approx(100.0 * FRAME_SAMPLES / 44100)
+    assert info.bitrate == pytest.approx(128000, rel=0.01)
+    assert (info.sampleRate, info.channels) == (44100, 2)
+
+
+def testMp3XingHeader(tmp_path):
+    mp3File = str(tmp_path / 'episode.mp3')
+
+    # Only the first of the 1000 frames the header counts is written
+    header = bytearray(FRAME)
+    header[36:48] = b'Xing' + struct.pack('>II', 1, 1000)
+
+    with open(mp3File, 'wb') as f:
+        f.write(bytes(header) + FRAME)
+
+    info = probe.probeFile(mp3File)
+
+    assert info.length == pytest.approx(1000.0 * FRAME_SAMPLES / 44100)
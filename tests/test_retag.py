@@ -0,0 +1,35 @@
+"""Tests of bringing the tags of published MP3s up to date."""
+
+from mutagen.id3 import ID3
+
+from penpen import audio
+from penpen import retag
+
+
+def readFile(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read()
+
+
+def testRetagInPlace(config, makeEpisode):
+    _, _, mp3File, _ = makeEpisode("1")
+    audioData = readFile(mp3File)
+    audio.tagAudio(mp3File, config, "Episode 1")
+    job = (mp3File, config, "Episode 1", None)
+
+    assert retag.retagFile(job) == (mp3File, retag.UP_TO_DATE, [])
+
+    before = readFile(mp3File)
+
+    config['episodeAuthor'] = "Another Author"
+
+    assert retag.retagFile(job, dryRun=True) == \
+        (mp3File, retag.STALE, ['TPE1'])
+    assert retag.retagFile(job) == (mp3File, retag.IN_PLACE, ['TPE1'])
+
+    # The new tag fit in the padding: the audio didn't move
+    after = readFile(mp3File)
+    assert len(after) == len(before)
+    assert after.endswith(audioData)
+    assert ID3(mp3File).getall('TPE1')[0].text == ["Another Author"]
+    assert retag.retagFile(job) == (mp3File, retag.UP_TO_DATE, [])
@@ -0,0 +1,219 @@
+"""Tests of publishing to the feed: queued commits, splices, fragments and
+archive pages."""
+
+import collections
+import multiprocessing
+import os
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from penpen import episodeIndex
+from penpen import errors
+from penpen import rss
+from penpen import validate
+
+
+def publish(config, episode):
+    rss.addEpisodes(config, [episode])
+
+
+def feedGuids(config):
+    return [item.findtext('guid')
+            for item in ET.parse(config['xmlFilepath']).iter('item')]
+
+
+def testConcurrentAddsLandOnce(config, makeEpisode):
+    episodes = [makeEpisode("%d" % i) for i in range(8)]
+    rss.addEpisodes(config, [makeEpisode("first")])
+
+    # Every run queues its episode, and whichever holds the lock commits it
+    processes = [multiprocessing.Process(target=publish,
+                                         args=(config, episode))
+                 for episode in episodes]
+
+    for process in processes:
+        process.start()
+
+    for process in processes:
+        process.join()
+
+    assert [process.exitcode for process in processes] == [0] * 8
+
+    guids = feedGuids(config)
+    expected = [rss.episodeGuid(config, mp3File)
+                for _, _, mp3File, _ in episodes]
+    counts = collections.Counter(guids)
+    assert all(counts[guid] == 1 for guid in expected)
+    assert len(guids) == len(expected) + 1
+
+    index = episodeIndex.openIndex(config)
+    assert episodeIndex.countEpisodes(index) == len(guids)
+    index.close()
+
+
+def testDuplicateLeavesFeedAlone(config, makeEpisode):
+    episode = makeEpisode("1")
+    rss.addEpisodes(config, [episode])
+
+    with open(config['xmlFilepath'], 'rb') as f:
+        before = f.read()
+
+    with pytest.raises(errors.DuplicateEpisodeError):
+        rss.addEpisodes(config, [episode])
+
+    with open(config['xmlFilepath'], 'rb') as f:
+        assert f.read() == before
+
+
+def testSpliceKeepsOffsets(config, makeEpisode):
+    rss.addEpisodes(config, [makeEpisode("%d" % i) for i in range(3)])
+
+    for i in range(3, 6):
+        rss.addEpisodes(config, [makeEpisode("%d" % i)])
+
+    index = episodeIndex.openIndex(config)
+    records = [record for record in episodeIndex.listEpisodes(index)]
+    index.close()
+
+    # Rebuilding the index from the spliced feed gives the same offsets
+    assert records == list(episodeIndex.scanFeed(config['xmlFilepath']))
+
+    with open(config['xmlFilepath'], 'rb') as f:
+        data = f.read()
+
+    for record in records:
+        assert data[record[6]:].startswith(b'<item>')
+        end = data.index(b'</item>', record[6])
+        assert record[0].encode('utf-8') in data[record[6]:end]
+
+
+def testUnchangedItemsSurviveRewrite(config, makeEpisode):
+    rss.addEpisodes(config, [makeEpisode("%d" % i) for i in range(3)])
+
+    with open(config['xmlFilepath'], 'rb') as f:
+        data = f.read()
+
+    # Edit one item by hand: only that one is serialized again
+    edited = data.replace(b'About 1.', b'About one.')
+
+    with open(config['xmlFilepath'], 'wb') as f:
+        f.write(edited)
+
+    index = episodeIndex.openIndex(config)
+    episodeIndex.refreshIndex(index, config['xmlFilepath'])
+    items = list(rss.feedFragments(index, config['xmlFilepath']))
+
+    assert [isinstance(item, rss.Fragment) for item in items] == \
+        [True, False, True]
+
+    config['rssDescription'] = "A new description."
+    rss.generateXml(config, [], index)
+    index.close()
+
+    with open(config['xmlFilepath'], 'rb') as f:
+        rewritten = f.read()
+
+    assert b'A new description.' in rewritten
+    assert b'About one.' in rewritten
+
+    for fragment in (items[0], items[2]):
+        assert fragment.data.strip() in rewritten
+
+
+def testArchivePages(config, makeEpisode):
+    config['feedPageSize'] = "2"
+
+    for i in range(7):
+        rss.addEpisodes(config, [makeEpisode("%d" % i)])
+
+    index = episodeIndex.openIndex(config)
+    pages = collections.Counter(record[7] for record
+                                in episodeIndex.listEpisodes(index))
+    index.close()
+
+    # Full pages of the oldest episodes, and 2 to 3 episodes in the feed
+    assert pages == {0: 3, 1: 2, 2: 2}
+
+    guids = feedGuids(config)
+
+    for page in (1, 2):
+        pageFilepath = episodeIndex.archiveFilepath(config['xmlFilepath'],
+                                                    page)
+        guids += [item.findtext('guid')
+                  for item in ET.parse(pageFilepath).iter('item')]
+
+    assert sorted(guids) == sorted(rss.episodeGuid(config, "%d.mp3" % i)
+                                   for i in range(7))
+
+    problems, count = validate.validateFeed(config)
+    assert problems == []
+    assert count == 7
+
+
+def testArchivingReusesKeptItems(config, makeEpisode, monkeypatch):
+    config['feedPageSize'] = "2"
+
+    for i in range(3):
+        rss.addEpisodes(config, [makeEpisode("%d" % i)])
+
+    feedFragments = rss.feedFragments
+    items = []
+
+    def recordFragments(index, xmlFilepath):
+        for item in feedFragments(index, xmlFilepath):
+            items.append(item)
+            yield item
+
+    monkeypatch.setattr(rss, 'feedFragments', recordFragments)
+    rss.addEpisodes(config, [makeEpisode("3")])
+
+    # The last item kept ends before the archived ones, which aren't read
+    assert [isinstance(item, rss.Fragment) for item in items] == \
+        [True, True]
+    assert [item.record[1] for item in items] == ["Episode 3", "Episode 2"]
+    assert b'Episode 1' not in items[-1].data
+
+
+def archiveLinks(filepath):
+    """Return the atom links of a feed or archive page by rel."""
+    return {link.get('rel'): link.get('href') for link in
+            ET.parse(filepath).iter('{http://www.w3.org/2005/Atom}link')}
+
+
+def testArchiveChain(config, makeEpisode):
+    config['feedPageSize'] = "2"
+
+    # Two pages frozen together, then one more on its own
+    rss.addEpisodes(config, [makeEpisode("%d" % i) for i in range(7)])
+    rss.addEpisodes(config, [makeEpisode("7")])
+
+    feedDir = os.path.dirname(config['xmlFilepath'])
+    links = archiveLinks(config['xmlFilepath'])
+    feedHref = links['self']
+    pages = []
+
+    # Back from the feed through every page
+    while 'prev-archive' in links:
+        filepath = os.path.join(feedDir,
+                                links['prev-archive'].rsplit('/', 1)[-1])
+        pages.append(filepath)
+        links = archiveLinks(filepath)
+        assert links['current'] == feedHref
+
+    assert [os.path.basename(page) for page in pages] == \
+        ['feed-archive-3.xml', 'feed-archive-2.xml', 'feed-archive-1.xml']
+
+    # Forward links only lead to pages that exist, and back again
+    for filepath in pages:
+        links = archiveLinks(filepath)
+
+        if 'next-archive' in links:
+            nextFilepath = os.path.join(
+                feedDir, links['next-archive'].rsplit('/', 1)[-1])
+            assert os.path.isfile(nextFilepath)
+            assert archiveLinks(nextFilepath)['prev-archive'] == \
+                archiveLinks(filepath)['self']
+
+    assert 'next-archive' not in archiveLinks(pages[0])
+    assert 'next-archive' in archiveLinks(pages[2])
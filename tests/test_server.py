@@ -0,0 +1,120 @@
+"""Tests of the local feed and episode server."""
+
+import asyncio
+import email.utils
+import os
+
+import pytest
+
+from penpen import server
+
+EPISODE = bytes(range(100))
+
+
+@pytest.fixture
+def mounts(tmp_path):
+    with open(str(tmp_path / 'episode.mp3'), 'wb') as f:
+        f.write(EPISODE)
+
+    return [('/podcast/', str(tmp_path))]
+
+
+def fetch(mounts, path='/podcast/episode.mp3', **headers):
+    """Send a GET request and return (status, headers, body)."""
+    async def exchange():
+        listener = await asyncio.start_server(
+            lambda reader, writer: server.handleClient(reader, writer,
+                                                       mounts),
+            '127.0.0.1', 0)
+        port = listener.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+        head = "GET %s HTTP/1.1\r\nConnection: close\r\n" % path
+        head += "".join("%s: %s\r\n" % (key.replace('_', '-'), value)
+                        for key, value in headers.items())
+        writer.write((head + "\r\n").encode('iso-8859-1'))
+        response = await reader.read()
+
+        writer.close()
+        listener.close()
+        await listener.wait_closed()
+
+        return response
+
+    response = asyncio.run(exchange())
+    head, body = response.split(b'\r\n\r\n', 1)
+    lines = head.decode('iso-8859-1').split('\r\n')
+    respHeaders = dict(line.split(': ', 1) for line in lines[1:])
+
+    return int(lines[0].split(' ')[1]), respHeaders, body
+
+
+def testWholeFile(mounts):
+    status, headers, body = fetch(mounts)
+
+    assert status == 200
+    assert body == EPISODE
+    assert headers['Content-Type'] == 'audio/mpeg'
+
+
+def testSingleRange(mounts):
+    status, headers, body = fetch(mounts, Range='bytes=10-19')
+
+    assert status == 206
+    assert body == EPISODE[10:20]
+    assert headers['Content-Range'] == 'bytes 10-19/100'
+
+    status, _, body = fetch(mounts, Range='bytes=-5')
+    assert (status, body) == (206, EPISODE[-5:])
+
+
+def testUnsatisfiableRange(mounts):
+    status, headers, body = fetch(mounts, Range='bytes=100-')
+
+    assert status == 416
+    assert headers['Content-Range'] == 'bytes */100'
+    assert body == b''
+
+
+def testUnsupportedRangesAreIgnored(mounts):
+    for value in ('bytes=0-9,20-29', 'bytes=9-0', 'items=0-9'):
+        status, _, body = fetch(mounts, Range=value)
+        assert (status, body) == (200, EPISODE)
+
+
+def testIfRange(mounts):
+    _, headers, _ = fetch(mounts)
+
+    for validator in (headers['ETag'], headers['Last-Modified']):
+        status, _, body = fetch(mounts, Range='bytes=0-9',
+                                If_Range=validator)
+        assert (status, body) == (206, EPISODE[:10])
+
+    for validator in ('"stale"', 'Thu, 01 Jan 1998 00:00:00 GMT'):
+        status, _, body = fetch(mounts, Range='bytes=0-9',
+                                If_Range=validator)
+        assert (status, body) == (200, EPISODE)
+
+
+def testNotModified(mounts):
+    _, headers, _ = fetch(mounts)
+
+    status, _, body = fetch(mounts, If_None_Match=headers['ETag'])
+    assert (status, body) == (304, b'')
+
+    status, _, _ = fetch(mounts, If_Modified_Since=headers['Last-Modified'])
+    assert status == 304
+
+    past = email.utils.formatdate(0, usegmt=True)
+    status, _, _ = fetch(mounts, If_Modified_Since=past)
+    assert status == 200
+
+
+def testNotFound(mounts, monkeypatch):
+    assert fetch(mounts, '/podcast/missing.mp3')[0] == 404
+    assert fetch(mounts, '/podcast/.hidden.mp3')[0] == 404
+
+    # Deleted after it was found
+    missing = os.path.join(mounts[0][1], 'deleted.mp3')
+    monkeypatch.setattr(server, 'resolvePath', lambda mounts, path: missing)
+    assert fetch(mounts)[0] == 404
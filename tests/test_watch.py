@@ -0,0 +1,83 @@
+"""Tests of publishing the episodes dropped into a watched folder."""
+
+import os
+import time
+
+from penpen import episodeIndex
+from penpen import watch
+
+
+class DropWatcher(object):
+    """Report the dropped files once, then stop the watch after a while."""
+
+    def __init__(self, paths, polls=20):
+        self.paths = paths
+        self.polls = polls
+
+    def poll(self, timeout):
+        paths, self.paths = self.paths, []
+        self.polls -= 1
+
+        if self.polls < 0:
+            raise KeyboardInterrupt
+
+        time.sleep(0.1)
+        return paths
+
+    def close(self):
+        pass
+
+
+def testEpisodeText(tmp_path):
+    wavFile = str(tmp_path / 'episode-1.wav')
+    assert watch.episodeText(wavFile) == ("episode-1", "episode-1")
+
+    with open(str(tmp_path / 'episode-1.txt'), 'w') as f:
+        f.write("The First\nAbout the first.\nAnd more.\n")
+
+    assert watch.episodeText(wavFile) == \
+        ("The First", "About the first.\nAnd more.")
+
+
+def testIsAudioFile(tmp_path):
+    for name in ('episode.wav', 'episode.MP3', '.episode.wav', 'notes.txt'):
+        open(str(tmp_path / name), 'w').close()
+
+    assert [name for name in sorted(os.listdir(str(tmp_path)))
+            if watch.isAudioFile(str(tmp_path / name))] == \
+        ['episode.MP3', 'episode.wav']
+
+
+def testPollingWaitsForStableFiles(tmp_path):
+    filepath = str(tmp_path / 'episode.wav')
+    watcher = watch.PollingWatcher(str(tmp_path), 0)
+
+    with open(filepath, 'wb') as f:
+        f.write(b'RIFF')
+
+    assert watcher.poll(0) == []
+
+    # Still being written
+    with open(filepath, 'ab') as f:
+        f.write(b'WAVE')
+
+    assert watcher.poll(0) == []
+    assert watcher.poll(0) == [filepath]
+    assert watcher.poll(0) == []
+
+
+def testDroppedEpisodesArePublished(config, makeEpisode, tmp_path,
+                                    monkeypatch):
+    config.update(renditions="mono", rendition_mono_mp3Suffix="-mono")
+    episodes = [makeEpisode("1"), makeEpisode("2"), makeEpisode("2-mono")]
+    paths = [mp3File for _, _, mp3File, _ in episodes]
+    watcher = DropWatcher(paths + paths[:1])
+    monkeypatch.setattr(watch, 'createWatcher', lambda *args: watcher)
+
+    watch.watch(config, str(tmp_path), window=0)
+
+    # Once each, without the rendition's MP3
+    index = episodeIndex.openIndex(config)
+    assert sorted(record[1] for record in
+                  episodeIndex.listEpisodes(index)) == ["1", "2"]
+    index.close()